@@ -0,0 +1,8 @@
+from rediz.client import Rediz
+from rediz.collider_config_private import REDIZ_COLLIDER_CONFIG
+import pprint
+
+
+if __name__ == '__main__':
+    rdz = Rediz(**REDIZ_COLLIDER_CONFIG)
+    pprint.pprint(rdz.get_promise_stats())
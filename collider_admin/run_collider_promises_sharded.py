@@ -0,0 +1,19 @@
+import sys
+import time
+from rediz.collider_config_private import REDIZ_COLLIDER_CONFIG
+from rediz.client import Rediz
+import pprint
+
+# Must use the same promise_shards as every Rediz instance that sets values, otherwise delivery fails fast.
+
+if __name__ == '__main__':
+    promise_shards = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    rdz = Rediz(promise_shards=promise_shards, **REDIZ_COLLIDER_CONFIG)
+    HOURS=1
+    for k in range(HOURS*60*60*2):
+        time.sleep(0.5)
+        promises_before = time.time()
+        report = rdz.admin_sharded_promises(with_report=True)
+        promises_after = time.time()
+        print("Sharded promise delivery took " + str(promises_after - promises_before) + " seconds.")
+        pprint.pprint(report['backlog'])
@@ -0,0 +1,10 @@
+from rediz.collider_config_private import REDIZ_COLLIDER_CONFIG
+from rediz.scheduler import PromiseScheduler
+import pprint
+
+if __name__ == '__main__':
+    rdz = PromiseScheduler(**REDIZ_COLLIDER_CONFIG)
+    HOURS=1
+    for k in range(HOURS*60):
+        rdz.run(duration=60)
+        pprint.pprint(rdz.get_lateness_stats())
@@ -0,0 +1,20 @@
+import time, sys
+from rediz.collider_config_private import REDIZ_COLLIDER_CONFIG
+from rediz.client import Rediz
+import pprint
+
+# Settlement worker for use with async_settlement=True. Run several with distinct worker ids to scale clearing:
+#    python run_collider_settlement.py 3
+
+if __name__ == '__main__':
+    worker_id = sys.argv[1] if len(sys.argv) > 1 else '0'
+    rdz = Rediz(async_settlement=True, **REDIZ_COLLIDER_CONFIG)
+    HOURS=1
+    for k in range(HOURS*60*60*2):
+        before = time.time()
+        report = rdz.admin_settlement(worker_id=worker_id, with_report=True)
+        after = time.time()
+        print("Settlement took " + str(after - before) + " seconds.")
+        pprint.pprint(report)
+        if not report['settled']:
+            time.sleep(0.5)
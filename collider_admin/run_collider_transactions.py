@@ -0,0 +1,19 @@
+import time
+from rediz.collider_config_private import REDIZ_COLLIDER_CONFIG
+from rediz.client import Rediz
+import pprint
+
+# Fans out the settlement journal into transaction streams, for use with settlement_journal=True.
+# Run exactly one of these. Entries left pending by a previous run are claimed after a minute.
+
+if __name__ == '__main__':
+    rdz = Rediz(settlement_journal=True, **REDIZ_COLLIDER_CONFIG)
+    HOURS=1
+    for k in range(HOURS*60*60):
+        before = time.time()
+        report = rdz.admin_transactions(with_report=True)
+        after = time.time()
+        print("Fan out took " + str(after - before) + " seconds.")
+        pprint.pprint(report)
+        if not report['fanned']:
+            time.sleep(1)
@@ -1,2 +1,4 @@
 from rediz.client import Rediz
-from rediz.admin_client import AdminRediz
\ No newline at end of file
+from rediz.admin_client import AdminRediz
+from rediz.batching import BatchingRediz
+from rediz.scheduler import PromiseScheduler
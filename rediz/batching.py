@@ -0,0 +1,127 @@
+import threading, queue, time
+from collections import OrderedDict, Counter
+from concurrent.futures import Future
+from rediz.client import Rediz
+from rediz.conventions import RedizConventions
+
+# BATCHING REDIZ
+# --------------
+# Coalesces set() calls arriving from many threads within a short window into one mset() per write_key, so
+# that the ownership check, settlement pipeline and confirmation log are paid once per batch rather than per call.
+
+
+class BatchingRediz(Rediz):
+
+    def __init__(self, batch_window=0.005, batch_max_items=100, **kwargs):
+        """
+            batch_window     Seconds to wait for further set() calls after the first arrives
+            batch_max_items  Dispatch early once this many set() calls are waiting
+        """
+        super().__init__(**kwargs)
+        self._BATCH_WINDOW = batch_window
+        self._BATCH_MAX_ITEMS = batch_max_items
+        self._batch_queue = queue.Queue()
+        self._batch_closed = False
+        self._batch_thread = threading.Thread(target=self._batch_dispatcher, daemon=True)
+        self._batch_thread.start()
+
+    # --------------------------------------------------------------------------
+    #            Public interface
+    # --------------------------------------------------------------------------
+
+    def set(self, name, value, write_key, budget=10, with_percentiles=False):
+        """ Same as Rediz.set() but the write is coalesced with others arriving at about the same time """
+        future = self.submit(name=name, value=value, write_key=write_key, budget=budget,
+                             with_percentiles=with_percentiles)
+        return future.result()
+
+    def submit(self, name, value, write_key, budget=10, with_percentiles=False):
+        """ Queue a set() and return a Future resolving to its title (or False if the write_key is not rare enough) """
+        assert RedizConventions.is_plain_name(name), "Expecting plain name"
+        assert RedizConventions.is_valid_key(write_key), "Invalid write_key"
+        future = Future()
+        if self.muid_difficulty(write_key) < self.min_len:
+            reason = "Write key isn't sufficiently rare to create or update a stream. Must be difficulty " + str(
+                self.min_len)
+            self._error(write_key=write_key, operation='set', success=False, reason=reason)
+            future.set_result(False)
+        elif self._batch_closed:
+            raise Exception("BatchingRediz has been closed")
+        else:
+            self._batch_queue.put({"name": name, "value": value, "write_key": write_key, "budget": budget,
+                                   "with_percentiles": with_percentiles, "future": future})
+        return future
+
+    def close(self):
+        """ Dispatch anything still waiting and stop the dispatcher thread """
+        if not self._batch_closed:
+            self._batch_closed = True
+            self._batch_queue.put(None)
+            self._batch_thread.join()
+
+    # --------------------------------------------------------------------------
+    #            Implementation
+    # --------------------------------------------------------------------------
+
+    def _batch_dispatcher(self):
+        closing = False
+        while not closing:
+            item = self._batch_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + self._BATCH_WINDOW
+            while len(batch) < self._BATCH_MAX_ITEMS:
+                try:
+                    item = self._batch_queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            self._dispatch_batch(batch)
+
+        # Anything that slipped in before the sentinel
+        remaining = list()
+        while not self._batch_queue.empty():
+            item = self._batch_queue.get()
+            if item is not None:
+                remaining.append(item)
+        if remaining:
+            self._dispatch_batch(remaining)
+
+    def _dispatch_batch(self, batch):
+        """ One mset() per (write_key, with_percentiles) group, and per round of distinct names """
+        groups = OrderedDict()
+        for item in batch:
+            groups.setdefault((item["write_key"], item["with_percentiles"]), list()).append(item)
+        for (write_key, with_percentiles), items in groups.items():
+            for round_items in self._batch_rounds(items):
+                self._dispatch_round(items=round_items, write_key=write_key, with_percentiles=with_percentiles)
+
+    @staticmethod
+    def _batch_rounds(items):
+        """ Settlement requires distinct names, so repeated names are deferred to later rounds (preserving order) """
+        rounds = list()
+        occurrences = Counter()
+        for item in items:
+            round_ndx = occurrences[item["name"]]
+            occurrences[item["name"]] += 1
+            if round_ndx == len(rounds):
+                rounds.append(list())
+            rounds[round_ndx].append(item)
+        return rounds
+
+    def _dispatch_round(self, items, write_key, with_percentiles):
+        try:
+            titles = self.mset(names=[item["name"] for item in items], values=[item["value"] for item in items],
+                               budgets=[item["budget"] for item in items], write_key=write_key,
+                               with_percentiles=with_percentiles)
+            if isinstance(titles, dict):
+                titles = [titles]
+            for item, title in zip(items, titles):
+                item["future"].set_result(title)
+        except Exception as e:
+            for item in items:
+                item["future"].set_exception(e)
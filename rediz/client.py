@@ -1,4 +1,5 @@
-import fakeredis, sys, math, json, redis, time, random, itertools, datetime
+import fakeredis, sys, math, json, redis, time, random, itertools, datetime, uuid
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from collections import Counter, OrderedDict
 from typing import List, Union, Any, Optional
@@ -6,6 +7,8 @@ from redis.client import list_or_args
 from redis.exceptions import DataError
 from .conventions import RedizConventions, REDIZ_CONVENTIONS_ARGS, MICRO_CONVENTIONS_ARGS, KeyList, NameList, ValueList
 from rediz.utilities import get_json_safe, has_nan, shorten, stem
+from rediz.scripts import MODIFY_PAGE_SCRIPT, SETTLE_HORIZON_SCRIPT, ZINCRBY_MANY_SCRIPT, DELIVER_PREDICTIONS_SCRIPT
+from rediz.pipelines import IntentPipeline
 from pprint import pprint
 
 # REDIZ
@@ -38,6 +41,10 @@ class Rediz(RedizConventions):
         for k in conventions_kwargs.keys():
             kwargs.pop(k)
         self.client = self.make_redis_client(**kwargs)
+        self._modify_page_script = self.client.register_script(MODIFY_PAGE_SCRIPT)
+        self._settle_horizon_script = self.client.register_script(SETTLE_HORIZON_SCRIPT)
+        self._zincrby_many_script = self.client.register_script(ZINCRBY_MANY_SCRIPT)
+        self._deliver_predictions_script = self.client.register_script(DELIVER_PREDICTIONS_SCRIPT)
 
     # --------------------------------------------------------------------------
     #            Public interface - getters
@@ -101,8 +108,7 @@ class Rediz(RedizConventions):
 
     def get_prediction_cdf(self, name, delay=None, values=None):
         tickets = self._get_predictions_implementation(name=name, delay=delay)
-        tups = [(ticket.split('::')[1], val) for ticket, val in tickets.items()]
-        samples = sorted([v for owner, v in tups])
+        samples = sorted(tickets.values())
         return self._samples_to_cdf(samples=samples,values=values)
 
     def get_lagged_cdf(self, name, values=None):
@@ -470,17 +476,38 @@ class Rediz(RedizConventions):
         assert len(values) == self.num_predictions
         assert int(delay) in self.DELAYS, "Invalid choice of delay"
         assert self.is_valid_key(write_key), "Invalid write_key"
-        if self.bankrupt(write_key=write_key):
-            leaderboard = self._get_leaderboard_implementation(name=name, delay=delay, readable=False, count=10000)
-            code = self.shash(key=write_key)
-            if (code not in leaderboard) or (leaderboard[code] < -1.0):
-                self._error(write_key=write_key,
-                            data={'operation': 'submit', 'success': False, 'reason': 'bankruptcy', 'name': name})
-                return False
+        if self._bankruptcy_declined(write_key=write_key, horizons=[(name, int(delay))]):
+            self._error(write_key=write_key,
+                        data={'operation': 'submit', 'success': False, 'reason': 'bankruptcy', 'name': name})
+            return False
 
         fvalues = list(map(float, values))
         return self._set_scenarios_implementation(name=name, values=fvalues, delay=delay, write_key=write_key)
 
+    def mset_scenarios(self, write_key, submissions, verbose=False):
+        """ Supply scenarios for many horizons in one pipeline
+               submissions :  { (name, delay): [ float ] }    values of len self.num_predictions
+               Returns:       { (name, delay): success }
+        """
+        assert self.is_valid_key(write_key), "Invalid write_key"
+        assert all(len(values) == self.num_predictions for values in submissions.values())
+        assert all(int(delay) in self.DELAYS for _, delay in submissions), "Invalid choice of delay"
+        fsubmissions = OrderedDict(((name, int(delay)), list(map(float, values)))
+                                   for (name, delay), values in submissions.items())
+        declined = self._bankruptcy_declined(write_key=write_key, horizons=list(fsubmissions))
+        if declined:
+            self._error(write_key=write_key,
+                        data={'operation': 'submit', 'success': False, 'reason': 'bankruptcy',
+                              'names': [name for name, _ in declined][:5], 'count': len(declined)})
+        accepted = OrderedDict((horizon, values) for horizon, values in fsubmissions.items() if horizon not in declined)
+        confirmation = self._mset_scenarios_implementation(write_key=write_key, submissions=accepted, verbose=True)
+        successes = OrderedDict((horizon, False if horizon in declined else confirmation['successes'][horizon])
+                                for horizon in fsubmissions)
+        if verbose:
+            confirmation.update({'successes': successes, 'declined': list(declined)})
+            return confirmation
+        return successes
+
     def delete_all_scenarios(self, write_key):
         active = self.get_active(write_key=write_key)
         limit = 5
@@ -623,7 +650,8 @@ class Rediz(RedizConventions):
                              write_keys: Optional[KeyList] = None, budgets: Optional[List[int]] = None,
                              name: Optional[str] = None, value: Optional[Any] = None, write_key: Optional[str] = None,
                              budget: Optional[int] = None,
-                             return_args: Optional[List[str]] = None, with_percentiles=False, with_copulas=False):
+                             return_args: Optional[List[str]] = None, with_percentiles=False, with_copulas=False,
+                             idempotency_key=None):
 
         if return_args is None:
             return_args = ['name', 'write_key', 'value', 'percentile']
@@ -637,24 +665,19 @@ class Rediz(RedizConventions):
         values = [v if isinstance(v, (int, float, str)) else json.dumps(v) for v in values]
 
         # Execute assignment (creates temporary execution logs)
-        execution_log = self._pipelined_set(names=names, values=values, write_keys=write_keys, budgets=budgets)
-
-        # Ensure there is at least one baseline prediction and occasionally update it
-        pools = self._pools(names, self.DELAYS)
-        for nm, v, wk in zip(names, values, write_keys):
-            if self.is_scalar_value(v):
-                for delay_ndx, delay in enumerate(self.DELAYS):
-                    if np.random.rand() < 1 / 20 or pools[nm][delay_ndx] == 0:
-                        self._baseline_prediction(name=nm, value=v, write_key=wk, delay=delay)
-
-        # Rewards, percentiles ... but only for scalar floats
-        # Settlement also triggers the derived market for zscores
-        if all(self.is_scalar_value(v) for v in values):
-            fvalues = list(map(float, values))
-            prctls = self._msettle(names=names, values=fvalues, budgets=budgets, with_percentiles=with_percentiles,
-                                   write_keys=write_keys, with_copulas=with_copulas)
-        else:
+        # Market clearing is either done now or later by a settlement worker (in which case percentiles are not
+        # returned), and the job is then queued in the same pipeline as the assignment
+        settlement = {"names": names, "values": values, "budgets": budgets, "write_keys": write_keys,
+                      "with_percentiles": with_percentiles, "with_copulas": with_copulas}
+        execution_log = self._pipelined_set(names=names, values=values, write_keys=write_keys, budgets=budgets,
+                                            settlement=settlement if self._ASYNC_SETTLEMENT else None,
+                                            idempotency_key=idempotency_key)
+
+        if self._ASYNC_SETTLEMENT:
             prctls = None
+        else:
+            prctls = self._settle_implementation(names=names, values=values, budgets=budgets, write_keys=write_keys,
+                                                 with_percentiles=with_percentiles, with_copulas=with_copulas)
 
         # Coerce execution log and maybe add percentiles
         exec_args = [arg for arg in return_args if arg in ['name', 'write_key', 'value']]
@@ -669,21 +692,97 @@ class Rediz(RedizConventions):
 
         return titles[0] if singular else titles
 
-    def _pipelined_set(self, names, values, write_keys, budgets):
-        """ Parallel assignment and some knock-on effects of clearing (rewards, derived market) """
+    def _settle_implementation(self, names, values, budgets, write_keys, with_percentiles, with_copulas,
+                               idempotency_key=None):
+        """ Baseline predictions, rewards and derived markets that follow assignment of values
+              idempotency_key :  If supplied, set in the same transaction as the baselines and payments, and the
+                                 derived markets are queued there too rather than set directly
+        """
+        # Settlement reads and prediction pools share one pipeline when all values are scalar
+        all_scalar = all(self.is_scalar_value(v) for v in values)
+        if all_scalar:
+            fvalues = list(map(float, values))
+            retrieved = self._msettle_retrieve(names=names, values=fvalues, with_predictions_pools=True)
+            pools = dict([(nm, [retrieved[(nm, delay_ndx, 'predictions_pool')][0] for delay_ndx in
+                                range(len(self.DELAYS))]) for nm in names])
+        else:
+            pools = self._pools(names, self.DELAYS)
+
+        # Ensure there is at least one baseline prediction and occasionally update it
+        baselines = list()
+        for nm, v, wk in zip(names, values, write_keys):
+            if self.is_scalar_value(v):
+                baseline_delays = [delay for delay_ndx, delay in enumerate(self.DELAYS) if
+                                   np.random.rand() < 1 / 20 or pools[nm][delay_ndx] == 0]
+                if baseline_delays:
+                    baselines.append((nm, wk, baseline_delays))
+
+        # Rewards, percentiles ... but only for scalar floats
+        # Settlement also triggers the derived market for zscores
+        if all_scalar:
+            prctls = self._msettle(names=names, values=fvalues, budgets=budgets, with_percentiles=with_percentiles,
+                                   write_keys=write_keys, with_copulas=with_copulas, retrieved=retrieved,
+                                   baselines=baselines, idempotency_key=idempotency_key)
+        else:
+            prctls = None
+            if baselines or idempotency_key is not None:
+                pipe = IntentPipeline(self.client)
+                anticipated = self._baseline_predictions_pipe(pipe=pipe, baselines=baselines)
+                if idempotency_key is not None:
+                    pipe.set(idempotency_key, 1, ex=self._SETTLED_TTL)
+                self._baseline_confirms(baselines=baselines, anticipated=anticipated, execut=pipe.execute())
+        return prctls
+
+    def _enqueue_settlement(self, names, values, budgets, write_keys, with_percentiles, with_copulas, pipe=None):
+        """ Push a settlement job for admin_settlement() workers (queued on pipe, if supplied) """
+        job = {"id": str(uuid.uuid4()), "names": names, "values": values, "budgets": budgets,
+               "write_keys": write_keys, "with_percentiles": with_percentiles, "with_copulas": with_copulas}
+        (pipe or self.client).lpush(self._SETTLEMENT, json.dumps(job))
+        return job["id"]
+
+    def _enqueue_set(self, pipe, names, values, budgets, write_keys):
+        """ Queue an assignment job for admin_settlement() workers, used for derived markets of settlement jobs """
+        job = {"id": str(uuid.uuid4()), "operation": "set", "names": names, "values": values, "budgets": budgets,
+               "write_keys": write_keys}
+        pipe.lpush(self._SETTLEMENT, json.dumps(job))
+        return job["id"]
+
+    def _pipelined_set(self, names, values, write_keys, budgets, settlement=None, idempotency_key=None):
+        """ Parallel assignment and some knock-on effects of clearing (rewards, derived market)
+              settlement      :  If supplied, arguments of a settlement job queued in the same pipeline as the writes
+              idempotency_key :  If supplied, set in the same transaction as the writes
+        """
+        # Ownership of all named streams is resolved by a single HMGET, and then obscure, new and existing
+        # streams are written (and rejections logged) in one pipeline whose results are keyed by ndx
         ndxs = list(range(len(names)))
-        executed_obscure, rejected_obscure, ndxs, names, values, write_keys = self._pipelined_set_obscure(ndxs=ndxs,
-                                                                                                          names=names,
-                                                                                                          values=values,
-                                                                                                          write_keys=write_keys,
-                                                                                                          budgets=budgets)
-        executed_new, rejected_new, ndxs, names, values, write_keys = self._pipelined_set_new(ndxs=ndxs, names=names,
-                                                                                              values=values,
-                                                                                              write_keys=write_keys,
-                                                                                              budgets=budgets)
-        executed_existing, rejected_existing = self._pipelined_set_existing(ndxs=ndxs, names=names, values=values,
-                                                                            write_keys=write_keys, budgets=budgets)
+        named_ndxs = [ndx for ndx in ndxs if names[ndx] is not None]
+        official_write_keys = self._mauthority([names[ndx] for ndx in named_ndxs]) if named_ndxs else list()
+        ownership = dict(zip(named_ndxs, official_write_keys))
+
+        # Storage costs are computed once for the whole batch
+        costs = {"ttls": self._cost_based_ttls(values=values, budgets=budgets),
+                 "lag_lens": self._cost_based_lagged_lens(values=values)}
+
+        write_pipe = IntentPipeline(self.client, transaction=idempotency_key is not None)
+        executed_obscure, rejected_obscure, ndxs = self._pipelined_set_obscure(pipe=write_pipe, ndxs=ndxs, names=names,
+                                                                               values=values, write_keys=write_keys,
+                                                                               budgets=budgets, costs=costs)
+        executed_new, rejected_new, ndxs = self._pipelined_set_new(pipe=write_pipe, ndxs=ndxs, names=names,
+                                                                   values=values, write_keys=write_keys,
+                                                                   budgets=budgets, ownership=ownership, costs=costs)
+        executed_existing, rejected_existing = self._pipelined_set_existing(pipe=write_pipe, ndxs=ndxs, names=names,
+                                                                            values=values, write_keys=write_keys,
+                                                                            budgets=budgets, ownership=ownership,
+                                                                            costs=costs)
         executed = executed_obscure + executed_new + executed_existing
+        if settlement is not None:
+            self._enqueue_settlement(pipe=write_pipe, **settlement)
+        if idempotency_key is not None:
+            write_pipe.set(idempotency_key, 1, ex=self._SETTLED_TTL)
+        write_results = write_pipe.execute()
+        for intent in executed:
+            intent.update({"result": tuple(write_results[intent["ndx"]])})
+        self._record_distribution_refreshes([ex["name"] for ex in executed if ex.get("refreshed")])
 
         # Propagate to subscribers
         modified_names = [ex["name"] for ex in executed]
@@ -699,114 +798,82 @@ class Rediz(RedizConventions):
         sorted_log = sorted(execution_log["executed"] + execution_log["rejected"], key=lambda d: d['ndx'])
         return [dict((arg, s[arg]) for arg in exec_args) for s in sorted_log]
 
-    def _pipelined_set_obscure(self, ndxs, names, values, write_keys, budgets):
+    def _pipelined_set_obscure(self, pipe, ndxs, names, values, write_keys, budgets, costs):
         # Set values only if names were None. Random names will be assigned.
         executed = list()
         rejected = list()
         ignored_ndxs = list()
-        if ndxs:
-            obscure_pipe = self.client.pipeline(transaction=True)
-
-            for ndx, name, value, write_key, budget in zip(ndxs, names, values, write_keys, budgets):
-                if not (self.is_valid_value(value)):
-                    rejected.append({"ndx": ndx, "name": name, "write_key": None, "value": value,
-                                     "error": "invalid value of type " + str(type(value)) + " was supplied"})
-                else:
-                    if name is None:
-                        if not (self.is_valid_key(write_key)):
-                            rejected.append(
-                                {"ndx": ndx, "name": name, "write_key": None, "errror": "invalid write_key"})
-                        else:
-                            new_name = self.random_name()
-                            ttl = self._cost_based_ttl(value=value, budget=budget)
-                            obscure_pipe, intent = self._new_obscure_page(pipe=obscure_pipe, ndx=ndx, name=new_name,
-                                                                          value=value, write_key=write_key,
-                                                                          budget=budget)
-                            executed.append(intent)
-                    elif not (self.is_valid_name(name)):
-                        rejected.append({"ndx": ndx, "name": name, "write_key": None, "error": "invalid name"})
+        for ndx in ndxs:
+            name, value, write_key, budget = names[ndx], values[ndx], write_keys[ndx], budgets[ndx]
+            if not (self.is_valid_value(value)):
+                rejected.append({"ndx": ndx, "name": name, "write_key": None, "value": value,
+                                 "error": "invalid value of type " + str(type(value)) + " was supplied"})
+            else:
+                if name is None:
+                    if not (self.is_valid_key(write_key)):
+                        rejected.append(
+                            {"ndx": ndx, "name": name, "write_key": None, "errror": "invalid write_key"})
                     else:
-                        ignored_ndxs.append(ndx)
-
-            if len(executed):
-                obscure_results = RedizConventions.chunker(results=obscure_pipe.execute(), n=len(executed))
-                for intent, res in zip(executed, obscure_results):
-                    intent.update({"result": res})
+                        new_name = self.random_name()
+                        with pipe.intent(ndx) as p:
+                            _, intent = self._new_obscure_page(pipe=p, ndx=ndx, name=new_name, value=value,
+                                                               write_key=write_key, budget=budget,
+                                                               ttl=int(costs["ttls"][ndx]),
+                                                               lag_len=int(costs["lag_lens"][ndx]))
+                        executed.append(intent)
+                elif not (self.is_valid_name(name)):
+                    rejected.append({"ndx": ndx, "name": name, "write_key": None, "error": "invalid name"})
+                else:
+                    ignored_ndxs.append(ndx)
 
-        # Marshall residual. Return indexes, names, values and write_keys that are yet to be processed.
-        names = [n for n, ndx in zip(names, ndxs) if ndx in ignored_ndxs]
-        values = [v for v, ndx in zip(values, ndxs) if ndx in ignored_ndxs]
-        write_keys = [w for w, ndx in zip(write_keys, ndxs) if ndx in ignored_ndxs]
-        return executed, rejected, ignored_ndxs, names, values, write_keys
+        # Return indexes that are yet to be processed
+        return executed, rejected, ignored_ndxs
 
-    def _pipelined_set_new(self, ndxs, names, values, write_keys, budgets):
+    def _pipelined_set_new(self, pipe, ndxs, names, values, write_keys, budgets, ownership, costs):
         # Treat cases where name does not exist yet
         executed = list()
         rejected = list()
         ignored_ndxs = list()
-
-        if ndxs:
-            exists_pipe = self.client.pipeline(transaction=False)
-            fakeredis = self.client.connection is None
-            for name in names:
-                exists_pipe.hexists(name=self._ownership_name(), key=name)
-            exists = exists_pipe.execute()
-
-            new_pipe = self.client.pipeline(transaction=False)
-            for exist, ndx, name, value, write_key, budget in zip(exists, ndxs, names, values, write_keys, budgets):
-                if not (exist):
-                    if not (self.is_valid_key(write_key)):
-                        rejected.append({"ndx": ndx, "name": name, "write_key": None, "errror": "invalid write_key"})
-                    else:
-                        ttl = self._cost_based_ttl(value=value, budget=budget)
-                        new_pipe, intent = self._new_page(new_pipe, ndx=ndx, name=name, value=value,
-                                                          write_key=write_key, budget=budget, fakeredis=fakeredis)
-                        executed.append(intent)
+        fakeredis = self.client.connection is None
+        for ndx in ndxs:
+            name, value, write_key, budget = names[ndx], values[ndx], write_keys[ndx], budgets[ndx]
+            if ownership.get(ndx) is None:
+                if not (self.is_valid_key(write_key)):
+                    rejected.append({"ndx": ndx, "name": name, "write_key": None, "errror": "invalid write_key"})
                 else:
-                    ignored_ndxs.append(ndx)
-
-            if len(executed):
-                new_results = RedizConventions.chunker(results=new_pipe.execute(), n=len(executed))
-                for intent, res in zip(executed, new_results):
-                    intent.update({"result": res})
+                    with pipe.intent(ndx) as p:
+                        _, intent = self._new_page(p, ndx=ndx, name=name, value=value, write_key=write_key,
+                                                   budget=budget, fakeredis=fakeredis, ttl=int(costs["ttls"][ndx]),
+                                                   lag_len=int(costs["lag_lens"][ndx]))
+                    executed.append(intent)
+            else:
+                ignored_ndxs.append(ndx)
 
         # Return those we are yet to get to because they are not new
-        names = [n for n, ndx in zip(names, ndxs) if ndx in ignored_ndxs]
-        values = [v for v, ndx in zip(values, ndxs) if ndx in ignored_ndxs]
-        write_keys = [w for w, ndx in zip(write_keys, ndxs) if ndx in ignored_ndxs]
-        return executed, rejected, ignored_ndxs, names, values, write_keys
+        return executed, rejected, ignored_ndxs
 
-    def _pipelined_set_existing(self, ndxs, names, values, write_keys, budgets):
+    def _pipelined_set_existing(self, pipe, ndxs, names, values, write_keys, budgets, ownership, costs):
         # Potentially modify existing name, assuming write_keys are correct
         executed = list()
         rejected = list()
-        if ndxs:
-            modify_pipe = self.client.pipeline(transaction=False)
-            error_pipe = self.client.pipeline(transaction=False)
-            official_write_keys = self._mauthority(names)
-            for ndx, name, value, write_key, official_write_key, budget in zip(ndxs, names, values, write_keys,
-                                                                               official_write_keys, budgets):
-                if write_key == official_write_key:
-                    modify_pipe, intent = self._modify_page(modify_pipe, ndx=ndx, name=name, value=value, budget=budget)
-                    intent.update({"ndx": ndx, "write_key": write_key})
-                    executed.append(intent)
-                else:
-                    auth_message = {"ndx": ndx, "name": name, "value": value, "write_key": write_key,
-                                    "official_write_key_ends_in": official_write_key[-4:],
-                                    "error": "write_key does not match page_key on record"}
-                    intent = auth_message
-                    error_pipe.lpush(self.errors_name(write_key=write_key), json.dumps(auth_message))
-                    error_pipe.expire(self.errors_name(write_key=write_key), self.ERROR_TTL)
-                    error_pipe.ltrim(name=self.errors_name(write_key=write_key), start=0, end=self.ERROR_LIMIT)
-                    rejected.append(intent)
-            if len(executed):
-                modify_results = RedizConventions.chunker(results=modify_pipe.execute(), n=len(executed))
-                for intent, res in zip(executed, modify_results):
-                    intent.update({"result": res})
-
-            if len(rejected):
-                error_pipe.execute()
-
+        for ndx in ndxs:
+            name, value, write_key, budget = names[ndx], values[ndx], write_keys[ndx], budgets[ndx]
+            official_write_key = ownership[ndx]
+            if write_key == official_write_key:
+                with pipe.intent(ndx) as p:
+                    _, intent = self._modify_page(p, ndx=ndx, name=name, value=value, budget=budget,
+                                                  ttl=int(costs["ttls"][ndx]), lag_len=int(costs["lag_lens"][ndx]))
+                intent.update({"ndx": ndx, "write_key": write_key})
+                executed.append(intent)
+            else:
+                auth_message = {"ndx": ndx, "name": name, "value": value, "write_key": write_key,
+                                "official_write_key_ends_in": official_write_key[-4:],
+                                "error": "write_key does not match page_key on record"}
+                intent = auth_message
+                pipe.lpush(self.errors_name(write_key=write_key), json.dumps(auth_message))
+                pipe.expire(self.errors_name(write_key=write_key), self.ERROR_TTL)
+                pipe.ltrim(name=self.errors_name(write_key=write_key), start=0, end=self.ERROR_LIMIT)
+                rejected.append(intent)
         return executed, rejected
 
     def _propagate_to_subscribers(self, names, values):
@@ -815,30 +882,31 @@ class Rediz(RedizConventions):
         for name in names:
             subscriber_pipe.smembers(name=self.subscribers_name(name=name))
         subscribers_sets = subscriber_pipe.execute()
-        propagate_pipe = self.client.pipeline(transaction=False)
+        propagate_pipe = IntentPipeline(self.client, transaction=False)
 
         executed = list()
         for sender_name, value, subscribers_set in zip(names, values, subscribers_sets):
             for subscriber in subscribers_set:
                 mailbox_name = self.messages_name(subscriber)
-                propagate_pipe.hset(name=mailbox_name, key=sender_name, value=value)
+                with propagate_pipe.intent(len(executed)) as p:
+                    p.hset(name=mailbox_name, key=sender_name, value=value)
                 executed.append({"mailbox_name": mailbox_name, "sender": sender_name, "value": value})
 
         if len(executed):
-            propagation_results = RedizConventions.chunker(results=propagate_pipe.execute(), n=len(executed))
-            for intent, res in zip(executed, propagation_results):
-                intent.update({"result": res})
+            propagation_results = propagate_pipe.execute()
+            for intent_ndx, intent in enumerate(executed):
+                intent.update({"result": tuple(propagation_results[intent_ndx])})
 
         return executed
 
-    def _new_obscure_page(self, pipe, ndx, name, value, write_key, budget, fakeredis=False):
+    def _new_obscure_page(self, pipe, ndx, name, value, write_key, budget, fakeredis=False, ttl=None, lag_len=None):
         """ Almost the same as a new page """
         pipe, intent = self._new_page(pipe=pipe, ndx=ndx, name=name, value=value, write_key=write_key, budget=budget,
-                                      fakeredis=fakeredis)
+                                      fakeredis=fakeredis, ttl=ttl, lag_len=lag_len)
         intent.update({"obscure": True})
         return pipe, intent
 
-    def _new_page(self, pipe, ndx, name, value, write_key, budget, fakeredis=False):
+    def _new_page(self, pipe, ndx, name, value, write_key, budget, fakeredis=False, ttl=None, lag_len=None):
         """ Create new page:
               pipe         :  Redis pipeline that will be modified
             Returns also:
@@ -860,41 +928,53 @@ class Rediz(RedizConventions):
                 pipe.xadd(name=ln, fields=transaction_record, maxlen=self.TRANSACTIONS_LIMIT)
                 pipe.expire(name=ln, time=self._TRANSACTIONS_TTL)
         # Then modify
-        pipe, intent = self._modify_page(pipe=pipe, ndx=ndx, name=name, value=value, budget=budget)
+        pipe, intent = self._modify_page(pipe=pipe, ndx=ndx, name=name, value=value, budget=budget, ttl=ttl,
+                                         lag_len=lag_len)
         intent.update({"new": True, "write_key": write_key, "value": value})
         return pipe, intent
 
-    def _modify_page(self, pipe, ndx, name, value, budget):
-        """ Create pipelined operations for save, buffer, history etc """
-        # Remark: It is important the exactly the same number of redis operations are used
-        # here regardless of how things branch, because this simplifies considerably the
-        # unpacking of pipelined results in calling algorithms.
+    def _page_storage(self, value):
+        """ Decide how to store: 'lags', 'history' or neither (None) """
+        if self.is_scalar_value(value):
+            return 'lags'
+        elif self.is_small_value(value) and self.is_vector_value(value):
+            return 'lags'
+        elif self.streams_support:
+            return 'history'
+        else:
+            return None
+
+    def _modify_page(self, pipe, ndx, name, value, budget, ttl=None, lag_len=None):
+        """ Create pipelined operations for save, buffer, history etc
+              ttl, lag_len :  Precomputed storage costs (computed here if not supplied)
+        """
+        # Remark: The number of operations varies by branch, so callers should attribute results
+        # using IntentPipeline.intent() rather than chunking the pipeline results.
+        if self._SCRIPTED_WRITES:
+            return self._scripted_modify_page(pipe=pipe, ndx=ndx, name=name, value=value, budget=budget, ttl=ttl,
+                                              lag_len=lag_len)
 
         # (1) Set the actual value ... which will be overwritten by the next set() ... and a randomly named copy that survives longer
-        ttl = self._cost_based_ttl(value=value, budget=budget)
+        if ttl is None:
+            ttl = self._cost_based_ttl(value=value, budget=budget)
         pipe.set(name=name, value=value, ex=ttl)
         name_of_copy = self._random_promised_name(name)
         promise_ttl = self._promise_ttl()
         pipe.set(name=name_of_copy, value=value, ex=promise_ttl)
 
-        # (1.5) Update the time to live for predictions and samples
+        # (1.5) Update the time to live for predictions and samples (only occasionally, if distribution_ttl_refresh is set)
         distribution_ttl = self._cost_based_distribution_ttl(budget=budget)
-        for delay in self.DELAYS:
-            pipe.expire(name=self._samples_name(name=name, delay=delay), time=distribution_ttl)
-            pipe.expire(name=self._sample_owners_name(name=name, delay=delay), time=distribution_ttl)
-            pipe.expire(name=self._predictions_name(name=name, delay=delay), time=distribution_ttl)
-
-        # (2) Decide how to store: lags, history or neither, but always use exactly six operations
-        len_in = len(pipe)
-        good_for_lags = self.is_scalar_value(value)
-        if not good_for_lags:
-            if self.is_small_value(value):
-                if self.is_vector_value(value):
-                    good_for_lags = True
-        if good_for_lags:
+        distribution_names = self._distribution_ttl_names(name)
+        for distribution_name in distribution_names:
+            pipe.expire(name=distribution_name, time=distribution_ttl)
+
+        # (2) Decide how to store: lags, history or neither
+        storage = self._page_storage(value)
+        if storage == 'lags':
             # Dynamically choose length of lags according to size of value
             t = time.time()
-            lag_len = self._cost_based_lagged_len(value)
+            if lag_len is None:
+                lag_len = self._cost_based_lagged_len(value)
             lv = self.lagged_values_name(name)
             lt = self.lagged_times_name(name)
             pipe.lpush(lv, value)
@@ -904,40 +984,72 @@ class Rediz(RedizConventions):
             pipe.expire(lv, ttl)
             pipe.expire(lt, ttl)
 
-        # Other types value field(s) may be stored in stream instead ... (note again: exactly six operations so chunking of pipeline is trivial)
-        if not good_for_lags:
-            if self._streams_support():
-                if self.is_small_value(value):
-                    fields = RedizConventions.to_record(value)
-                else:
-                    fields = {self._POINTER: name_of_copy}
-                history = self.history_name(name)
-                history_len = self._cost_based_history_len(value=fields)
-                pipe.xadd(history, fields=fields)
-                pipe.xtrim(history, maxlen=history_len)
-                pipe.expire(history, ttl)
-                pipe.expire(name=name_of_copy, time=ttl)
-                pipe.expire(name=name_of_copy, time=ttl)  # 5th operation
-                pipe.expire(name=name_of_copy, time=ttl)  # 6th operation
-            else:
-                for _ in range(6):  # Again ... same hack ... insist on (6) operations here
-                    pipe.expire(name=name_of_copy, time=promise_ttl)
-        len_out = len(pipe)
-        assert len_out - len_in == 6, "Need precisely six operations so parent function can chunk pipeline results"
+        # Other types value field(s) may be stored in stream instead, and the copy it may point to lives as long
+        elif storage == 'history':
+            fields = self._history_fields(value=value, name_of_copy=name_of_copy)
+            history = self.history_name(name)
+            history_len = self._cost_based_history_len(value=fields)
+            pipe.xadd(history, fields=fields)
+            pipe.xtrim(history, maxlen=history_len)
+            pipe.expire(history, ttl)
+            pipe.expire(name=name_of_copy, time=ttl)
 
         # (4) Construct delay promises
         utc_epoch_now = int(time.time())
         for delay in self.DELAYS:
-            queue = self._promise_queue_name(utc_epoch_now + delay)  # self.PROMISES+str(utc_epoch_now+delay)
             destination = self.delayed_name(name=name, delay=delay)  # self.DELAYED+str(delay_seconds)+self.SEP+name
             promise = self._copy_promise(source=name_of_copy, destination=destination)
-            pipe.sadd(queue, promise)
-            pipe.expire(name=queue, time=promise_ttl)
+            self._promise_pipe(pipe=pipe, promise=promise, due=utc_epoch_now + delay, ttl=promise_ttl, name=name)
+        self._notify_pipe(pipe=pipe, dues=[utc_epoch_now + delay for delay in self.DELAYS])
 
         # (5) Execution log
         intent = {"ndx": ndx, "name": name, "value": value, "ttl": ttl, "new": False, "obscure": False,
-                  "copy": name_of_copy}
+                  "copy": name_of_copy, "refreshed": len(distribution_names) > 0}
+
+        return pipe, intent
+
+    def _history_fields(self, value, name_of_copy):
+        """ Small values are stored in the history stream, larger ones by reference to the copy """
+        if self.is_small_value(value):
+            return RedizConventions.to_record(value)
+        else:
+            return {self._POINTER: name_of_copy}
+
+    def _scripted_modify_page(self, pipe, ndx, name, value, budget, ttl=None, lag_len=None):
+        """ Same as _modify_page but queues a single EVALSHA that performs all the mutations server side """
+        if ttl is None:
+            ttl = self._cost_based_ttl(value=value, budget=budget)
+        name_of_copy = self._random_promised_name(name)
+        promise_ttl = self._promise_ttl()
+        distribution_ttl = self._cost_based_distribution_ttl(budget=budget)
+        distribution_names = self._distribution_ttl_names(name)
+
+        storage = self._page_storage(value)
+        history_len, fields = 0, dict()
+        if storage == 'lags':
+            if lag_len is None:
+                lag_len = self._cost_based_lagged_len(value)
+        elif storage == 'history':
+            fields = self._history_fields(value=value, name_of_copy=name_of_copy)
+            history_len = self._cost_based_history_len(value=fields)
+
+        utc_epoch_now = int(time.time())
+        dues = [utc_epoch_now + delay for delay in self.DELAYS]
+        queues = [self._promise_queue(due=due, name=name) for due in dues]
+        promises = [self._copy_promise(source=name_of_copy, destination=self.delayed_name(name=name, delay=delay))
+                    for delay in self.DELAYS]
+
+        keys = [name, name_of_copy, self.lagged_values_name(name), self.lagged_times_name(name),
+                self.history_name(name)] + distribution_names + queues
+        args = [value, ttl, promise_ttl, distribution_ttl, len(distribution_names), len(queues), storage or '',
+                time.time(), lag_len or 0, history_len, 1 if self._SORTED_PROMISES else 0,
+                self._promise_queue_ttl(promise_ttl)] + promises + dues + \
+               list(itertools.chain(*fields.items()))
+        self._modify_page_script(keys=keys, args=args, client=pipe)
+        self._notify_pipe(pipe=pipe, dues=dues)
 
+        intent = {"ndx": ndx, "name": name, "value": value, "ttl": ttl, "new": False, "obscure": False,
+                  "copy": name_of_copy, "refreshed": len(distribution_names) > 0}
         return pipe, intent
 
     # --------------------------------------------------------------------------
@@ -972,24 +1084,22 @@ class Rediz(RedizConventions):
         names = [n for n in names if n is not None]
 
         # (a) Gather and assemble stream "edges"  (links, backlinks, subscribers, subscriptions)
-        info_pipe = self.client.pipeline()
-        for name in names:
-            info_pipe.smembers(self.subscribers_name(name))
-        for name in names:
-            info_pipe.smembers(self.subscriptions_name(name))
-        for name in names:
-            info_pipe.hgetall(self.backlinks_name(name))
-        links_ndx = dict([(k, dict()) for k in range(len(names))])
+        info_pipe = IntentPipeline(self.client)
         for name_ndx, name in enumerate(names):
+            with info_pipe.intent(('subscribers', name_ndx)) as p:
+                p.smembers(self.subscribers_name(name))
+            with info_pipe.intent(('subscriptions', name_ndx)) as p:
+                p.smembers(self.subscriptions_name(name))
+            with info_pipe.intent(('backlinks', name_ndx)) as p:
+                p.hgetall(self.backlinks_name(name))
             for delay_ndx, delay in enumerate(self.DELAYS):
-                links_ndx[name_ndx][delay_ndx] = len(info_pipe)
-                info_pipe.hgetall(self.links_name(name=name, delay=delay))
+                with info_pipe.intent(('links', name_ndx, delay_ndx)) as p:
+                    p.hgetall(self.links_name(name=name, delay=delay))
 
         info_exec = info_pipe.execute()
-        assert len(info_exec) == 3 * len(names) + len(names) * len(self.DELAYS)
-        subscribers_res = info_exec[:len(names)]
-        subscriptions_res = info_exec[len(names):2 * len(names)]
-        backlinks_res = info_exec[2 * len(names):]
+        subscribers_res = [info_exec[('subscribers', name_ndx)][0] for name_ndx in range(len(names))]
+        subscriptions_res = [info_exec[('subscriptions', name_ndx)][0] for name_ndx in range(len(names))]
+        backlinks_res = [info_exec[('backlinks', name_ndx)][0] for name_ndx in range(len(names))]
 
         # (b)   Second call will do all remaining cleanup
         delete_pipe = self.client.pipeline(transaction=False)
@@ -1012,8 +1122,7 @@ class Rediz(RedizConventions):
         # (b-4) Unlink gracefully
         for name_ndx, name in enumerate(names):
             for delay_ndx, delay in enumerate(self.DELAYS):
-                link_ndx = links_ndx[name_ndx][delay_ndx]
-                targets = list(info_exec[link_ndx].keys())
+                targets = list(info_exec[('links', name_ndx, delay_ndx)][0].keys())
                 if targets:
                     for target in targets:
                         delete_pipe = self._unlink_pipe(pipe=delete_pipe, name=name, delay=delay, target=target)
@@ -1033,6 +1142,8 @@ class Rediz(RedizConventions):
         delete_pipe.hdel(self._ownership_name(), *names)
 
         del_exec = delete_pipe.execute()
+        for name in names:
+            self._distribution_refreshes.pop(name, None)
 
         return sum((1 for r in del_exec if r))
 
@@ -1063,6 +1174,11 @@ class Rediz(RedizConventions):
         self._log_to_list(log_name=self.errors_name(write_key=write_key), ttl=self.ERROR_TTL,
                           limit=self.ERROR_LIMIT, data=data, **kwargs)
 
+    def _settlement_error(self, horizon, data=None, **kwargs):
+        """ Log a horizon that was not (fully) settled to the admin settlement error log """
+        self._log_to_list(log_name=self._SETTLEMENT_ERRORS, ttl=self._SETTLED_TTL, limit=self.ERROR_LIMIT, data=data,
+                          horizon=horizon, **kwargs)
+
     def _warn(self, write_key, data=None, **kwargs):
         self._log_to_list(log_name=self.warnings_name(write_key=write_key), ttl=self.WARNINGS_TTL,
                           limit=self.WARNINGS_LIMIT, data=data, **kwargs)
@@ -1249,14 +1365,25 @@ class Rediz(RedizConventions):
         """
         name = self.client.srandmember(self._NAMES)
         discards = list()
+        if name is None:
+            return 0 if not with_report else {"discards": discards}
+        owners_pipe = self.client.pipeline()
         for delay in self.DELAYS:
-            write_keys = self._get_sample_owners(name, delay)
-            leaderboard = self._get_leaderboard_implementation(name=name, delay=delay, readable=False, count=10000)
-            losers = [key for key in write_keys if
-                      (self.shash(key) in leaderboard) and (leaderboard[self.shash(key)] < -1.0)]
+            owners_pipe.smembers(self._sample_owners_name(name=name, delay=delay))
+        owners = [list(write_keys) for write_keys in owners_pipe.execute()]
 
-            for write_key in losers:
-                if self.bankrupt(write_key=write_key):
+        # Scores of owners on each leaderboard, then balances of those well down them
+        score_pipe = self.client.pipeline()
+        for delay, write_keys in zip(self.DELAYS, owners):
+            for write_key in write_keys:
+                score_pipe.zscore(self.leaderboard_name(name=name, delay=delay), self.shash(write_key))
+        scores = iter(score_pipe.execute())
+        losers = [[key for key in write_keys if self._well_down(next(scores))] for write_keys in owners]
+        bankrupt = self._bankrupt_write_keys(list(itertools.chain(*losers)), cached=False)  # Not stale balances
+
+        for delay, delay_losers in zip(self.DELAYS, losers):
+            for write_key in delay_losers:
+                if write_key in bankrupt:
                     self._confirm(write_key=write_key,
                                   data={"operation": "bankruptcy", "time": str(datetime.datetime.now()),
                                         "epoch_time": time.time(), "name": name, "code": self.shash(write_key)})
@@ -1332,34 +1459,146 @@ class Rediz(RedizConventions):
 
         return sum(individual_cancellations) if not with_report else {'cancellations': individual_cancellations}
 
-    def admin_promises(self, with_report=False):
-        """ Iterate through task queues populating delays and samples """
-
-        # Find recent promise queues that exist
-        exists_pipe = self.client.pipeline()
-        utc_epoch_now = int(time.time())
-        candidates = [self._promise_queue_name(epoch_seconds=utc_epoch_now - seconds) for seconds in
-                      range(self._DELAY_GRACE, -1, -1)]
-        for candidate in candidates:
-            exists_pipe.exists(candidate)
-        exists = exists_pipe.execute()
-
-        # If they exist get the members
-        get_pipe = self.client.pipeline()
-        promise_collection_names = [promise for promise, exist in zip(candidates, exists) if exists]
-        for collection_name in promise_collection_names:
-            get_pipe.smembers(collection_name)
-        collections = get_pipe.execute()
-        self.client.delete(
-            *promise_collection_names)  # Immediately delete task list so it isn't done twice ... not that that would
-        # be the end of the world
-        individual_promises = list(itertools.chain(*collections))
+    def admin_settlement(self, worker_id='0', max_jobs=1000, with_report=False):
+        """ Drain queued settlement jobs (only populated when async_settlement=True)
+              Jobs are moved to a per-worker processing list and removed only once settled, so a worker restarted
+              with the same worker_id will retry unfinished jobs. Every write a job makes is in the same transaction
+              as its idempotency key, so a retried job is not paid (or assigned) twice. With scripted settlement the
+              payments for each horizon are instead marked by the script that makes them. Derived markets are queued
+              as jobs of their own.
+        """
+        processing_name = self._settlement_processing_name(worker_id=worker_id)
+        unfinished = self.client.lrange(processing_name, 0, -1)
+        report = {'settled': 0, 'skipped': 0, 'retried': len(unfinished)}
+        for _ in range(max_jobs):
+            job_json = unfinished.pop() if unfinished else self.client.rpoplpush(self._SETTLEMENT, processing_name)
+            if job_json is None:
+                break
+            job = json.loads(job_json)
+            idempotency_key = self._settled_name(job["id"])
+            if self.client.exists(idempotency_key):
+                report['skipped'] += 1
+            elif job.get("operation") == "set":
+                self._mset_implementation(names=job["names"], values=job["values"], budgets=job["budgets"],
+                                          write_keys=job["write_keys"], idempotency_key=idempotency_key)
+                report['settled'] += 1
+            else:
+                self._settle_implementation(names=job["names"], values=job["values"], budgets=job["budgets"],
+                                            write_keys=job["write_keys"], with_percentiles=job["with_percentiles"],
+                                            with_copulas=job["with_copulas"], idempotency_key=idempotency_key)
+                report['settled'] += 1
+            self.client.lrem(processing_name, 1, job_json)
+        report['backlog'] = self.client.llen(self._SETTLEMENT)
+        return report if with_report else report['settled']
+
+    def admin_transactions(self, max_entries=100000, with_report=False):
+        """ Fan out the settlement journal into transaction streams (only populated when settlement_journal=True)
+              Intended to be run by a single worker. Consumers that crashed are removed once their entries are claimed.
+        """
+        fanned = self._fan_out_journal(max_entries=max_entries)
+        removed = self._remove_idle_journal_consumers()
+        backlog = self._journal_backlog()
+        report = {'fanned': fanned, 'removed': removed, 'journal': self.client.xlen(self._JOURNAL),
+                  'backlog': backlog, 'warnings': ''}
+        if backlog >= self._JOURNAL_ALERT * self._JOURNAL_LIMIT:
+            # The journal is trimmed at _JOURNAL_LIMIT, so records not yet fanned out will soon be lost
+            report['warnings'] = 'Journal backlog of ' + str(backlog) + ' is close to the trim limit of ' + \
+                                 str(self._JOURNAL_LIMIT)
+            self._log_to_list(log_name=self._SETTLEMENT_ERRORS, ttl=self._SETTLED_TTL, limit=self.ERROR_LIMIT,
+                              operation='fan_out', error=report['warnings'], backlog=backlog)
+        return report if with_report else fanned
+
+    def _journal_backlog(self):
+        """ Number of journal entries not yet fanned out (never delivered, or delivered but not acknowledged) """
+        for info in self.client.xinfo_groups(name=self._JOURNAL):
+            if info['name'] == self._JOURNAL_GROUP:
+                return int(info.get('lag') or 0) + int(info['pending'])
+        return self.client.xlen(self._JOURNAL)
+
+    def _fan_out_journal(self, count=1000, max_entries=10000):
+        """ Copy journal records into the per write_key transaction streams read by get_transactions()
+              Entries left pending for _JOURNAL_CLAIM_IDLE seconds (e.g. by a consumer that crashed) are claimed
+              with XAUTOCLAIM and processed first
+              Returns:  number of journal entries processed
+        """
+        if not self._journal_group_created:
+            try:
+                self.client.xgroup_create(name=self._JOURNAL, groupname=self._JOURNAL_GROUP, id='0', mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+            self._journal_group_created = True
+
+        consumer = self._journal_consumer_name()
+        fanned = 0
+        claim_id = '0-0'
+        while fanned < max_entries:
+            if claim_id is not None:
+                claimed = self.client.xautoclaim(name=self._JOURNAL, groupname=self._JOURNAL_GROUP,
+                                                 consumername=consumer, min_idle_time=int(1000 * self._JOURNAL_CLAIM_IDLE),
+                                                 start_id=claim_id, count=count)
+                claim_id = None if claimed[0] == '0-0' else claimed[0]  # Pending entries are done, move on to new ones
+                entries = claimed[1]
+            else:
+                response = self.client.xreadgroup(groupname=self._JOURNAL_GROUP, consumername=consumer,
+                                                  streams={self._JOURNAL: '>'}, count=count)
+                entries = response[0][1] if response else list()
+                if not entries:
+                    break
+            if entries:
+                # Records keep the journal entry id, and so the time of settlement. They are acknowledged in the same
+                # transaction so no record is copied twice.
+                fan_out_pipe = self.client.pipeline(transaction=True)
+                copies = list()
+                for entry_id, transaction_record in entries:
+                    if transaction_record:  # Pending entries may have been trimmed from the journal
+                        recipient = transaction_record.pop('recipient')
+                        name, delay = transaction_record['stream'], transaction_record['delay']
+                        self._transaction_logs_pipe(pipe=fan_out_pipe, recipient=recipient, name=name, delay=delay,
+                                                    transaction_record=transaction_record, entry_id=entry_id)
+                        copies += [(log_name, transaction_record) for log_name in
+                                   self._transaction_log_names(recipient=recipient, name=name, delay=delay)]
+                fan_out_pipe.xack(self._JOURNAL, self._JOURNAL_GROUP, *[entry_id for entry_id, _ in entries])
+                execut = fan_out_pipe.execute(raise_on_error=False)
+                late = [copy for copy, ex in zip(copies, execut[0:2 * len(copies):2]) if isinstance(ex, Exception)]
+                if late:
+                    # A stream already holds a later record (e.g. this entry was claimed from a consumer that crashed)
+                    late_pipe = self.client.pipeline(transaction=False)
+                    for log_name, transaction_record in late:
+                        late_pipe.xadd(name=log_name, fields=transaction_record, maxlen=self.TRANSACTIONS_LIMIT)
+                        late_pipe.expire(name=log_name, time=self._TRANSACTIONS_TTL)
+                    late_pipe.execute()
+                fanned += len(entries)
+        return fanned
+
+    def _remove_idle_journal_consumers(self):
+        """ Delete consumers of the journal, other than this one, that have nothing pending and have been idle
+              Returns:  number removed
+        """
+        consumer = self._journal_consumer_name()
+        removed = 0
+        for info in self.client.xinfo_consumers(name=self._JOURNAL, groupname=self._JOURNAL_GROUP):
+            if info['name'] != consumer and info['pending'] == 0 and info['idle'] >= 1000 * self._JOURNAL_CLAIM_IDLE:
+                self.client.xgroup_delconsumer(name=self._JOURNAL, groupname=self._JOURNAL_GROUP,
+                                               consumername=info['name'])
+                removed += 1
+        return removed
+
+    def admin_promises(self, with_report=False, shard=None):
+        """ Iterate through task queues populating delays and samples
+               shard :  Deliver only promises for this shard (default is all of them)
+        """
+        if shard is None:
+            self._check_promise_shards()
+        shards = range(self._PROMISE_SHARDS) if shard is None else [shard]
+        claims = list(itertools.chain(*[self._claim_promises(shard=s, with_dues=True) for s in shards]))
 
         # Sort through promises in reverse time precedence
         # In particular, we allow more recent copy instructions to override less recent ones
         dest_source = dict()
         dest_method = dict()
-        for promise in individual_promises:
+        dest_due = dict()
+        for promise, due in claims:
             if self.COPY_SEP in promise:
                 source, destination = promise.split(self.COPY_SEP)
                 dest_source[destination] = source
@@ -1370,70 +1609,312 @@ class Rediz(RedizConventions):
                 dest_method[destination] = 'predict'
             else:
                 raise Exception("invalid promise")
+            dest_due[destination] = due
 
         sources = list(dest_source.values())
         destinations = list(dest_source.keys())
         methods = list(dest_method.values())
 
         # Interpret the promises as source / destination references and get the source values
-        retrieve_pipe = self.client.pipeline()
-        for source, destination, method in zip(sources, destinations, methods):
-            if method == 'copy':
-                retrieve_pipe.get(source)
-            elif method == 'predict':
-                retrieve_pipe.zrange(name=source, start=0, end=-1, withscores=True)
-            elif method == 'cancel':
-                retrieve_pipe.get(source)
-        source_values = retrieve_pipe.execute()
+        # (Predictions stay on the server when they are delivered by script)
+        retrieve_pipe = IntentPipeline(self.client)
+        for ndx, (source, destination, method) in enumerate(zip(sources, destinations, methods)):
+            with retrieve_pipe.intent(ndx) as p:
+                if method == 'copy':
+                    p.get(source)
+                elif method == 'predict' and not self._SCRIPTED_WRITES:
+                    p.zrange(name=source, start=0, end=-1, withscores=True)
+                elif method == 'cancel':
+                    p.get(source)
+        retrieved = retrieve_pipe.execute()
+        source_values = [(retrieved[ndx] or [None])[0] for ndx in range(len(sources))]
 
         # Copy delay promises and insert prediction promises
         move_pipe = self.client.pipeline(transaction=False)
         report = dict()
         report['warnings'] = ''
         execution_report = list()
-        for value, destination, method in zip(source_values, destinations, methods):
+        counters = Counter({"claimed": len(claims), "superseded": len(claims) - len(destinations)})
+        distribution_ttl = self._cost_based_distribution_ttl(budget=1)
+        created = list()  # Samples and owners that need a TTL, in case no set() refreshes them
+        for source, value, destination, method in zip(sources, source_values, destinations, methods):
             if method == 'copy':
                 if value is None:
                     report['warnings'] = report['warnings'] + ' None value found '
+                    counters["none_values"] += 1
                 else:
                     delay_ttl = int(max(self.DELAYS) + self._DELAY_GRACE + 5 * 60)
                     move_pipe.set(name=destination, value=value, ex=delay_ttl)
                     execution_report.append({"operation": "set", "destination": destination, "value": value})
                     report[destination] = str(value)
+                    counters["copies"] += 1
+            elif method == 'predict' and self._SCRIPTED_WRITES:
+                self._deliver_predictions_script(
+                    keys=[source, destination, self._OWNERS + destination, self._PARTICIPANT_KEYS],
+                    args=[self.SEP, self.TICKET_SEP, distribution_ttl], client=move_pipe)
+                execution_report.append({"operation": "deliver", "source": source, "destination": destination})
+                counters["predictions"] += 1
             elif method == 'predict':
-                if len(value):
+                if not value:
+                    counters["missing_predictions"] += 1
+                else:
+                    counters["predictions"] += 1
                     value_as_dict = dict(value)
                     move_pipe.zadd(name=destination, mapping=value_as_dict, ch=True)
                     execution_report.append(
                         {"operation": "zadd", "destination": destination, "len": len(value_as_dict)})
                     report[destination] = str(len(value_as_dict))
-                    owners = [self._scenario_owner(ticket) for ticket in value_as_dict.keys()]
-                    unique_owners = list(set(owners))
+                    owners = self._scenario_owners(list(value_as_dict.keys()))
+                    unique_owners = list(set(owner for owner in owners if owner is not None))
+                    created.append(destination)
                     try:
                         move_pipe.sadd(self._OWNERS + destination, *unique_owners)
                         execution_report.append(
                             {"operation": "sadd", "destination": self._OWNERS + destination, "value": unique_owners})
+                        created.append(self._OWNERS + destination)
                     except DataError:
                         report[destination] = "Failed to insert predictions to " + destination
             else:
                 raise Exception("bug - missing case ")
 
-        execut = move_pipe.execute()
+        # Lateness and counters are recorded in the same round trip, after the deliveries
+        num_moves = len(execution_report)
+        for distribution_name in created:
+            move_pipe.expire(name=distribution_name, time=distribution_ttl)
+        if claims:
+            self._promise_stats_pipe(pipe=move_pipe, counters=counters,
+                                     lateness=[time.time() - dest_due[destination] for destination in destinations])
+        execut = move_pipe.execute()[:num_moves]
         for record, ex in zip(execution_report, execut):
             record.update({"execution_result": ex})
 
         return sum(execut) if not with_report else execution_report
 
+    def admin_sharded_promises(self, max_workers=None, with_report=False):
+        """ Deliver promises for every shard in parallel threads
+               Returns:  number delivered, or report by shard together with the remaining backlog
+        """
+        self._check_promise_shards()
+        shards = list(range(self._PROMISE_SHARDS))
+        with ThreadPoolExecutor(max_workers=max_workers or len(shards)) as executor:
+            results = list(executor.map(lambda shard: self.admin_promises(with_report=with_report, shard=shard),
+                                        shards))
+        if with_report:
+            return {"shards": dict(zip(shards, results)), "backlog": self.get_promise_backlog()}
+        return sum(results)
+
+    def get_promise_backlog(self):
+        """ Number of promises due (within the grace period) but not yet delivered, by shard """
+        utc_epoch_now = int(time.time())
+        shards = list(range(self._PROMISE_SHARDS))
+        backlog_pipe = self.client.pipeline()
+        for shard in shards:
+            if self._SORTED_PROMISES:
+                backlog_pipe.zcount(self._promise_schedule_name(shard), min=utc_epoch_now - self._DELAY_GRACE,
+                                    max=utc_epoch_now)
+            else:
+                for seconds in range(self._DELAY_GRACE, -1, -1):
+                    backlog_pipe.scard(self._promise_queue_name(epoch_seconds=utc_epoch_now - seconds, shard=shard))
+        counts = backlog_pipe.execute()
+        if not self._SORTED_PROMISES:
+            counts = [sum(chunk) for chunk in RedizConventions.chunker(counts, n=len(shards))]
+        return dict(zip(shards, counts))
+
+    def get_promise_stats(self):
+        """ Lateness histogram of deliveries, counters of claimed and dropped promises, and backlog by due second """
+        utc_epoch_now = int(time.time())
+        seconds = list(range(utc_epoch_now - self._DELAY_GRACE, utc_epoch_now + 1))
+        shards = list(range(self._PROMISE_SHARDS))
+        stats_pipe = self.client.pipeline()
+        stats_pipe.hgetall(self._PROMISE_LATENESS)
+        stats_pipe.hgetall(self._PROMISE_STATS)
+        for shard in shards:
+            for second in seconds:
+                if self._SORTED_PROMISES:
+                    stats_pipe.zcount(self._promise_schedule_name(shard), min=second, max=second)
+                else:
+                    stats_pipe.scard(self._promise_queue_name(epoch_seconds=second, shard=shard))
+        lateness, counters, *depths = stats_pipe.execute()
+        backlog = [sum(depth) for depth in zip(*RedizConventions.chunker(depths, n=len(shards)))]
+        labels = [str(edge) for edge in self._LATENESS_BUCKETS] + ['inf']
+        return {"lateness": dict((label, int(lateness.get(label, 0))) for label in labels),
+                "counters": dict((counter, int(count)) for counter, count in counters.items()),
+                "backlog": dict(zip(seconds, backlog))}
+
+    def _promise_stats_pipe(self, pipe, counters, lateness):
+        """ Queue increments of promise counters and of the lateness histogram """
+        for counter, count in counters.items():
+            if count:
+                pipe.hincrby(self._PROMISE_STATS, counter, count)
+        for bucket, count in Counter(self._lateness_bucket(seconds) for seconds in lateness).items():
+            pipe.hincrby(self._PROMISE_LATENESS, bucket, count)
+
+    def _claim_promises(self, shard=0, with_dues=False):
+        """ Remove and return the promises that are due, oldest first
+               with_dues :  Return (promise, due) pairs instead
+        """
+        utc_epoch_now = int(time.time())
+        if self._SORTED_PROMISES:
+            # Claimed atomically, so concurrent workers never deliver the same promise. Those more than
+            # _DELAY_GRACE seconds late are discarded, just as per-second queues would have expired.
+            schedule = self._promise_schedule_name(shard)
+            claim_pipe = self.client.pipeline(transaction=True)
+            claim_pipe.zcount(schedule, min='-inf', max='(' + str(utc_epoch_now - self._DELAY_GRACE))
+            claim_pipe.zrangebyscore(schedule, min=utc_epoch_now - self._DELAY_GRACE, max=utc_epoch_now,
+                                     withscores=True)
+            claim_pipe.zremrangebyscore(schedule, min='-inf', max=utc_epoch_now)
+            num_expired, claims, _ = claim_pipe.execute()
+            if num_expired:
+                self.client.hincrby(self._PROMISE_STATS, "expired", num_expired)
+            if with_dues:
+                return [(promise, int(due)) for promise, due in claims]
+            return [promise for promise, _ in claims]
+
+        # Find recent promise queues that exist
+        exists_pipe = self.client.pipeline()
+        candidate_dues = [utc_epoch_now - seconds for seconds in range(self._DELAY_GRACE, -1, -1)]
+        candidates = [self._promise_queue_name(epoch_seconds=due, shard=shard) for due in candidate_dues]
+        for candidate in candidates:
+            exists_pipe.exists(candidate)
+        # Queues that have just fallen out of the grace period will never be delivered, but they are kept long
+        # enough (see _promise_queue_ttl) to still be counted. They are removed so they are counted once.
+        expired = [self._promise_queue_name(epoch_seconds=utc_epoch_now - seconds, shard=shard)
+                   for seconds in range(self._DELAY_GRACE + 1, 2 * self._DELAY_GRACE + 2)]
+        for queue in expired:
+            exists_pipe.scard(queue)
+        exists_pipe.delete(*expired)
+        exists_execut = exists_pipe.execute()
+        exists = exists_execut[:len(candidates)]
+        num_expired = sum(exists_execut[len(candidates):len(candidates) + len(expired)])
+        if num_expired:
+            self.client.hincrby(self._PROMISE_STATS, "expired", num_expired)
+
+        # If they exist get the members
+        get_pipe = self.client.pipeline()
+        promise_collection_names = [promise for promise, exist in zip(candidates, exists) if exist]
+        collection_dues = [due for due, exist in zip(candidate_dues, exists) if exist]
+        for collection_name in promise_collection_names:
+            get_pipe.smembers(collection_name)
+        collections = get_pipe.execute()
+        if promise_collection_names:
+            self.client.delete(
+                *promise_collection_names)  # Immediately delete task list so it isn't done twice ... not that that would
+            # be the end of the world
+        if with_dues:
+            return [(promise, due) for collection, due in zip(collections, collection_dues) for promise in collection]
+        return list(itertools.chain(*collections))
+
+    def _check_promise_shards(self):
+        """ Fail fast if promises are being queued with a different number of shards than this instance delivers """
+        stored = self.client.get(self._PROMISE_SHARD_COUNT)
+        if stored is not None and int(stored) != self._PROMISE_SHARDS:
+            raise Exception("Promises are queued for " + str(stored) + " shards but promise_shards=" +
+                            str(self._PROMISE_SHARDS) + ". Use the same promise_shards for every Rediz instance, "
+                            "or delete " + self._PROMISE_SHARD_COUNT + " once all queues are drained.")
+
+    def _register_promise_shards(self):
+        """ Record the number of shards the first time this instance queues a promise """
+        if not self._promise_shards_registered:
+            self.client.set(self._PROMISE_SHARD_COUNT, self._PROMISE_SHARDS, nx=True)
+            self._check_promise_shards()
+            self._promise_shards_registered = True
+
+    def _promise_queue(self, due, name):
+        """ Key that a promise due at epoch second due, and targeting name, is added to """
+        self._register_promise_shards()
+        shard = self._promise_shard(name)
+        if self._SORTED_PROMISES:
+            return self._promise_schedule_name(shard)
+        return self._promise_queue_name(epoch_seconds=due, shard=shard)
+
+    def _promise_pipe(self, pipe, promise, due, ttl, name):
+        """ Queue a promise targeting name for delivery at epoch second due
+               Returns:  anticipated results of the queued operations
+        """
+        queue = self._promise_queue(due=due, name=name)
+        if self._SORTED_PROMISES:
+            pipe.zadd(queue, mapping={promise: due})
+            return [1]
+        else:
+            pipe.sadd(queue, promise)
+            pipe.expire(name=queue, time=self._promise_queue_ttl(ttl))
+            return [1, True]
+
+    def _notify_pipe(self, pipe, dues):
+        """ Announce the due times of newly queued promises (only when promise_notify is set)
+               Returns:  anticipated results of the queued operations (None as stream ids are not checked)
+        """
+        if self._PROMISE_NOTIFY and self.streams_support:
+            pipe.xadd(name=self._PROMISE_NOTIFICATIONS, fields={"dues": ",".join(str(due) for due in sorted(set(dues)))},
+                      maxlen=self._NOTIFICATIONS_LIMIT, approximate=True)
+            return [None]
+        return []
+
     # --------------------------------------------------------------------------
     #            Implementation  (prediction and settlement)
     # --------------------------------------------------------------------------
 
     def _baseline_prediction(self, name, value, write_key, delay):
+        return self._baseline_predictions([(name, write_key, [delay])])[0]
+
+    def _baseline_predictions(self, baselines):
+        """ Submit bootstrapped predictions using one pipeline to fetch lags and one to submit
+               baselines:  [ (name, write_key, [ delay ]) ]
+               Returns:    [ success ]
+        """
+        submit_pipe = IntentPipeline(self.client)
+        anticipated = self._baseline_predictions_pipe(pipe=submit_pipe, baselines=baselines)
+        return self._baseline_confirms(baselines=baselines, anticipated=anticipated, execut=submit_pipe.execute())
+
+    def _baseline_predictions_pipe(self, pipe, baselines):
+        """ Fetch lags and queue submission of bootstrapped predictions
+               Returns:    { ('baseline', baseline_ndx): anticipated results }
+        """
+        if not baselines:
+            return dict()
         # As a finer point, we should really be using the delay times here and sampling by time not lag ... but it is just a lazy benchmark anyway
-        lagged_values = self._get_lagged_implementation(name, with_times=False, with_values=True, to_float=True,
-                                                        start=0, end=None, count=self.num_predictions)
-        predictions = self.empirical_predictions(lagged_values=lagged_values)
-        return self._set_scenarios_implementation(name=name, values=predictions, write_key=write_key, delay=delay)
+        lagged_pipe = self.client.pipeline()
+        for name, _, _ in baselines:
+            lagged_pipe.lrange(self.lagged_values_name(name), start=0, end=self.num_predictions)
+        raw_lagged = lagged_pipe.execute()
+
+        anticipated = dict()
+        for baseline_ndx, ((name, write_key, delays), raw_values) in enumerate(zip(baselines, raw_lagged)):
+            try:
+                lagged_values = RedizConventions.to_float(raw_values)
+            except:
+                continue
+            values = self.empirical_predictions(lagged_values=lagged_values)
+            if self._valid_scenarios(values=values, write_key=write_key, delays=delays):
+                predictions = self._jiggered_scenarios(values=values, write_key=write_key)
+                with pipe.intent(('baseline', baseline_ndx)) as p:
+                    anticipated[('baseline', baseline_ndx)] = self._set_scenarios_pipe(
+                        pipe=p, name=name, predictions=predictions, delays=delays, write_key=write_key)
+        return anticipated
+
+    def _baseline_confirms(self, baselines, anticipated, execut):
+        """ Check submissions queued by _baseline_predictions_pipe, with one confirmation per write_key
+               Returns:    [ success ]
+        """
+        successes = list()
+        submitted = OrderedDict()
+        for baseline_ndx, (name, write_key, delays) in enumerate(baselines):
+            intent = ('baseline', baseline_ndx)
+            if intent in anticipated:
+                success, warn = self._set_scenarios_success(execut=execut[intent],
+                                                            anticipated_execut=anticipated[intent])
+                submitted.setdefault(write_key, list()).append((name, delays, success))
+                if not success or warn:
+                    self._error(write_key=write_key, operation='submit', name=name, delays=delays, success=success,
+                                warn=warn, antipated_execut=anticipated[intent], actual_execut=execut[intent])
+            else:
+                success = 0
+            successes.append(success)
+        for write_key, submissions in submitted.items():
+            self._confirm(write_key=write_key, operation='submit', count=len(submissions),
+                          names=[name for name, _, success in submissions if success][:5],
+                          success=all(success for _, _, success in submissions))
+        return successes
 
     def _cancel_implementation(self, name, write_key, delay=None, delays=None):
         """
@@ -1494,12 +1975,15 @@ class Rediz(RedizConventions):
             delete_pipe = self.client.pipeline(
                 transaction=True)  # <-- Important that transaction=True lest submissions and owners get out of sync
             code = self.animal_from_key(write_key)
+            participant_id = self._participant_id(write_key=write_key, create=False)  # Compact tickets, if any
             confirmation = {'operation': 'cancel', 'time': str(datetime.datetime.now()), 'success': True, 'name': name,
                             'delays': delays, 'participant': code, 'epoch_time': time.time(),
                             'explanation': 'delayed withdrawal is complete'}
             for delay in delays:
                 collective_predictions_name = self._predictions_name(name, delay)
                 keys = [self._format_scenario(write_key, k) for k in range(self.num_predictions)]
+                if participant_id is not None:
+                    keys += [self._compact_scenario(participant_id, k) for k in range(self.num_predictions)]
                 delete_pipe.zrem(collective_predictions_name, *keys)  # 1000
                 samples_name = self._samples_name(name=name, delay=delay)
                 delete_pipe.zrem(samples_name, *keys)  # 1000
@@ -1515,9 +1999,19 @@ class Rediz(RedizConventions):
         """ Charge for this! Not encouraged as it should not be necessary, and it is inefficient to get scenarios back from the collective zset """
         assert name == self._root_name(name)
         if self.is_valid_key(write_key) and delay in self.DELAYS:
-            cursor, items = self.client.zscan(name=self._predictions_name(name=name, delay=delay), cursor=cursor,
-                                              match='*' + write_key + '*', count=self.num_predictions)
-            return {"cursor": cursor, "scenarios": dict(items)}
+            participant_id = self._participant_id(write_key=write_key, create=False) if self._COMPACT_TICKETS else None
+            if participant_id is None:
+                cursor, items = self.client.zscan(name=self._predictions_name(name=name, delay=delay), cursor=cursor,
+                                                  match='*' + write_key + '*', count=self.num_predictions)
+            else:
+                # Compact and legacy tickets cannot be matched by one pattern, so they are filtered here
+                cursor, items = self.client.zscan(name=self._predictions_name(name=name, delay=delay), cursor=cursor,
+                                                  count=self.num_predictions)
+                owners = (write_key, str(participant_id))
+                items = [(ticket, v) for ticket, v in items if self._parse_scenario(ticket)[1] in owners]
+            tickets = self._decoded_scenarios([ticket for ticket, _ in items])
+            return {"cursor": cursor, "scenarios": dict((ticket, v) for ticket, (_, v) in zip(tickets, items)
+                                                        if ticket is not None)}
 
     def _get_invcdf_implementation(self, name, delay, percentiles):
         """ Random estimate of invcdf at percentiles 0 < p < 1 """
@@ -1546,9 +2040,8 @@ class Rediz(RedizConventions):
             execut = score_pipe.execute()
             execut_combined = RedizConventions.chunker(execut, n=len(values))
             execut_merged = [lst[0] + lst[1] for lst in execut_combined]
-            prtcls = [
-                self._zmean_scenarios_percentile(percentile_scenarios=ex, included_codes=included) if ex else np.NaN for
-                ex in execut_merged]
+            zmeans = self._zmean_scenarios_percentiles(scenario_lists=execut_merged, included_codes=included)
+            prtcls = [zm if ex else np.NaN for zm, ex in zip(zmeans, execut_merged)]
             valid = [(v, p) for v, p in zip(values, prtcls) if not np.isnan(p) and abs(p - 0.5) > 1e-6]
 
             # Make CDF monotone using avg of min and max envelopes running from each direction
@@ -1572,82 +2065,17 @@ class Rediz(RedizConventions):
         elif delays is None:
             delays = [delay]
         assert name == self._root_name(name)
-        if len(values) == self.num_predictions and self.is_valid_key(write_key
-                                                                     ) and all(
-            [isinstance(v, (int, float)) for v in values]) and all(delay in self.DELAYS for delay in delays):
-            # Ensure sorted ... TODO: force this on the algorithm, or charge a fee?
-            values = sorted(values)
-
-            # Jigger sorted predictions
-            max_abs_value = max([abs(vi) for vi in values])
-            some_big = [ vi for vi in values if abs(vi)>0.1*max_abs_value ]
-            pretty_big = np.mean(some_big)
-
-            if pretty_big>1000.:
-                noise_ratio = pretty_big/1000.
-            else:
-                noise_ratio = 1.0
-            noise = [ nz for nz in np.random.randn(2*self.num_predictions).tolist() if abs(nz)>0.1 ]
-            # noise_ratio = 1.0 # <---- debugging hack
-            jiggered_values = [v + noise_ratio*n * self.NOISE for v, n in zip(values, noise)]
-
-
-            jiggered_values.sort()
-            if len(set(jiggered_values)) != self.num_predictions:
-                print('----- submission error ----- ')
-                num_values_unique = len(set(values))
-                num_values = len(values)
-                num_jiggled_unique = len(set(jiggered_values))
-                num_jiggled = len(jiggered_values)
-
-                if True:
-                    print('Values...')
-                    pprint(values)
-                    print('Jigged values ...')
-                    pprint(jiggered_values)
-                some_values = ','.join( [ str(v) for v in jiggered_values[:15] ] )
-                error_message = "Cannot accept submission as there are "+str((num_values,num_values_unique))+" values/unique values ("+str((num_jiggled,num_jiggled_unique ))+" jiggled/jiggled unique). Some jiggered values are "+some_values
-                print(error_message,flush=True)
-                raise Exception(error_message)
-            predictions = dict(
-                [(self._format_scenario(write_key=write_key, k=k), v) for k, v in enumerate(jiggered_values)])
+        if self._valid_scenarios(values=values, write_key=write_key, delays=delays):
+            predictions = self._jiggered_scenarios(values=values, write_key=write_key)
 
             # Open pipeline
             set_and_expire_pipe = self.client.pipeline()
-
-            # Add to collective contemporaneous forward predictions
-            for delay in delays:
-                collective_predictions_name = self._predictions_name(name, delay)
-                set_and_expire_pipe.zadd(name=collective_predictions_name, mapping=predictions, ch=True,
-                                         nx=False)  # [num]*len(delays)
-
-            # Create obscure predictions and promise to insert them later, at different times, into different samples
-            utc_epoch_now = int(time.time())
-            individual_predictions_name = self._random_promised_name(name)
-            set_and_expire_pipe.zadd(name=individual_predictions_name, mapping=predictions, ch=True)  # num
-            promise_ttl = max(self.DELAYS) + self._DELAY_GRACE
-            set_and_expire_pipe.expire(name=individual_predictions_name, time=promise_ttl)  # true
-            for delay_seconds in delays:
-                promise_queue = self._promise_queue_name(utc_epoch_now + delay_seconds)
-                promise = self._prediction_promise(target=name, delay=delay_seconds,
-                                                   predictions_name=individual_predictions_name)
-                set_and_expire_pipe.sadd(promise_queue, promise)  # (3::3)
-                set_and_expire_pipe.expire(name=promise_queue, time=delay_seconds + self._DELAY_GRACE)  # (4::3)
-                set_and_expire_pipe.expire(name=individual_predictions_name,
-                                           time=delay_seconds + self._DELAY_GRACE)  # (5::3)
+            anticipated_execut = self._set_scenarios_pipe(pipe=set_and_expire_pipe, name=name,
+                                                          predictions=predictions, delays=delays, write_key=write_key)
 
             # Execute pipeline ... should not fail (!)
             execut = set_and_expire_pipe.execute()
-            anticipated_execut = [self.num_predictions] * len(delays) + [self.num_predictions, True] + [1, True,
-                                                                                                        True] * len(
-                delays)
-
-            def _close(a1, a2):
-                return a1 == a2 or (isinstance(a1, int) and a1 > 20 and ((a1 - a2) / self.num_predictions) < 0.05)
-
-            success = all(
-                _close(actual, anticipate) for actual, anticipate in itertools.zip_longest(execut, anticipated_execut))
-            warn = not (all(a1 == a2) for a1, a2 in itertools.zip_longest(execut, anticipated_execut))
+            success, warn = self._set_scenarios_success(execut=execut, anticipated_execut=anticipated_execut)
 
             confirmation = {'write_key': write_key, 'operation': 'submit', 'name': name, 'delays': delays,
                             'some_values': values[:5], 'success': success, 'warn': warn}
@@ -1662,71 +2090,343 @@ class Rediz(RedizConventions):
             # TODO: Log failed prediction attempt to write_key log
             return 0
 
-    def _msettle(self, names, values, budgets, with_percentiles, write_keys, with_copulas):
-        """ Parallel version of settle  """
+    def _mset_scenarios_implementation(self, write_key, submissions, verbose=False):
+        """ Supply scenarios for many horizons with one pipeline and one confirmation
+               submissions :  { (name, delay): [ float ] }
+        """
+        submit_pipe = IntentPipeline(self.client)
+        anticipated = dict()
+        problems = list()
+        for (name, delay), values in submissions.items():
+            assert name == self._root_name(name)
+            if self._valid_scenarios(values=values, write_key=write_key, delays=[delay]):
+                try:
+                    predictions = self._jiggered_scenarios(values=values, write_key=write_key)
+                except Exception as e:
+                    # One bad horizon does not prevent submission to the others
+                    problems.append({'name': name, 'delay': delay, 'success': False, 'error': str(e)[:200]})
+                    continue
+                with submit_pipe.intent((name, delay)) as p:
+                    anticipated[(name, delay)] = self._set_scenarios_pipe(pipe=p, name=name, predictions=predictions,
+                                                                          delays=[delay], write_key=write_key)
+        execut = submit_pipe.execute()
+
+        successes = OrderedDict()
+        for (name, delay) in submissions:
+            if (name, delay) in anticipated:
+                success, warn = self._set_scenarios_success(execut=execut[(name, delay)],
+                                                            anticipated_execut=anticipated[(name, delay)])
+                if not success or warn:
+                    problems.append({'name': name, 'delay': delay, 'success': success,
+                                     'antipated_execut': anticipated[(name, delay)],
+                                     'actual_execut': execut[(name, delay)]})
+            else:
+                success = 0
+            successes[(name, delay)] = success
+
+        confirmation = {'write_key': write_key, 'operation': 'submit', 'count': len(submissions),
+                        'names': [name for (name, _), success in successes.items() if success][:5],
+                        'success': all(successes.values())}
+        if any(successes.values()):
+            self._confirm(**confirmation)
+        if problems:
+            self._error(write_key=write_key, operation='submit', success=confirmation['success'],
+                        count=len(problems), problems=problems[:5])
+        if verbose:
+            confirmation.update({'successes': successes})
+            return confirmation
+        return successes
+
+    def _bankruptcy_declined(self, write_key, horizons):
+        """ Horizons (name, delay) where a bankrupt write_key may not submit because it is absent from, or well down,
+            the leaderboard
+        """
+        if not self._bankrupt_write_keys([write_key]):
+            return set()
+        code = self.shash(key=write_key)
+        score_pipe = self.client.pipeline()
+        for name, delay in horizons:
+            score_pipe.zscore(self.leaderboard_name(name=name, delay=delay), code)
+        scores = score_pipe.execute()
+        return set(horizon for horizon, score in zip(horizons, scores) if score is None or self._well_down(score))
 
-        half_winners = int(math.ceil(self.NUM_WINNERS/2))
+    @staticmethod
+    def _well_down(score):
+        """ Leaderboard scores below which bankrupt participants may not submit """
+        return score is not None and float(score) < -1.0
 
+    def _bankrupt_write_keys(self, write_keys, cached=True):
+        """ Subset of write_keys that are bankrupt, using balances cached for up to balance_cache_ttl seconds
+              cached :  If False all balances are read (and the cache refreshed), as when acting on bankruptcy
+        """
+        now = time.time()
+        balances = dict()
+        missing = list()
+        for write_key in set(write_keys):
+            entry = self._balance_cache.get(write_key) if self._BALANCE_CACHE_TTL and cached else None
+            if entry is not None and now - entry[0] < self._BALANCE_CACHE_TTL:
+                balances[write_key] = entry[1]
+            else:
+                missing.append(write_key)
+        if missing:
+            for write_key, balance in zip(missing, self.client.hmget(self._BALANCES, missing)):
+                balances[write_key] = float(balance or 0)
+                if self._BALANCE_CACHE_TTL:
+                    self._balance_cache[write_key] = (now, balances[write_key])
+        return set(write_key for write_key, balance in balances.items() if
+                   balance < self.bankruptcy(self.key_difficulty(write_key)))
+
+    def _valid_scenarios(self, values, write_key, delays):
+        return len(values) == self.num_predictions and self.is_valid_key(write_key) and all(
+            [isinstance(v, (int, float)) for v in values]) and all(delay in self.DELAYS for delay in delays)
+
+    def _jiggered_scenarios(self, values, write_key):
+        """ Sort, break ties with noise and convert to tickets
+               Returns:  { ticket: value }
+        """
+        # Ensure sorted ... TODO: force this on the algorithm, or charge a fee?
+        values = np.asarray(values, dtype=float)
+        if np.any(values[1:] < values[:-1]):
+            values = np.sort(values)
+
+        # Jigger sorted predictions
+        max_abs_value = np.max(np.abs(values))
+        some_big = values[np.abs(values) > 0.1 * max_abs_value]
+        pretty_big = np.mean(some_big) if len(some_big) else 0.
+        if pretty_big>1000.:
+            noise_ratio = pretty_big/1000.
+        else:
+            noise_ratio = 1.0
+        noise = np.random.randn(2 * self.num_predictions)
+        noise = noise[np.abs(noise) > 0.1]
+        while len(noise) < self.num_predictions:
+            more_noise = np.random.randn(self.num_predictions)
+            noise = np.concatenate([noise, more_noise[np.abs(more_noise) > 0.1]])
+        jiggered_values = values + noise_ratio * self.NOISE * noise[:self.num_predictions]
+        if np.any(jiggered_values[1:] < jiggered_values[:-1]):
+            jiggered_values.sort()
+
+        if len(np.unique(jiggered_values)) != self.num_predictions:
+            num_values_unique = len(np.unique(values))
+            num_values = len(values)
+            num_jiggled_unique = len(np.unique(jiggered_values))
+            num_jiggled = len(jiggered_values)
+            some_values = ','.join( [ str(v) for v in jiggered_values[:15] ] )
+            error_message = "Cannot accept submission as there are "+str((num_values,num_values_unique))+" values/unique values ("+str((num_jiggled,num_jiggled_unique ))+" jiggled/jiggled unique). Some jiggered values are "+some_values
+            self._error(write_key=write_key, operation='submit', error=error_message)
+            raise Exception(error_message)
+        return dict(zip(self._scenario_tickets(write_key=write_key), jiggered_values.tolist()))
+
+    def _set_scenarios_pipe(self, pipe, name, predictions, delays, write_key):
+        """ Queue submission of predictions for name
+               Returns:  anticipated results of the queued operations (None where the result is not checked)
+        """
+        # Add to collective contemporaneous forward predictions
+        distribution_ttl = self._cost_based_distribution_ttl(budget=1)
+        for delay in delays:
+            collective_predictions_name = self._predictions_name(name, delay)
+            pipe.zadd(name=collective_predictions_name, mapping=predictions, ch=True, nx=False)  # [num]*len(delays)
+        for delay in delays:
+            pipe.expire(name=self._predictions_name(name, delay), time=distribution_ttl)  # [True]*len(delays)
+
+        # Create obscure predictions and promise to insert them later, at different times, into different samples
+        utc_epoch_now = int(time.time())
+        individual_predictions_name = self._random_promised_name(name)
+        pipe.zadd(name=individual_predictions_name, mapping=predictions, ch=True)  # num
+        promise_ttl = max(self.DELAYS) + self._DELAY_GRACE
+        pipe.expire(name=individual_predictions_name, time=promise_ttl)  # true
+        anticipated_promises = list()
+        for delay_seconds in delays:
+            promise = self._prediction_promise(target=name, delay=delay_seconds,
+                                               predictions_name=individual_predictions_name)
+            anticipated_promises += self._promise_pipe(pipe=pipe, promise=promise, due=utc_epoch_now + delay_seconds,
+                                                       ttl=delay_seconds + self._DELAY_GRACE,
+                                                       name=name)  # (3::3), (4::3)
+            pipe.expire(name=individual_predictions_name, time=delay_seconds + self._DELAY_GRACE)  # (5::3)
+            anticipated_promises.append(True)
+        anticipated_promises += self._notify_pipe(pipe=pipe, dues=[utc_epoch_now + delay for delay in delays])
+
+        return [self.num_predictions] * len(delays) + [True] * len(delays) + \
+               [self.num_predictions, True] + anticipated_promises
+
+    def _set_scenarios_success(self, execut, anticipated_execut):
+        """ Returns success, warn """
+
+        def _close(a1, a2):
+            return a2 is None or a1 == a2 or (isinstance(a1, int) and a1 > 20 and ((a1 - a2) / self.num_predictions) < 0.05)
+
+        success = all(
+            _close(actual, anticipate) for actual, anticipate in itertools.zip_longest(execut, anticipated_execut))
+        warn = not all(a2 is None or a1 == a2 for a1, a2 in itertools.zip_longest(execut, anticipated_execut))
+        return success, warn
+
+    def _msettle_retrieve(self, names, values, with_predictions_pools=False):
+        """ Single read pipeline for settlement, optionally also counting contemporaneous predictions
+               Returns:  { (name, delay_ndx, 'pool' | 'participants' | 'predictions_pool' | window_ndx): [ results ] }
+        """
+        half_winners = int(math.ceil(self.NUM_WINNERS/2))
+        widest = max(self._WINDOWS)
         assert len(set(names)) == len(names), "mget() cannot be used with repeated names"
-        retrieve_pipe = self.client.pipeline()
-        num_delay = len(self.DELAYS)
-        num_windows = len(self._WINDOWS)
-        sponsors = [self.shash(ky) for ky in write_keys]
+        retrieve_pipe = IntentPipeline(self.client)
 
         # ----  Construct pipe to retrieve quarantined predictions ----------
-        scenarios_lookup = dict(
-            [(name, dict([(delay_ndx, dict()) for delay_ndx in range(num_delay)])) for name in names])
-        pools_lookup = dict([(name, dict()) for name in names])
-        participants_lookup = dict([(name, dict()) for name in names])
         for name, value in zip(names, values):
             for delay_ndx, delay in enumerate(self.DELAYS):
+                if with_predictions_pools:
+                    with retrieve_pipe.intent((name, delay_ndx, 'predictions_pool')) as p:
+                        p.zcard(self._predictions_name(name=name, delay=delay))
                 samples_name = self._samples_name(name=name, delay=delay)
-                pools_lookup[name][delay_ndx] = len(retrieve_pipe)
-                retrieve_pipe.zcard(samples_name)  # Total number of entries
-                participants_lookup[name][delay_ndx] = len(retrieve_pipe)
-                retrieve_pipe.smembers(self._sample_owners_name(name=name, delay=delay))  # List of owners
-                for window_ndx, window in enumerate(self._WINDOWS):
-                    scenarios_lookup[name][delay_ndx][window_ndx] = len(retrieve_pipe)
-                    retrieve_pipe.zrangebyscore(name=samples_name, min=value, max=value + 0.5 * window,
-                                                withscores=False, start=0, num=half_winners)
-                    retrieve_pipe.zrevrangebyscore(name=samples_name, max=value, min=value - 0.5 * window,
-                                                   withscores=False, start=0, num=half_winners)
+                with retrieve_pipe.intent((name, delay_ndx, 'pool')) as p:
+                    p.zcard(samples_name)  # Total number of entries
+                with retrieve_pipe.intent((name, delay_ndx, 'participants')) as p:
+                    p.smembers(self._sample_owners_name(name=name, delay=delay))  # List of owners
+                # Only the widest window is retrieved, as narrower ones are nested within it
+                with retrieve_pipe.intent((name, delay_ndx, 'widest')) as p:
+                    p.zrangebyscore(name=samples_name, min=value, max=value + 0.5 * widest,
+                                    withscores=True, start=0, num=half_winners)
+                    p.zrevrangebyscore(name=samples_name, max=value, min=value - 0.5 * widest,
+                                       withscores=True, start=0, num=half_winners)
         retrieved = retrieve_pipe.execute()
 
+        # ---- Select neighbourhoods for each window client side ----------
+        for name, value in zip(names, values):
+            for delay_ndx in range(len(self.DELAYS)):
+                scenarios_up, scenarios_dn = retrieved.pop((name, delay_ndx, 'widest'))
+                retrieved.update(dict(((name, delay_ndx, window_ndx), neighbours) for window_ndx, neighbours in
+                                      enumerate(self._nested_neighbours(value, scenarios_up, scenarios_dn))))
+        return retrieved
+
+    def _nested_neighbours(self, value, scenarios_up, scenarios_dn):
+        """ Given the closest scenarios above and below value (with scores) within the widest window, select those
+            that would have been returned for each window in self._WINDOWS
+              Returns:  [ [ scenarios_up, scenarios_dn ] ]  by window_ndx
+        """
+        tickets_up = [ticket for ticket, _ in scenarios_up]
+        tickets_dn = [ticket for ticket, _ in scenarios_dn]
+        scores_up = np.array([score for _, score in scenarios_up])
+        scores_dn = -np.array([score for _, score in scenarios_dn])  # Negated so they are ascending
+        half_windows = 0.5 * np.array(self._WINDOWS)
+        num_up = np.searchsorted(scores_up, value + half_windows, side='right')
+        num_dn = np.searchsorted(scores_dn, -(value - half_windows), side='right')
+        return [[tickets_up[:n_up], tickets_dn[:n_dn]] for n_up, n_dn in zip(num_up, num_dn)]
+
+    def _msettle(self, names, values, budgets, with_percentiles, write_keys, with_copulas, retrieved=None,
+                 baselines=None, idempotency_key=None):
+        """ Parallel version of settle
+              baselines       :  [ (name, write_key, [ delay ]) ] submitted in the same transaction as the payments
+              idempotency_key :  If supplied, set in that transaction too, and derived markets are queued there as a
+                                 job rather than set afterwards. With scripted settlement each horizon is paid before
+                                 that transaction by its own script, which marks the horizon as settled for this key.
+        """
+
+        num_delay = len(self.DELAYS)
+        sponsors = [self.shash(ky) for ky in write_keys]
+        if retrieved is None:
+            retrieved = self._msettle_retrieve(names=names, values=values)
+
         # ---- Compute percentiles by zooming out until we have enough points ---
         some_percentiles = False
         percentiles = dict([(name, dict((d, 0.5) for d in range(len(self.DELAYS)))) for name in names])
+        percentile_horizons, percentile_scenario_lists = list(), list()
         if with_percentiles:
             for name in names:
-                pools = [retrieved[pools_lookup[name][delay_ndx]] for delay_ndx in range(num_delay)]
+                pools = [retrieved[(name, delay_ndx, 'pool')][0] for delay_ndx in range(num_delay)]
                 if any(pools):
                     for delay_ndx, pool in enumerate(pools):
-                        assert pool == retrieved[pools_lookup[name][delay_ndx]]  # Just checkin
-                        participant_set = retrieved[participants_lookup[name][delay_ndx]]
+                        participant_set = retrieved[(name, delay_ndx, 'participants')][0]
                         if pool and len(participant_set) >= 1:
                             # Zoom out window for percentiles ... want a few so we can average zscores
                             # from more than one contributor, hopefully leading to more accurate percentiles
                             percentile_scenarios = list()
                             for window_ndx, window_used in enumerate(self._WINDOWS):
                                 if len(percentile_scenarios) < 10:
-                                    _ndx = scenarios_lookup[name][delay_ndx][window_ndx]
-                                    percentile_scenarios_up = retrieved[_ndx]
-                                    percentile_scenarios_dn = retrieved[_ndx + 1]
+                                    percentile_scenarios_up, percentile_scenarios_dn = retrieved[
+                                        (name, delay_ndx, window_ndx)]
                                     percentile_scenarios = percentile_scenarios_dn + percentile_scenarios_up
                                     some_percentiles = len(percentile_scenarios) > 0
-                            percentiles[name][delay_ndx] = self._zmean_scenarios_percentile(
-                                percentile_scenarios=percentile_scenarios)
+                            percentile_horizons.append((name, delay_ndx))
+                            percentile_scenario_lists.append(percentile_scenarios)
+            # All horizons of the batch are decoded and averaged at once
+            zmeans = self._zmean_scenarios_percentiles(scenario_lists=percentile_scenario_lists)
+            for (name, delay_ndx), zmean in zip(percentile_horizons, zmeans):
+                percentiles[name][delay_ndx] = float(zmean)
+
+        # ---- Derived markets use 1-d, 2-d, 3-d market-implied z-scores and z-curves
+        z_budgets = list()
+        z_names = list()
+        z_curves = list()
+        z_write_keys = list()
+        if with_percentiles and some_percentiles:
+            first_write_key = write_keys[0]
+            for delay_ndx, delay in enumerate(self.ZDELAYS):
+                percentiles1 = [percentiles[name][delay_ndx] for name in names]
+                legit = not (all([abs(p1 - 0.5) < 1e-5 for p1 in percentiles1]))
+                if legit:
+                    num_names = len(names)
+                    selections = list(itertools.combinations(list(range(num_names)), 1))
+                    if with_copulas and num_names <= 12:
+                        selections2 = list(itertools.combinations(list(range(num_names)), 2))
+                        if num_names<=5:
+                            selections3 = list(itertools.combinations(list(range(num_names)), 3))
+                        else:
+                            selections3 = []
+                        selections = selections + selections2 + selections3
+
+                    # All selections of the same dimension are mapped to z-curves at once
+                    for dim in sorted(set(len(selection) for selection in selections)):
+                        selected = np.array([selection for selection in selections if len(selection) == dim])
+                        zcurve_values = self._to_zcurves(np.array(percentiles1)[selected])
+                        selected_budgets = np.array(budgets, dtype=float)[selected].sum(axis=1) / (10 * dim)  # FIXME: Why int?
+                        for selection, zcurve_value, z_budget in zip(selected, zcurve_values, selected_budgets):
+                            if np.isfinite(zcurve_value):
+                                z_names.append(self.zcurve_name([names[o] for o in selection], delay))
+                                z_budgets.append(float(z_budget))
+                                z_curves.append(float(zcurve_value))
+                                z_write_keys.append(first_write_key)
 
         # ---- Rewards and leaderboard update pipeline
-        pipe = self.client.pipeline()
+        if self._SCRIPTED_SETTLEMENT:
+            # Each horizon is read, cleared and paid atomically by a server side script
+            self._scripted_settle(names=names, values=values, budgets=budgets, sponsors=sponsors, retrieved=retrieved,
+                                  idempotency_key=idempotency_key)
+        pipe = IntentPipeline(self.client)
+        anticipated_baselines = self._baseline_predictions_pipe(pipe=pipe, baselines=baselines or list())
         pipe.hmset(name=self.BUDGETS, mapping=dict(zip(names, budgets)))  # Log the budget decision
-        for name, budget, write_key, sponsor, value in zip(names, budgets, write_keys, sponsors, values):
-            pools = [retrieved[pools_lookup[name][delay_ndx]] for delay_ndx in range(num_delay)]
+        if not self._SCRIPTED_SETTLEMENT:
+            self._settle_pipe(pipe=pipe, names=names, values=values, budgets=budgets, sponsors=sponsors,
+                              retrieved=retrieved)
+
+        if idempotency_key is not None:
+            if z_names:
+                self._enqueue_set(pipe=pipe, names=z_names, values=z_curves, budgets=z_budgets,
+                                  write_keys=z_write_keys)
+            pipe.set(idempotency_key, 1, ex=self._SETTLED_TTL)
+        settle_exec = pipe.execute()  # No checks here, other than of baseline submissions
+        if baselines:
+            self._baseline_confirms(baselines=baselines, anticipated=anticipated_baselines, execut=settle_exec)
+
+        if z_names and idempotency_key is None:
+            self._mset_implementation(budgets=z_budgets, names=z_names, values=z_curves, write_keys=z_write_keys,
+                                      with_percentiles=False, with_copulas=False)
+
+        return percentiles
+
+    def _horizon_settlements(self, names, values, budgets, sponsors, retrieved):
+        """ Payments for every horizon with participants
+              Returns:  [ (name, delay, leaderboard_names, payments, transaction_record) ]
+                        where payments are rescaled by budget, and the amount and recipient_code of the record are
+                        filled in for each recipient
+        """
+        half_winners = int(math.ceil(self.NUM_WINNERS/2))
+        num_delay = len(self.DELAYS)
+        num_windows = len(self._WINDOWS)
+        settlements = list()
+        for name, budget, sponsor, value in zip(names, budgets, sponsors, values):
+            pools = [retrieved[(name, delay_ndx, 'pool')][0] for delay_ndx in range(num_delay)]
             if any(pools):
-                participant_sets = [retrieved[participants_lookup[name][delay_ndx]] for delay_ndx in range(num_delay)]
+                participant_sets = [retrieved[(name, delay_ndx, 'participants')][0] for delay_ndx in range(num_delay)]
                 for delay_ndx, delay, pool, participant_set in zip(range(num_delay), self.DELAYS, pools,
                                                                    participant_sets):
-                    payments = Counter()
                     if pool and len(participant_set) > 1:
                         # Zoom out rewards scenarios window if we don't have a winner
                         # Possibly this should be adjusted by the number of participants to reduce wealth variance
@@ -1734,65 +2434,26 @@ class Rediz(RedizConventions):
                         rewarded_scenarios = list()
                         for window_ndx in range(num_windows):
                             if len(rewarded_scenarios) == 0:
-                                _ndx = scenarios_lookup[name][delay_ndx][window_ndx]
-                                rewarded_scenarios = retrieved[_ndx]
+                                rewarded_scenarios = retrieved[(name, delay_ndx, window_ndx)][0]
                                 winning_window_ndx = window_ndx
                         winning_window = self._WINDOWS[winning_window_ndx]
                         num_rewarded = len(rewarded_scenarios)
 
                         game_payments = self._game_payments(pool=pool, participant_set=participant_set,
-                                                            rewarded_scenarios=rewarded_scenarios)
-                        payments.update(game_payments)
-
-                    if len(payments):
-                        usual_leaderboard_names = [self.leaderboard_name(),
-                                             self.leaderboard_name(name=name),
-                                             self.leaderboard_name(name=None, delay=delay),
-                                             self.leaderboard_name(name=name, delay=delay)]
-                        custom_leaderboard_names = [ self.custom_leaderboard_name(sponsor=None, name=None),  # Overall all time
-                                             self.custom_leaderboard_name(sponsor=None, name=None,
-                                                                          dt=datetime.datetime.now()),  # This month
-                                             self.custom_leaderboard_name(sponsor=sponsor, name=None),
-                                             # Sponsor category
-                                             self.custom_leaderboard_name(sponsor=sponsor, name=name),
-                                             # Sponsor and category
-                                             self.custom_leaderboard_name(sponsor=sponsor, dt=datetime.datetime.now()),
-                                             # Sponsor and month
-                                             self.custom_leaderboard_name(sponsor=sponsor, name=name,
-                                                                          dt=datetime.datetime.now()),
-                                             # Sponsor and category and month
-                                             self.custom_leaderboard_name(sponsor=sponsor, name=name,
-                                                                          dt=datetime.datetime.now())
-                                             ]
-                        leaderboard_names = usual_leaderboard_names
-                        # Decide whether we will include certain delays in the leaderboards used for prizes
-                        if delay>=self.DELAYS[-1]: # <-- Only include the 1hr ahead predictions
-                             leaderboard_names = usual_leaderboard_names + custom_leaderboard_names
-
-
-                        for (recipient, amount) in payments.items():
-                            # Record keeping
-                            rescaled_amount = budget * float(amount)
-                            pipe.hincrbyfloat(name=self._BALANCES, key=recipient, amount=rescaled_amount)
-                            pipe.hincrbyfloat(name=self.VOLUMES, key=self.horizon_name(name=name, delay=delay),
-                                              amount=abs(rescaled_amount))
-                            write_code = self.shash(write_key)
-                            recipient_code = self.shash(recipient)
-                            # Leaderboards
-                            for lb in leaderboard_names:
-                                pipe.zincrby(name=lb, value=recipient_code, amount=rescaled_amount)
-                            # Performance
-                            pipe.hincrbyfloat(name=self.performance_name(write_key=recipient),
-                                              key=self.horizon_name(name=name, delay=delay), amount=rescaled_amount)
-                            # Transactions logs:
+                                                            rewarded_scenarios=rewarded_scenarios,
+                                                            horizon=self.horizon_name(name=name, delay=delay))
+                        if len(game_payments):
+                            payments = OrderedDict((recipient, budget * float(amount))
+                                                   for recipient, amount in game_payments.items())
+                            leaderboard_names = self._settlement_leaderboard_names(name=name, delay=delay,
+                                                                                   sponsor=sponsor)
                             maxed_out = num_rewarded == 2 * half_winners
                             mass = num_rewarded / pool if pool > 0.0 else 0.
                             density = mass / winning_window
                             reliable = 0 if maxed_out else 1
                             breakeven = self.num_predictions*num_rewarded/pool if pool>0 else 0
-
                             transaction_record = {"settlement_time": str(datetime.datetime.now()),
-                                                  "amount": rescaled_amount,
+                                                  "amount": None,
                                                   "budget": budget,
                                                   "stream": name,
                                                   "delay": delay,
@@ -1804,82 +2465,195 @@ class Rediz(RedizConventions):
                                                   "reliable": reliable,
                                                   "submissions_count": pool,
                                                   "submissions_close": num_rewarded,
-                                                  "stream_owner_code": write_code,
-                                                  "recipient_code": recipient_code}
-                            log_names = [self.transactions_name(),
-                                         self.transactions_name(write_key=recipient),
-                                         self.transactions_name(write_key=recipient, name=name),
-                                         self.transactions_name(write_key=recipient, name=name, delay=delay)]
-                            for ln in log_names:
-                                pipe.xadd(name=ln, fields=transaction_record, maxlen=self.TRANSACTIONS_LIMIT)
-                                pipe.expire(name=ln, time=self._TRANSACTIONS_TTL)
-                        for lb in leaderboard_names:
-                            pipe.expire(name=lb, time=self._LEADERBOARD_TTL)
-
-        settle_exec = pipe.execute()  # No checks here
-
-        if with_percentiles and some_percentiles:
-            first_write_key = write_keys[0]
-            # Derived markets use 1-d, 2-d, 3-d market-implied z-scores and z-curves
-            z_budgets = list()
-            z_names = list()
-            z_curves = list()
-            z_write_keys = list()
-            for delay_ndx, delay in enumerate(self.ZDELAYS):
-                percentiles1 = [percentiles[name][delay_ndx] for name in names]
-                legit = not (all([abs(p1 - 0.5) < 1e-5 for p1 in percentiles1]))
-                if legit:
-                    num_names = len(names)
-                    selections = list(itertools.combinations(list(range(num_names)), 1))
-                    if with_copulas and num_names <= 12:
-                        selections2 = list(itertools.combinations(list(range(num_names)), 2))
-                        if num_names<=5:
-                            selections3 = list(itertools.combinations(list(range(num_names)), 3))
-                        else:
-                            selections3 = []
-                        selections = selections + selections2 + selections3
-
-                    for selection in selections:
-                        selected_names = [names[o] for o in selection]
-                        dim = len(selection)
-                        z_budget = sum([budgets[o] for o in selection]) / (10 * dim)  # FIXME: Why int?
-                        selected_prctls = [percentiles1[o] for o in selection]
-                        zcurve_value = self.to_zcurve(selected_prctls)
-                        zname = self.zcurve_name(selected_names, delay)
-                        z_names.append(zname)
-                        z_budgets.append(z_budget)
-                        z_curves.append(zcurve_value)
-                        z_write_keys.append(first_write_key)
-            if z_names:
-                self._mset_implementation(budgets=z_budgets, names=z_names, values=z_curves, write_keys=z_write_keys,
-                                          with_percentiles=False, with_copulas=False)
-        return percentiles
+                                                  "stream_owner_code": sponsor,
+                                                  "recipient_code": None}
+                            settlements.append((name, delay, leaderboard_names, payments, transaction_record))
+        return settlements
+
+    def _settle_pipe(self, pipe, names, values, budgets, sponsors, retrieved):
+        """ Queue payments, leaderboard updates and transaction logs for every horizon with participants """
+        leaderboard_increments = Counter()
+        for name, delay, leaderboard_names, payments, record in self._horizon_settlements(
+                names=names, values=values, budgets=budgets, sponsors=sponsors, retrieved=retrieved):
+            horizon = self.horizon_name(name=name, delay=delay)
+            for recipient, amount in payments.items():
+                # Record keeping
+                pipe.hincrbyfloat(name=self._BALANCES, key=recipient, amount=amount)
+                pipe.hincrbyfloat(name=self.VOLUMES, key=horizon, amount=abs(amount))
+                recipient_code = self.shash(recipient)
+                # Leaderboards (accumulated across the batch and flushed below)
+                for lb in leaderboard_names:
+                    leaderboard_increments[(lb, recipient_code)] += amount
+                # Performance
+                pipe.hincrbyfloat(name=self.performance_name(write_key=recipient), key=horizon, amount=amount)
+                # Transactions logs:
+                transaction_record = dict(record, amount=amount, recipient_code=recipient_code)
+                if self._SETTLEMENT_JOURNAL:
+                    # Written once, and fanned out to transaction streams later
+                    transaction_record.update({"recipient": recipient})
+                    pipe.xadd(name=self._JOURNAL, fields=transaction_record, maxlen=self._JOURNAL_LIMIT)
+                else:
+                    self._transaction_logs_pipe(pipe=pipe, recipient=recipient, name=name, delay=delay,
+                                                transaction_record=transaction_record)
+        self._leaderboard_increments_pipe(pipe=pipe, leaderboard_increments=leaderboard_increments)
+
+    def _leaderboard_increments_pipe(self, pipe, leaderboard_increments):
+        """ One multi-member increment and one EXPIRE per leaderboard
+              leaderboard_increments :  Counter keyed by (leaderboard_name, code)
+              Several members are incremented by one script call, so pipe should be an IntentPipeline
+        """
+        by_leaderboard = OrderedDict()
+        for (lb, code), amount in leaderboard_increments.items():
+            by_leaderboard.setdefault(lb, list()).append((code, amount))
+        for lb, increments in by_leaderboard.items():
+            if len(increments) == 1:
+                code, amount = increments[0]
+                pipe.zincrby(name=lb, value=code, amount=amount)
+            else:
+                with pipe.intent(('leaderboard', lb)) as p:
+                    self._zincrby_many_script(keys=[lb], args=list(itertools.chain(*increments)), client=p)
+            pipe.expire(name=lb, time=self._LEADERBOARD_TTL)
+
+    def _transaction_log_names(self, recipient, name, delay):
+        """ The global, per key, per key and name, and per key and horizon transaction streams """
+        return [self.transactions_name(),
+                self.transactions_name(write_key=recipient),
+                self.transactions_name(write_key=recipient, name=name),
+                self.transactions_name(write_key=recipient, name=name, delay=delay)]
+
+    def _transaction_logs_pipe(self, pipe, recipient, name, delay, transaction_record, entry_id='*'):
+        """ Record a settlement in the global, per key, per key and name, and per key and horizon streams
+              entry_id :  Stream id of the records (by default assigned by redis)
+        """
+        for ln in self._transaction_log_names(recipient=recipient, name=name, delay=delay):
+            pipe.xadd(name=ln, fields=transaction_record, id=entry_id, maxlen=self.TRANSACTIONS_LIMIT)
+            pipe.expire(name=ln, time=self._TRANSACTIONS_TTL)
+
+    def _settlement_leaderboard_names(self, name, delay, sponsor):
+        """ Leaderboards incremented when settling name at this delay """
+        usual_leaderboard_names = [self.leaderboard_name(),
+                             self.leaderboard_name(name=name),
+                             self.leaderboard_name(name=None, delay=delay),
+                             self.leaderboard_name(name=name, delay=delay)]
+        custom_leaderboard_names = [ self.custom_leaderboard_name(sponsor=None, name=None),  # Overall all time
+                             self.custom_leaderboard_name(sponsor=None, name=None,
+                                                          dt=datetime.datetime.now()),  # This month
+                             self.custom_leaderboard_name(sponsor=sponsor, name=None),
+                             # Sponsor category
+                             self.custom_leaderboard_name(sponsor=sponsor, name=name),
+                             # Sponsor and category
+                             self.custom_leaderboard_name(sponsor=sponsor, dt=datetime.datetime.now()),
+                             # Sponsor and month
+                             self.custom_leaderboard_name(sponsor=sponsor, name=name,
+                                                          dt=datetime.datetime.now())
+                             # Sponsor and category and month
+                             ]
+        leaderboard_names = usual_leaderboard_names
+        # Decide whether we will include certain delays in the leaderboards used for prizes
+        if delay>=self.DELAYS[-1]: # <-- Only include the 1hr ahead predictions
+             leaderboard_names = usual_leaderboard_names + custom_leaderboard_names
+        return list(OrderedDict.fromkeys(leaderboard_names))  # Each leaderboard is incremented once
+
+    def _scripted_settle(self, names, values, budgets, sponsors, retrieved, idempotency_key=None):
+        """ Read, clear and pay each horizon with participants atomically in a server side script
+              The keys of every recipient must be declared to the script, so a horizon whose owners have changed since
+              they were retrieved is declined and tried again with the recipients reported. With an idempotency_key
+              each script marks its horizon as settled, so a retried job does not pay it twice.
+              Returns:  { (name, delay_ndx): summary }
+        """
+        expected = dict()
+        for name in names:
+            for delay_ndx in range(len(self.DELAYS)):
+                participant_set = retrieved[(name, delay_ndx, 'participants')][0]
+                if retrieved[(name, delay_ndx, 'pool')][0] and len(participant_set) > 1:
+                    expected[(name, delay_ndx)] = set(participant_set)
+        summaries = dict()
+        for _ in range(self._SETTLEMENT_ATTEMPTS):
+            if not expected:
+                break
+            settle_pipe = IntentPipeline(self.client)
+            self._scripted_settle_pipe(pipe=settle_pipe, names=names, values=values, budgets=budgets,
+                                       sponsors=sponsors, expected=expected, idempotency_key=idempotency_key)
+            for (name, delay_ndx), (summary,) in settle_pipe.execute().items():
+                if summary[0] == 0:
+                    expected[(name, delay_ndx)].update(summary[1:])
+                else:
+                    del expected[(name, delay_ndx)]
+                    summaries[(name, delay_ndx)] = summary
+
+        for (name, delay_ndx), summary in summaries.items():
+            horizon = self.horizon_name(name=name, delay=self.DELAYS[delay_ndx])
+            if summary[0] == 2:
+                self._settlement_error(horizon=horizon, operation='settle', error='undecodable winning tickets',
+                                       tickets=summary[1:6])
+            elif summary[0] == 1 and summary[4]:
+                self._settlement_error(horizon=horizon, operation='settle', error='leakage in zero sum game')
+        for (name, delay_ndx), recipients in expected.items():
+            self._settlement_error(horizon=self.horizon_name(name=name, delay=self.DELAYS[delay_ndx]),
+                                   operation='settle', error='owners kept changing', attempts=self._SETTLEMENT_ATTEMPTS)
+        return summaries
+
+    def _scripted_settle_pipe(self, pipe, names, values, budgets, sponsors, expected, idempotency_key=None):
+        """ Queue one settlement script per horizon
+              expected :  { (name, delay_ndx): recipients whose keys are declared }
+        """
+        half_winners = int(math.ceil(self.NUM_WINNERS / 2))
+        settlement_time = str(datetime.datetime.now())
+        log_name = self._JOURNAL if self._SETTLEMENT_JOURNAL else self.transactions_name()
+        log_limit = self._JOURNAL_LIMIT if self._SETTLEMENT_JOURNAL else self.TRANSACTIONS_LIMIT
+        for name, budget, sponsor, value in zip(names, budgets, sponsors, values):
+            for delay_ndx, delay in enumerate(self.DELAYS):
+                if (name, delay_ndx) not in expected:
+                    continue
+                horizon = self.horizon_name(name=name, delay=delay)
+                leaderboard_names = self._settlement_leaderboard_names(name=name, delay=delay, sponsor=sponsor)
+                keys = [self._samples_name(name=name, delay=delay), self._sample_owners_name(name=name, delay=delay),
+                        self._BALANCES, self.VOLUMES, self._PARTICIPANT_KEYS, log_name]
+                if idempotency_key is not None:
+                    keys.append(idempotency_key + self.SEP + horizon)  # Marks this horizon of the job as settled
+                keys += leaderboard_names
+                recipient_args = list()
+                for recipient in sorted(expected[(name, delay_ndx)]):
+                    keys.append(self.performance_name(write_key=recipient))
+                    if not self._SETTLEMENT_JOURNAL:
+                        keys += self._transaction_log_names(recipient=recipient, name=name, delay=delay)[1:]
+                    recipient_args += [recipient, self.shash(recipient)]
+                args = [value, budget, self.num_predictions, half_winners, self._PARTICIPATION_INCENTIVE, self.SEP,
+                        settlement_time, delay, name, horizon, sponsor, log_limit, self._TRANSACTIONS_TTL,
+                        self._LEADERBOARD_TTL, self._SETTLED_TTL, len(leaderboard_names),
+                        1 if self._SETTLEMENT_JOURNAL else 0, 0 if idempotency_key is None else 1,
+                        len(self._WINDOWS)] + list(self._WINDOWS) + recipient_args
+                with pipe.intent((name, delay_ndx)) as p:
+                    self._settle_horizon_script(keys=keys, args=args, client=p)
 
     def _zmean_scenarios_percentile(self, percentile_scenarios, included_codes=None):
         """ Each submission has an implicit z-score. Average them. """
-        # On the fly discard legacy scenarios where num_predictions are too large
-        if included_codes:
-            owners_prctls = dict(
-                [(self._scenario_owner(s), self._scenario_percentile(s)) for s in percentile_scenarios if
-                 (self.shash(self._scenario_owner(s)) in included_codes) and self._scenario_percentile(s) < 1])
-        else:
-            owners_prctls = dict(
-                [(self._scenario_owner(s), self._scenario_percentile(s)) for s in percentile_scenarios if
-                 self._scenario_percentile(s) < 1])
-
-        prctls = [p for o, p in owners_prctls.items()]
-        mean_prctl = Rediz.zmean_percentile(prctls)
-
-        if prctls and included_codes is not None and len(prctls) < len(included_codes) and abs(mean_prctl - 0.5) > 1e-6:
-            if True:
-                E = math.exp(8.0 * (mean_prctl - 0.5))
-                missing_prctl = (E / (E + 1))
-                prctls = prctls + [missing_prctl] * (len(included_codes) - len(prctls))
-            return Rediz.zmean_percentile(prctls)
-        else:
-            return mean_prctl
+        return float(self._zmean_scenarios_percentiles(scenario_lists=[percentile_scenarios],
+                                                       included_codes=included_codes)[0])
 
-    def _game_payments(self, pool, participant_set, rewarded_scenarios):
+    def _zmean_scenarios_percentiles(self, scenario_lists, included_codes=None):
+        """ Vectorized _zmean_scenarios_percentile applied to a list of lists of tickets
+               Returns:  np.array with one percentile per list
+        """
+        groups, owner_ndxs, prctls, owners = self._scenario_arrays(scenario_lists)
+        # On the fly discard legacy scenarios where num_predictions are too large, and tickets that cannot be decoded
+        keep = prctls < 1
+        owner_known = np.array([owner is not None for owner in owners], dtype=bool)
+        keep &= owner_known[owner_ndxs] if len(owners) else keep
+        if included_codes:
+            included = set(included_codes)
+            owner_included = np.array([owner is not None and self.shash(owner) in included for owner in owners],
+                                      dtype=bool)
+            keep &= owner_included[owner_ndxs]
+        # One percentile per owner in each list (the last one)
+        kept = np.flatnonzero(keep)[::-1]
+        _, last = np.unique(groups[kept] * max(len(owners), 1) + owner_ndxs[kept], return_index=True)
+        chosen = kept[last]
+        num_expected = len(included_codes) if included_codes is not None else None
+        return self._zmean_percentiles(prctls=prctls[chosen], groups=groups[chosen], num_groups=len(scenario_lists),
+                                       num_expected=num_expected)
+
+    def _game_payments(self, pool, participant_set, rewarded_scenarios, horizon=None):
         if len(rewarded_scenarios) == 0:
             do_carryover = np.random.rand() < 0.00 # For future use
             if do_carryover:
@@ -1890,7 +2664,12 @@ class Rediz(RedizConventions):
                 game_payments = Counter()
         else:
             game_payments = Counter(dict((p, -1.0) for p in participant_set))
-            winners = [self._scenario_owner(ticket) for ticket in rewarded_scenarios]
+            winners = self._scenario_owners(rewarded_scenarios)
+            if any(winner is None for winner in winners):
+                # Compact tickets whose id is missing from participant_keys cannot be paid, so nobody is
+                self._settlement_error(horizon=horizon, operation='settle', error='undecodable winning tickets',
+                                       tickets=[s for s, w in zip(rewarded_scenarios, winners) if w is None][:5])
+                return Counter()
             # n_participants = pool / self.num_predictions
             reward = (1.0 * pool / self.num_predictions) / len(winners)  # Could augment this to use kernel or whatever
             payouts = Counter(dict([(w, reward * c) for w, c in Counter(winners).items()]))
@@ -1913,6 +2692,70 @@ class Rediz(RedizConventions):
         game_payments.update(participation_incentive)
         return game_payments
 
+    # --------------------------------------------------------------------------
+    #            Implementation  (participant ids and compact tickets)
+    # --------------------------------------------------------------------------
+
+    def _participant_id(self, write_key, create=True):
+        """ Small integer interned for write_key (or None if there is none and create=False) """
+        participant_id = self._participant_id_cache.get(write_key)
+        if participant_id is None:
+            participant_id = self.client.hget(self._PARTICIPANT_IDS, write_key)
+            if participant_id is None and create:
+                # The reverse entry is written first. If a concurrent writer wins the candidate is simply never used.
+                candidate = self.client.incr(self._PARTICIPANT_COUNTER)
+                intern_pipe = self.client.pipeline(transaction=True)
+                intern_pipe.hsetnx(self._PARTICIPANT_KEYS, candidate, write_key)
+                intern_pipe.hsetnx(self._PARTICIPANT_IDS, write_key, candidate)
+                intern_pipe.hget(self._PARTICIPANT_IDS, write_key)
+                participant_id = intern_pipe.execute()[-1]
+            if participant_id is not None:
+                self._participant_id_cache[write_key] = participant_id
+                self._participant_key_cache[participant_id] = write_key
+        return participant_id
+
+    def _scenario_tickets(self, write_key):
+        """ Tickets for write_key's scenarios, compact if compact_tickets is set """
+        if self._COMPACT_TICKETS:
+            participant_id = str(self._participant_id(write_key=write_key))
+            return [prefix + participant_id for prefix in self._ticket_prefixes(compact=True)]
+        else:
+            return [prefix + write_key for prefix in self._ticket_prefixes()]
+
+    def _scenario_owners(self, scenarios, parsed=None):
+        """ Write keys owning a list of tickets in either format, with at most one HMGET for ids not yet cached """
+        if parsed is None:
+            parsed = [self._parse_scenario(scenario) for scenario in scenarios]
+        unknown = list(set(owner for _, owner, compact in parsed if compact and owner not in self._participant_key_cache))
+        if unknown:
+            for participant_id, write_key in zip(unknown, self.client.hmget(self._PARTICIPANT_KEYS, unknown)):
+                if write_key is not None:
+                    self._participant_key_cache[participant_id] = write_key
+        return [self._participant_key_cache.get(owner) if compact else owner for _, owner, compact in parsed]
+
+    def _scenario_arrays(self, scenario_lists):
+        """ Decode a list of lists of tickets in one pass
+               Returns:  groups, owner_ndxs, prctls   np.arrays with one entry per ticket
+                         owners                       distinct write_keys indexed by owner_ndxs
+        """
+        scenarios = list(itertools.chain(*scenario_lists))
+        parsed = [self._parse_scenario(scenario) for scenario in scenarios]
+        owner_index = dict()
+        owner_ndxs = np.fromiter((owner_index.setdefault(owner, len(owner_index)) for owner in
+                                  self._scenario_owners(scenarios, parsed=parsed)), dtype=int, count=len(scenarios))
+        prctls = (0.5 + np.fromiter((float(k) for k, _, _ in parsed), dtype=float, count=len(scenarios))) / \
+                 self.NUM_PREDICTIONS
+        groups = np.repeat(np.arange(len(scenario_lists)), [len(s) for s in scenario_lists])
+        return groups, owner_ndxs, prctls, list(owner_index)
+
+    def _decoded_scenarios(self, scenarios):
+        """ Convert compact tickets to the legacy format 0000000k::write_key, which is what callers see
+               Returns:  list aligned with scenarios, with None for compact tickets whose id is unknown
+        """
+        owners = self._scenario_owners(scenarios)
+        return [None if owner is None else self._format_scenario(owner, int(self._parse_scenario(scenario)[0]))
+                for scenario, owner in zip(scenarios, owners)]
+
     # --------------------------------------------------------------------------
     #            Implementation  (getters)
     # --------------------------------------------------------------------------
@@ -2230,6 +3073,8 @@ class Rediz(RedizConventions):
         private_distributions = pipe.execute()
         data = list()
         for distribution in private_distributions:
+            tickets = self._decoded_scenarios([scenario for scenario, _ in distribution])
+            distribution = [(ticket, v) for ticket, (_, v) in zip(tickets, distribution) if ticket is not None]
             if obscure:
                 _data = dict([(self._make_scenario_obscure(scenario), v) for (scenario, v) in distribution])
             else:
@@ -1,4 +1,4 @@
-import re, sys, json, math, time, os, uuid, itertools
+import re, sys, json, time, os, uuid, socket, itertools
 import pymorton
 from itertools import zip_longest
 import numpy as np
@@ -6,6 +6,7 @@ from redis.client import list_or_args
 from typing import List, Union, Any, Optional
 from microconventions import MicroConventions
 from rediz.samplers import exponential_bootstrap
+from rediz.utilities import BoundedLRU, shard_of
 
 KeyList   = List[Optional[str]]
 NameList  = List[Optional[str]]
@@ -15,17 +16,34 @@ DelayList = List[Optional[int]]
 
 SEP = "::"
 
+# Storage cost model constants
+BLOAT = 3
+DOLLAR = 10000.  # Credits per dollar
+COST_PER_MONTH_10MB = 1. * DOLLAR
+COST_PER_MONTH_1b = COST_PER_MONTH_10MB / (10 * 1000 * 1000)
+SECONDS_PER_DAY = 60. * 60. * 24.
+SECONDS_PER_MONTH = SECONDS_PER_DAY * 30.
+FIXED_COST_bytes = 10  # Overhead
+FLOAT_SIZE = sys.getsizeof(51234134.12434)
+
 #TODO: move to microconventions
 REDIZ_CONVENTIONS_ARGS = ('history_len', 'delays','lagged_len', 'max_ttl', 'error_ttl',
                           'transactions_ttl','error_limit', 'windows','obscurity',
-                          'delay_grace','instant_recall')
+                          'delay_grace','instant_recall','scripted_writes','streams_support',
+                          'streams_probe_interval','distribution_ttl_refresh','async_settlement',
+                          'scripted_settlement','settlement_journal','compact_tickets',
+                          'balance_cache_ttl','sorted_promises','promise_shards','promise_notify')
 MICRO_CONVENTIONS_ARGS = ('num_predictions','min_len','min_balance','delays')
 
 class RedizConventions(MicroConventions):
 
     def __init__(self,history_len=None, lagged_len=None, delays=None, max_ttl=None, error_ttl=None, transactions_ttl=None,
                   error_limit=None, num_predictions=None, windows=None,
-                  obscurity=None, delay_grace=None, instant_recall=None, min_len=None, min_balance=None ):
+                  obscurity=None, delay_grace=None, instant_recall=None, min_len=None, min_balance=None,
+                  scripted_writes=None, streams_support=None, streams_probe_interval=None,
+                  distribution_ttl_refresh=None, async_settlement=None, scripted_settlement=None,
+                  settlement_journal=None, compact_tickets=None, balance_cache_ttl=None,
+                  sorted_promises=None, promise_shards=None, promise_notify=None ):
 
         super().__init__(min_len=min_len,min_balance=min_balance,num_predictions=num_predictions,delays=delays)
 
@@ -35,6 +53,7 @@ class RedizConventions(MicroConventions):
         self.COPY_SEP      = self.SEP + "copy" + self.SEP
         self.CANCEL_SEP    = self.SEP + "cancel" + self.SEP
         self.PREDICTION_SEP = self.SEP + "prediction" + self.SEP
+        self.TICKET_SEP = ":"  # Compact tickets are k:id whereas legacy tickets are 0000000k::write_key
 
 
         # Transparent but parametrized
@@ -73,6 +92,11 @@ class RedizConventions(MicroConventions):
         self._BLACKLIST = self._obscurity + "blacklist"  # List of discarded keys
         self._NAMES = self._obscurity + "names"  # Redundant set of all names (needed for random sampling when collecting garbage)
         self._PROMISES = self._obscurity + "promises" + self.SEP  # Prefixes queues of operations that are indexed by epoch second
+        self._PROMISE_SCHEDULE = self._obscurity + "promise_schedule"  # Single zset of promises scored by due time, used when sorted_promises=True
+        self._PROMISE_NOTIFICATIONS = self._obscurity + "promise_notifications"  # Stream of due times, read by PromiseScheduler when promise_notify=True
+        self._PROMISE_STATS = self._obscurity + "promise_stats"  # Counters of claimed, delivered and dropped promises
+        self._PROMISE_LATENESS = self._obscurity + "promise_lateness"  # Histogram of seconds between due time and delivery
+        self._PROMISE_SHARD_COUNT = self._obscurity + "promise_shards"  # Number of promise shards, which producers and workers must agree on
         self._CANCELLATIONS = self._obscurity + "cancellations" + self.SEP  # Prefixes queues of operations that are indexed by minute
         self._POINTER = self._obscurity + "pointer"  # A convention used in history stream
         self._BALANCES = self._obscurity + "balances"  # Hash of all balances attributed to write_keys
@@ -87,6 +111,13 @@ class RedizConventions(MicroConventions):
         self._REPOS = self._obscurity + "repos"
         self._AWARDS = self._obscurity + "awards"
         self._EMAILS = self._obscurity + "emails"
+        self._SETTLEMENT = self._obscurity + "settlement"  # Queue of settlement jobs, used when async_settlement=True
+        self._SETTLED = self._obscurity + "settled" + self.SEP  # Prefixes idempotency keys of completed settlement jobs
+        self._SETTLEMENT_ERRORS = self._obscurity + "settlement_errors"  # Horizons that could not be settled, for admins
+        self._JOURNAL = self._obscurity + "journal"  # Settlement records, later fanned out to transaction streams
+        self._PARTICIPANT_IDS = self._obscurity + "participant_ids"  # Map from write_key to small integer id used in compact tickets
+        self._PARTICIPANT_KEYS = self._obscurity + "participant_keys"  # Reverse map from id to write_key
+        self._PARTICIPANT_COUNTER = self._obscurity + "participant_counter"  # Last id handed out
 
         # Other implementation config
         self._CANCEL_GRACE = 45
@@ -94,6 +125,36 @@ class RedizConventions(MicroConventions):
         self._DEFAULT_MODEL_STD = 1.0  # Noise added for self-prediction
         self._WINDOWS = windows  # Sizes of neighbourhoods around truth used in countback ... don't make too big or it hits performance
         self._INSTANT_RECALL = instant_recall or False
+        self._SCRIPTED_WRITES = scripted_writes or False  # Use server side scripts (EVALSHA) in place of long pipelines
+        self._STREAMS_SUPPORT = streams_support  # Override for redis streams capability. None means probe redis.
+        self._STREAMS_PROBE_INTERVAL = streams_probe_interval  # Seconds before re-probing streams support. None means never.
+        self._streams_probe_result = None
+        self._streams_probe_time = None
+        self._DISTRIBUTION_TTL_REFRESH = distribution_ttl_refresh  # Seconds between TTL refreshes of predictions/samples on set. None means every set.
+        self._distribution_refreshes = BoundedLRU(maxsize=100000)  # Last refresh time by name
+        self._ASYNC_SETTLEMENT = async_settlement or False  # Queue settlement for admin_settlement() workers instead of clearing in set()
+        self._SETTLED_TTL = 24 * 60 * 60  # How long idempotency keys of settlement jobs are kept
+        self._SCRIPTED_SETTLEMENT = scripted_settlement or False  # Clear each horizon atomically in a server side script
+        self._SETTLEMENT_ATTEMPTS = 3  # Scripted clearings of a horizon whose owners change while it is being settled
+        self._SETTLEMENT_JOURNAL = settlement_journal or False  # Write settlement records once, to the journal
+        self._JOURNAL_GROUP = "fanout"  # Consumer group that copies journal records into transaction streams
+        self._JOURNAL_CLAIM_IDLE = 60  # Seconds after which entries left pending by another consumer are claimed
+        self._JOURNAL_LIMIT = 100000
+        self._JOURNAL_ALERT = 0.8  # Fraction of _JOURNAL_LIMIT entries not yet fanned out at which admin_transactions alerts
+        self._journal_group_created = False
+        self._COMPACT_TICKETS = compact_tickets or False  # Submit scenarios as k:id tickets rather than 0000000k::write_key
+        self._participant_id_cache = BoundedLRU(maxsize=100000)  # write_key -> id (ids are never reassigned)
+        self._participant_key_cache = BoundedLRU(maxsize=100000)  # id -> write_key
+        self._zcurve_names = BoundedLRU(maxsize=10000)  # (sorted names, delay) -> name of derived z-curve stream
+        self._ticket_prefix_cache = dict()  # (num_predictions, compact) -> ticket prefixes
+        self._BALANCE_CACHE_TTL = balance_cache_ttl  # Seconds that balances are cached for bankruptcy checks on submission. None means no caching.
+        self._balance_cache = BoundedLRU(maxsize=100000)  # write_key -> (time, balance)
+        self._SORTED_PROMISES = sorted_promises or False  # Schedule promises in one zset and claim them by due time
+        self._PROMISE_SHARDS = int(promise_shards or 1)  # Promises are partitioned by consistent hash of the target name
+        self._promise_shards_registered = False
+        self._PROMISE_NOTIFY = promise_notify or False  # Announce due times of new promises so that schedulers need not poll
+        self._NOTIFICATIONS_LIMIT = 10000  # Approximate maximum length of the notification stream
+        self._LATENESS_BUCKETS = [0.5, 1, 2, 5, 10, 30, 60]  # Upper edges of the lateness histogram, in seconds
         self._MAX_TTL = int( max_ttl or 96*60*60 ) # Maximum TTL, useful for testing
         self._TRANSACTIONS_TTL = int( transactions_ttl or (20 * 60) )  # How long to keep transactions stream for inactive write_keys
         self._LEADERBOARD_TTL  = int( 24 * (60 * 60)*60 )  # How long to keep transactions stream for inactive write_keys
@@ -345,9 +406,35 @@ class RedizConventions(MicroConventions):
     def _cancellation_queue_name(self, epoch_seconds):
         return self._CANCELLATIONS + str(int(epoch_seconds))
 
-    def _promise_queue_name(self, epoch_seconds):
+    def _promise_queue_name(self, epoch_seconds, shard=0):
+        if shard:
+            return self._PROMISES + str(shard) + self.SEP + str(int(epoch_seconds))
         return self._PROMISES + str(int(epoch_seconds))
 
+    def _promise_schedule_name(self, shard=0):
+        return self._PROMISE_SCHEDULE + self.SEP + str(shard) if shard else self._PROMISE_SCHEDULE
+
+    def _lateness_bucket(self, seconds):
+        """ Label of the histogram bucket for a delivery this many seconds after its due time """
+        for edge in self._LATENESS_BUCKETS:
+            if seconds <= edge:
+                return str(edge)
+        return 'inf'
+
+    def _promise_shard(self, name):
+        """ Shard responsible for delivering promises whose target is name (shard 0 uses the unsharded keys) """
+        return shard_of(name, self._PROMISE_SHARDS) if self._PROMISE_SHARDS > 1 else 0
+
+    def _journal_consumer_name(self):
+        """ Each process reads the journal as a consumer of its own """
+        return socket.gethostname() + self.SEP + str(os.getpid())
+
+    def _settlement_processing_name(self, worker_id):
+        return self._SETTLEMENT + self.SEP + "processing" + self.SEP + str(worker_id)
+
+    def _settled_name(self, job_id):
+        return self._SETTLED + job_id
+
     def _sample_owners_name(self, name, delay):
         return self._OWNERS + self._samples_name(name=name,delay=delay)
 
@@ -361,18 +448,41 @@ class RedizConventions(MicroConventions):
         """ A "ticket" indexed by write_key and an index from 0 to self.NUM_PREDiCTIONS-1 """
         return str(k).zfill(8) + self.SEP + write_key
 
+    def _ticket_prefixes(self, compact=False):
+        """ Cached ticket prefixes "0000000k::" (or "k:" if compact) for k in range(num_predictions) """
+        key = (self.num_predictions, compact)
+        prefixes = self._ticket_prefix_cache.get(key)
+        if prefixes is None:
+            if compact:
+                prefixes = [str(k) + self.TICKET_SEP for k in range(self.num_predictions)]
+            else:
+                prefixes = [str(k).zfill(8) + self.SEP for k in range(self.num_predictions)]
+            self._ticket_prefix_cache[key] = prefixes
+        return prefixes
+
+    def _compact_scenario(self, participant_id, k):
+        """ A shorter "ticket" indexed by the interned id of the write_key """
+        return str(k) + self.TICKET_SEP + str(participant_id)
+
+    def _parse_scenario(self, scenario):
+        """ Returns k, owner, compact  where owner is a write_key for legacy tickets and an id for compact tickets """
+        k, _, owner = scenario.partition(self.TICKET_SEP)
+        if owner[:len(self.TICKET_SEP)] == self.TICKET_SEP:
+            return k, owner[len(self.TICKET_SEP):], False
+        return k, owner, True
+
     def _make_scenario_obscure(self, ticket):
         """ Change write_key to a hash of write_key """
         parts = ticket.split(self.SEP)
         return parts[0] + self.SEP + self.shash(parts[1])
 
     def _scenario_percentile(self, scenario):
-        """ Extract scenario percentile from scenario string """
-        return (0.5 + float(scenario.split(self.SEP)[0])) / self.NUM_PREDICTIONS
+        """ Extract scenario percentile from scenario string (either format) """
+        return (0.5 + float(scenario.partition(self.TICKET_SEP)[0])) / self.NUM_PREDICTIONS
 
     def _scenario_owner(self, scenario):
-        """ Extract owner of a scenario from scenario string """
-        return scenario.split(self.SEP)[1]
+        """ Extract owner of a legacy scenario from scenario string (an id, for compact tickets) """
+        return self._parse_scenario(scenario)[1]
 
     def _prediction_promise(self, target, delay, predictions_name):
         """ Format for a promise that sits in a promise queue waiting to be inserted into samples::1::name, for instance """
@@ -424,34 +534,79 @@ class RedizConventions(MicroConventions):
     def _promise_ttl(self):
         return max(self.DELAYS) + self._DELAY_GRACE
 
+    def _promise_queue_ttl(self, ttl):
+        """ Per-second promise queues outlive ttl by a further grace period, so that _claim_promises can count
+            (and remove) those left undelivered in the 2*_DELAY_GRACE+1 seconds after they are due """
+        return ttl + self._DELAY_GRACE + 2
+
     def _cost_based_history_len(self, value):
         return self.HISTORY_LEN    # TODO: Could be refined
 
     def _cost_based_lagged_len(self, value ):
-        t = time.time()
-        sz = (sys.getsizeof(value) + sys.getsizeof(t)) + 10
-        min_sz = sys.getsizeof(51234134.12434) + sys.getsizeof(t) + 10
-        return int( math.ceil( self.LAGGED_LEN*(min_sz/sz) ) )
+        return int( self._cost_based_lagged_lens([value])[0] )
+
+    def _cost_based_lagged_lens(self, values):
+        """ Vectorized _cost_based_lagged_len, returns np.array of int """
+        sz = np.array([sys.getsizeof(value) for value in values]) + (FLOAT_SIZE + 10)
+        return np.ceil(self.LAGGED_LEN * ((2 * FLOAT_SIZE + 10) / sz)).astype(int)
 
     def _cost_based_ttl(self, value, budget):
         """ Time to live for name implies a minimal update frequency """
         return RedizConventions._value_ttl(value=value, budget=budget, num_delays=len(self.DELAYS), max_ttl=self._MAX_TTL )
 
+    def _cost_based_ttls(self, values, budgets):
+        """ Vectorized _cost_based_ttl, returns np.array of int """
+        return RedizConventions._value_ttls(values=values, budgets=budgets, num_delays=len(self.DELAYS), max_ttl=self._MAX_TTL)
+
     def _cost_based_distribution_ttl(self,budget):
         """ Time to live for samples ... mostly budget independent """
         return 60*60*24*3
         #return int( max(self.DELAYS)+self._DELAY_GRACE+60+budget )
 
+    def _distribution_ttl_names(self, name):
+        """ Samples, owners and predictions whose TTL should be refreshed by this set (possibly none)
+              The refresh is only remembered once the write succeeds, see _record_distribution_refreshes
+        """
+        if self._DISTRIBUTION_TTL_REFRESH is not None:
+            last_refresh = self._distribution_refreshes.get(name)
+            if last_refresh is not None and time.time() - last_refresh < self._DISTRIBUTION_TTL_REFRESH:
+                return list()
+        distribution_names = list()
+        for delay in self.DELAYS:
+            distribution_names.extend([self._samples_name(name=name, delay=delay),
+                                       self._sample_owners_name(name=name, delay=delay),
+                                       self._predictions_name(name=name, delay=delay)])
+        return distribution_names
+
+    def _record_distribution_refreshes(self, names):
+        """ Remember that the distribution TTLs of names were refreshed by a write that has executed """
+        if self._DISTRIBUTION_TTL_REFRESH is not None:
+            now = time.time()
+            for name in names:
+                self._distribution_refreshes[name] = now
+
     # --------------------------------------------------------------------------
     #            Redis version/capability inference
     # --------------------------------------------------------------------------
 
+    @property
+    def streams_support(self):
+        """ True if redis streams are supported. Probed once per client, unless overridden or re-probing is enabled """
+        if self._STREAMS_SUPPORT is not None:
+            return self._STREAMS_SUPPORT
+        now = time.time()
+        if self._streams_probe_time is None or (self._STREAMS_PROBE_INTERVAL is not None and
+                                                now - self._streams_probe_time > self._STREAMS_PROBE_INTERVAL):
+            self._streams_probe_result = self._streams_support()
+            self._streams_probe_time = now
+        return self._streams_probe_result
+
     def _streams_support(self):
         # Returns True if redis streams are supported by the redis client
-        # (Note that streams are not supported on fakeredis)
+        # (Note that streams are not supported on older fakeredis)
         try:
             record_of_test = {"time": str(time.time())}
-            self.client.xadd(name='e5312d16-dc87-46d7-a2e5-f6a6225e63a5', fields=record_of_test)
+            self.client.xadd(name='e5312d16-dc87-46d7-a2e5-f6a6225e63a5', fields=record_of_test, maxlen=1)
             return True
         except:
             return False
@@ -506,6 +661,29 @@ class RedizConventions(MicroConventions):
     #    else:
     #        return 0.5
 
+    @staticmethod
+    def _zmean_percentiles(prctls, groups, num_groups, num_expected=None):
+        """ Vectorized zmean_percentile applied to many groups of percentiles at once
+               prctls        np.array of percentiles in (0,1)
+               groups        np.array of group indexes, same length
+               num_expected  If supplied, groups with fewer percentiles than this are padded with a guess
+                             at the missing percentiles, leaning the same way as those present
+               Returns:  np.array of length num_groups (0.5 for empty groups)
+        """
+        from scipy.special import ndtri, ndtr
+        z_sums = np.bincount(groups, weights=ndtri(prctls), minlength=num_groups)
+        counts = np.bincount(groups, minlength=num_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(counts > 0, ndtr(z_sums / counts), 0.5)
+        if num_expected is not None:
+            padded = (counts > 0) & (counts < num_expected) & (np.abs(means - 0.5) > 1e-6)
+            if np.any(padded):
+                E = np.exp(8.0 * (means - 0.5))
+                missing_z = ndtri(E / (E + 1))
+                padded_means = ndtr((z_sums + (num_expected - counts) * missing_z) / num_expected)
+                means = np.where(padded, padded_means, means)
+        return means
+
     # --------------------------------------------------------------------------
     #           Z-order curves  TODO: Moved all this to MicroConventions
     # --------------------------------------------------------------------------
@@ -562,6 +740,40 @@ class RedizConventions(MicroConventions):
     #    prtcls = [ v/SCALE for v in values ]
     #    return prtcls
 
+    def zcurve_name(self, names, delay):
+        """ Cached version of MicroConventions.zcurve_name """
+        key = (tuple(sorted(names)), delay)
+        zname = self._zcurve_names.get(key)
+        if zname is None:
+            zname = super().zcurve_name(names=list(key[0]), delay=delay)
+            self._zcurve_names[key] = zname
+        return zname
+
+    @staticmethod
+    def _morton_interleave(ints):
+        """ Vectorized pymorton.interleave of the rows of an integer array with 2 or 3 columns """
+        ints = np.asarray(ints, dtype=np.uint64)
+        dim = ints.shape[1]
+        num_bits = int(RedizConventions.morton_scale(dim)).bit_length() - 1
+        interleaved = np.zeros(ints.shape[0], dtype=np.uint64)
+        for bit in range(num_bits):
+            for d in range(dim):
+                interleaved |= ((ints[:, d] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(bit * dim + d)
+        return interleaved
+
+    @staticmethod
+    def _to_zcurves(prctls):
+        """ Vectorized to_zcurve for an array of shape (n, dim) where dim is 1, 2 or 3 """
+        from scipy.special import ndtri
+        prctls = np.asarray(prctls, dtype=float)
+        dim = prctls.shape[1]
+        if dim == 1:
+            return ndtri(prctls[:, 0])
+        SCALE = RedizConventions.morton_scale(dim)
+        int_prctls = np.floor(prctls * SCALE).astype(np.uint64)
+        zpercentiles = RedizConventions._morton_interleave(int_prctls) / RedizConventions.morton_large(dim)
+        return ndtri(zpercentiles)
+
 
 
     # --------------------------------------------------------------------------
@@ -579,17 +791,14 @@ class RedizConventions(MicroConventions):
     @staticmethod
     def _value_ttl(value, budget, num_delays, max_ttl ):
         # Assign a time to live that won't break the bank
+        return int( RedizConventions._value_ttls(values=[value], budgets=[budget], num_delays=num_delays, max_ttl=max_ttl)[0] )
+
+    @staticmethod
+    def _value_ttls(values, budgets, num_delays, max_ttl):
+        """ Vectorized _value_ttl, returns np.array of int """
         REPLICATION = 1 + 2 * num_delays
-        BLOAT = 3
-        DOLLAR = 10000.  # Credits per dollar
-        COST_PER_MONTH_10MB = 1. * DOLLAR
-        COST_PER_MONTH_1b = COST_PER_MONTH_10MB / (10 * 1000 * 1000)
-        SECONDS_PER_DAY = 60. * 60. * 24.
-        SECONDS_PER_MONTH = SECONDS_PER_DAY * 30.
-        FIXED_COST_bytes = 10  # Overhead
-        num_bytes = sys.getsizeof(value)
+        num_bytes = np.array([sys.getsizeof(value) for value in values])
         credits_per_month = REPLICATION * BLOAT * (num_bytes + FIXED_COST_bytes) * COST_PER_MONTH_1b
-        ttl_seconds = int(math.ceil(SECONDS_PER_MONTH / credits_per_month))
-        ttl_seconds = budget * ttl_seconds
-        ttl_seconds = min(ttl_seconds, max_ttl)
-        return int( ttl_seconds )
+        ttl_seconds = np.ceil(SECONDS_PER_MONTH / credits_per_month).astype(int)
+        ttl_seconds = np.array(budgets) * ttl_seconds
+        return np.minimum(ttl_seconds, max_ttl).astype(int)
@@ -0,0 +1,31 @@
+from contextlib import contextmanager
+
+# Pipeline builder that remembers which results belong to which logical operation ("intent"), so that callers
+# can unpack pipelined results by key rather than relying on every intent issuing the same number of commands.
+
+
+class IntentPipeline(object):
+
+    def __init__(self, client, transaction=True):
+        self.pipe = client.pipeline(transaction=transaction)
+        self.slices = dict()
+
+    def __len__(self):
+        return len(self.pipe)
+
+    def __getattr__(self, item):
+        # Commands issued outside of an intent are still sent, but their results are not recorded
+        return getattr(self.pipe, item)
+
+    @contextmanager
+    def intent(self, key):
+        """ Commands queued on the yielded (raw) pipeline inside this block are attributed to key """
+        assert key not in self.slices, "Intent keys must be unique within a pipeline"
+        start = len(self.pipe)
+        yield self.pipe
+        self.slices[key] = (start, len(self.pipe))
+
+    def execute(self, raise_on_error=True):
+        """ Returns { key: [ results ] } for every recorded intent """
+        results = self.pipe.execute(raise_on_error=raise_on_error) if len(self.pipe) else list()
+        return dict((key, results[start:end]) for key, (start, end) in self.slices.items())
@@ -0,0 +1,204 @@
+import threading, time
+from collections import deque
+import numpy as np
+from rediz.client import Rediz
+
+# PROMISE SCHEDULER
+# -----------------
+# A long running replacement for calling admin_promises() and admin_cancellations() in a sleep loop. Due times are
+# kept in a hierarchical timer wheel, and the scheduler blocks on the notification stream (XREAD BLOCK) until the
+# next due time, so promises are delivered as soon as they fall due and an idle scheduler makes almost no requests.
+# Writers must be created with promise_notify=True for their promises to be announced. Anything they don't announce
+# is still delivered within max_sleep seconds.
+
+PROMISES_TASK = 'promises'
+CANCELLATIONS_TASK = 'cancellations'
+
+
+class TimerWheel(object):
+    """ Hierarchical timer wheel of (due, task) entries, where due is an epoch second
+          Level k has `slots` buckets each spanning slots**k seconds. Entries fall a level each time the wheel turns
+          into the span of their bucket, so add() and advance() cost O(1) per entry regardless of how far ahead it is.
+    """
+
+    def __init__(self, now, slots=64, levels=3):
+        self.slots = slots
+        self.levels = levels
+        self.current = int(now)  # Next second to be processed
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.overflow = set()  # Beyond the span of the top level
+        self.expired = set()  # Added after their due second was processed
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, due, task):
+        """ Schedule task at epoch second due (repeats of the same entry are ignored) """
+        entry = (int(due), task)
+        bucket = self.expired if entry[0] < self.current else self._bucket(entry[0])
+        if entry not in bucket:
+            bucket.add(entry)
+            self.size += 1
+
+    def next_due(self):
+        """ Earliest due time, or None if the wheel is empty """
+        if self.expired:
+            return min(due for due, _ in self.expired)
+        if not self.size:
+            return None
+        for level in range(self.levels):
+            start = (self.current // self.slots ** level) % self.slots
+            for bucket in self.wheels[level][start:]:
+                if bucket:
+                    return min(due for due, _ in bucket)
+        return min(due for due, _ in self.overflow)
+
+    def advance(self, now):
+        """ Remove and return entries due at or before now, earliest first """
+        fired = list(self.expired)
+        self.expired = set()
+        now = int(now)
+        if self.size == len(fired):
+            self.current = max(self.current, now + 1)  # Nothing else to visit
+        while self.current <= now:
+            bucket = self.wheels[0][self.current % self.slots]
+            fired.extend(bucket)
+            bucket.clear()
+            self.current += 1
+            self._cascade()
+        self.size -= len(fired)
+        return sorted(fired)
+
+    def _bucket(self, due):
+        for level in range(self.levels):
+            if due // self.slots ** (level + 1) == self.current // self.slots ** (level + 1):
+                return self.wheels[level][(due // self.slots ** level) % self.slots]
+        return self.overflow
+
+    def _cascade(self):
+        """ Re-file entries from the higher level buckets the wheel has just turned into """
+        for level in range(self.levels, 0, -1):
+            if self.current % self.slots ** level == 0:
+                if level == self.levels:
+                    entries, self.overflow = self.overflow, set()
+                else:
+                    bucket = self.wheels[level][(self.current // self.slots ** level) % self.slots]
+                    entries = set(bucket)
+                    bucket.clear()
+                for entry in entries:
+                    self._bucket(entry[0]).add(entry)
+
+
+class PromiseScheduler(Rediz):
+
+    def __init__(self, max_sleep=5.0, lateness_len=10000, **kwargs):
+        """
+            max_sleep      Longest wait between wake ups, bounding the delay of promises that were not announced
+            lateness_len   Number of recent delivery latenesses kept for percentiles
+        """
+        super().__init__(**kwargs)
+        self._MAX_SLEEP = max_sleep
+        self._CANCELLATION_INTERVAL = max(1, self._CANCEL_GRACE // 3)  # Queues remain eligible for _CANCEL_GRACE seconds
+        now = time.time()
+        self._wheel = TimerWheel(now=now)
+        self._wheel.add(now, CANCELLATIONS_TASK)
+        self._notifications_id = self._last_notification_id()  # Earlier announcements are covered by the first delivery
+        self._promises_time = 0.0  # Last delivery attempt, so anything already due is delivered by the first step
+        self._lateness = deque(maxlen=lateness_len)
+        self._lateness_count = 0
+        self._lateness_total = 0.0
+        self._lateness_max = 0.0
+        self._scheduler_stopped = threading.Event()
+
+    # --------------------------------------------------------------------------
+    #            Public interface
+    # --------------------------------------------------------------------------
+
+    def run(self, duration=None):
+        """ Deliver promises and cancellations as they fall due, until stop() is called or duration seconds pass """
+        self._scheduler_stopped.clear()
+        until = None if duration is None else time.time() + duration
+        while not self._scheduler_stopped.is_set() and (until is None or time.time() < until):
+            self.step(max_sleep=None if until is None else max(until - time.time(), 0))
+
+    def stop(self):
+        """ Ask run() to return after the current wait """
+        self._scheduler_stopped.set()
+
+    def step(self, max_sleep=None):
+        """ Wait for the next due time (or a notification), then perform whatever has fallen due
+               Returns:  { task: result } for the tasks that were performed
+        """
+        next_due = self._wheel.next_due()
+        timeout = self._MAX_SLEEP if max_sleep is None else min(self._MAX_SLEEP, max_sleep)
+        if next_due is not None:
+            timeout = min(timeout, max(next_due - time.time(), 0))
+        self._receive_notifications(timeout=timeout)
+
+        now = time.time()
+        fired = self._wheel.advance(now)
+        announced = [due for due, task in fired if task == PROMISES_TASK]
+        safety_net = now - self._promises_time >= self._MAX_SLEEP  # For promises that were never announced
+        results = dict()
+        if announced or safety_net:
+            results[PROMISES_TASK] = self._deliver_promises()
+            if announced and results[PROMISES_TASK]:
+                # Only announced due times that were met by a delivery say anything about lateness
+                delivered = time.time()
+                self._record_lateness([delivered - due for due in announced])
+        if any(task == CANCELLATIONS_TASK for _, task in fired):
+            results[CANCELLATIONS_TASK] = self.admin_cancellations(with_report=True)
+            self._wheel.add(now + self._CANCELLATION_INTERVAL, CANCELLATIONS_TASK)
+        return results
+
+    def get_lateness_stats(self):
+        """ Seconds between due times and the completion of their delivery """
+        recent = np.array(self._lateness) if self._lateness else np.zeros(1)
+        return {"count": self._lateness_count,
+                "mean": self._lateness_total / self._lateness_count if self._lateness_count else 0.0,
+                "max": self._lateness_max,
+                "p50": float(np.percentile(recent, 50)),
+                "p99": float(np.percentile(recent, 99)),
+                "pending": len(self._wheel)}
+
+    # --------------------------------------------------------------------------
+    #            Implementation
+    # --------------------------------------------------------------------------
+
+    def _last_notification_id(self):
+        if not self.streams_support:
+            return '0-0'
+        latest = self.client.xrevrange(self._PROMISE_NOTIFICATIONS, count=1)
+        return latest[0][0] if latest else '0-0'
+
+    def _receive_notifications(self, timeout):
+        """ Block for up to timeout seconds waiting for announced due times, and add them to the wheel """
+        if not self.streams_support:
+            time.sleep(timeout)
+            return 0
+        block = max(1, int(1000 * timeout)) if timeout > 0 else None  # block=0 would wait forever
+        response = self.client.xread({self._PROMISE_NOTIFICATIONS: self._notifications_id}, count=1000, block=block)
+        num_dues = 0
+        for _, messages in response or []:
+            for message_id, fields in messages:
+                self._notifications_id = message_id
+                for due in fields.get("dues", "").split(","):
+                    if due:
+                        self._wheel.add(int(due), PROMISES_TASK)
+                        num_dues += 1
+        return num_dues
+
+    def _deliver_promises(self):
+        self._promises_time = time.time()
+        if self._PROMISE_SHARDS > 1:
+            return self.admin_sharded_promises()
+        return self.admin_promises()
+
+    def _record_lateness(self, lateness):
+        for seconds in lateness:
+            seconds = max(seconds, 0.0)
+            self._lateness.append(seconds)
+            self._lateness_count += 1
+            self._lateness_total += seconds
+            self._lateness_max = max(self._lateness_max, seconds)
@@ -0,0 +1,344 @@
+# Server side (Lua) equivalents of some pipelined operations
+# These are registered with redis.Script objects so they are invoked by EVALSHA, and are only used when
+# the corresponding opt-in flag is passed to Rediz (e.g. scripted_writes=True)
+
+
+# --------------------------------------------------------------------------
+#            Set
+# --------------------------------------------------------------------------
+
+# Server side version of Rediz._modify_page
+# If sorted_promises is '1' each promise queue is the promise schedule, and promises are added with their due times
+#   KEYS:  name, copy, lagged values, lagged times, history, distribution names ..., promise queues ...
+#   ARGV:  value, ttl, promise_ttl, distribution_ttl, num_distribution, num_queues, storage, time, lag_len,
+#          history_len, sorted_promises, queue_ttl, promises ..., due times ..., history fields ...
+MODIFY_PAGE_SCRIPT = """
+local value = ARGV[1]
+local ttl = tonumber(ARGV[2])
+local promise_ttl = tonumber(ARGV[3])
+local distribution_ttl = tonumber(ARGV[4])
+local num_distribution = tonumber(ARGV[5])
+local num_queues = tonumber(ARGV[6])
+local storage = ARGV[7]
+local sorted_promises = ARGV[11] == '1'
+local queue_ttl = tonumber(ARGV[12])
+
+redis.call('SET', KEYS[1], value, 'EX', ttl)
+redis.call('SET', KEYS[2], value, 'EX', promise_ttl)
+
+for i = 1, num_distribution do
+    redis.call('EXPIRE', KEYS[5 + i], distribution_ttl)
+end
+
+if storage == 'lags' then
+    local lag_len = tonumber(ARGV[9])
+    redis.call('LPUSH', KEYS[3], value)
+    redis.call('LPUSH', KEYS[4], ARGV[8])
+    redis.call('LTRIM', KEYS[3], 0, lag_len)
+    redis.call('LTRIM', KEYS[4], 0, lag_len)
+    redis.call('EXPIRE', KEYS[3], ttl)
+    redis.call('EXPIRE', KEYS[4], ttl)
+elseif storage == 'history' then
+    local fields = {}
+    for i = 13 + 2 * num_queues, #ARGV do
+        fields[#fields + 1] = ARGV[i]
+    end
+    redis.call('XADD', KEYS[5], '*', unpack(fields))
+    redis.call('XTRIM', KEYS[5], 'MAXLEN', tonumber(ARGV[10]))
+    redis.call('EXPIRE', KEYS[5], ttl)
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+
+for i = 1, num_queues do
+    local queue = KEYS[5 + num_distribution + i]
+    if sorted_promises then
+        redis.call('ZADD', queue, ARGV[12 + num_queues + i], ARGV[12 + i])
+    else
+        redis.call('SADD', queue, ARGV[12 + i])
+        redis.call('EXPIRE', queue, queue_ttl)
+    end
+end
+return 1
+"""
+
+
+# --------------------------------------------------------------------------
+#            Promises
+# --------------------------------------------------------------------------
+
+# Server side delivery of a 'predict' promise in Rediz.admin_promises: copies the individual predictions into
+# the samples and adds their owners, without the scenarios leaving the server. Compact tickets k:id are decoded
+# using the participant_keys hash. Returns the number of changed samples plus the number of new owners.
+#   KEYS:  individual predictions, samples, sample owners, participant_keys
+#   ARGV:  sep, ticket_sep, distribution_ttl
+DELIVER_PREDICTIONS_SCRIPT = """
+local sep = ARGV[1]
+local ticket_sep = ARGV[2]
+local distribution_ttl = ARGV[3]
+local scenarios = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+if #scenarios == 0 then
+    return 0
+end
+
+local changed = 0
+local batch = {}
+local owners = {}
+local is_owner = {}
+local ids = {}
+local is_id = {}
+for i = 1, #scenarios, 2 do
+    local ticket = scenarios[i]
+    batch[#batch + 1] = scenarios[i + 1]
+    batch[#batch + 1] = ticket
+    if #batch >= 1000 then
+        changed = changed + redis.call('ZADD', KEYS[2], 'CH', unpack(batch))
+        batch = {}
+    end
+    local at = string.find(ticket, sep, 1, true)
+    if at then
+        local owner = string.sub(ticket, at + string.len(sep))
+        if not is_owner[owner] then
+            is_owner[owner] = true
+            owners[#owners + 1] = owner
+        end
+    else
+        local id = string.sub(ticket, string.find(ticket, ticket_sep, 1, true) + string.len(ticket_sep))
+        if not is_id[id] then
+            is_id[id] = true
+            ids[#ids + 1] = id
+        end
+    end
+end
+if #batch > 0 then
+    changed = changed + redis.call('ZADD', KEYS[2], 'CH', unpack(batch))
+end
+
+if #ids > 0 then
+    local decoded = redis.call('HMGET', KEYS[4], unpack(ids))
+    for j = 1, #ids do
+        local owner = decoded[j]
+        if owner and not is_owner[owner] then
+            is_owner[owner] = true
+            owners[#owners + 1] = owner
+        end
+    end
+end
+if #owners > 0 then
+    changed = changed + redis.call('SADD', KEYS[3], unpack(owners))
+    redis.call('EXPIRE', KEYS[3], distribution_ttl)
+end
+redis.call('EXPIRE', KEYS[2], distribution_ttl)
+return changed
+"""
+
+
+# --------------------------------------------------------------------------
+#            Settlement
+# --------------------------------------------------------------------------
+
+# Server side version of the clearing of one horizon in Rediz._msettle (including Rediz._game_payments), so that
+# samples, owners and the pool are read and paid in one atomic step. Every key the script writes is declared: the
+# performance hash (and, without the journal, the three per key transaction streams) of each expected recipient
+# follows the leaderboards in KEYS, and the recipient and public code are given in ARGV. Compact tickets k:id are
+# decoded using the participant_keys hash, legacy tickets k::write_key are split. If marked is '1' then KEYS[7] is
+# set once the horizon is paid, and a horizon whose key already exists is not paid again. Nothing is written unless
+# {1, pool, num_rewarded, num_recipients, leaked} is returned. Otherwise the summary is one of
+#     {0, write_key ...}  recipients whose keys were not declared (e.g. owners who joined since they were read)
+#     {2, ticket ...}     winning tickets that cannot be decoded, so the horizon cannot be settled
+#     {3}                 already settled
+#   KEYS:  samples, owners, balances, volumes, participant_keys, transactions (or journal), [settled], leaderboards ...,
+#          then for each expected recipient: performance, [ transactions by key, by key and name, by key and horizon ]
+#   ARGV:  value, budget, num_predictions, half_winners, participation_incentive, sep, settlement_time, delay, name,
+#          horizon, stream_owner_code, transactions_limit, transactions_ttl, leaderboard_ttl, settled_ttl,
+#          num_leaderboards, journal, marked, num_windows, windows ..., then for each expected recipient: write_key, code
+SETTLE_HORIZON_SCRIPT = """
+local value = tonumber(ARGV[1])
+local budget = tonumber(ARGV[2])
+local num_predictions = tonumber(ARGV[3])
+local half_winners = tonumber(ARGV[4])
+local incentive = tonumber(ARGV[5])
+local sep = ARGV[6]
+local num_leaderboards = tonumber(ARGV[16])
+local journal = ARGV[17] == '1'
+local marked = ARGV[18] == '1'
+local num_windows = tonumber(ARGV[19])
+
+local first_leaderboard = 7
+if marked then
+    if redis.call('EXISTS', KEYS[7]) == 1 then
+        return {3}
+    end
+    first_leaderboard = 8
+end
+local logs_per_recipient = 3
+if journal then
+    logs_per_recipient = 0
+end
+local expected = {}
+local first_recipient = first_leaderboard + num_leaderboards
+local first_arg = 20 + num_windows
+for r = 0, (#ARGV - first_arg + 1) / 2 - 1 do
+    expected[ARGV[first_arg + 2 * r]] = {code = ARGV[first_arg + 2 * r + 1],
+                                         key = first_recipient + r * (1 + logs_per_recipient)}
+end
+
+local pool = redis.call('ZCARD', KEYS[1])
+local participants = redis.call('SMEMBERS', KEYS[2])
+if pool == 0 or #participants <= 1 then
+    return {1, pool, 0, 0, 0}
+end
+
+-- Zoom out rewards scenarios window if we don't have a winner
+local rewarded = {}
+local winning_window = 0
+for i = 1, num_windows do
+    if #rewarded == 0 then
+        winning_window = tonumber(ARGV[19 + i])
+        rewarded = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], value + 0.5 * winning_window,
+                              'LIMIT', 0, half_winners)
+    end
+end
+
+-- Owners of winning tickets
+local owners = {}
+local ids = {}
+for i, ticket in ipairs(rewarded) do
+    local at = string.find(ticket, sep, 1, true)
+    if at then
+        owners[i] = string.sub(ticket, at + string.len(sep))
+    else
+        ids[#ids + 1] = string.sub(ticket, string.find(ticket, ':', 1, true) + 1)
+    end
+end
+if #ids > 0 then
+    local decoded = redis.call('HMGET', KEYS[5], unpack(ids))
+    local undecodable = {2}
+    local j = 0
+    for i, ticket in ipairs(rewarded) do
+        if owners[i] == nil then
+            j = j + 1
+            if decoded[j] then
+                owners[i] = decoded[j]
+            else
+                undecodable[#undecodable + 1] = ticket
+            end
+        end
+    end
+    if #undecodable > 1 then
+        return undecodable
+    end
+end
+
+-- Zero sum game between participants
+local payments = {}
+local recipients = {}
+local function pay(recipient, amount)
+    if payments[recipient] == nil then
+        payments[recipient] = 0
+        recipients[#recipients + 1] = recipient
+    end
+    payments[recipient] = payments[recipient] + amount
+end
+if #rewarded > 0 then
+    for _, participant in ipairs(participants) do
+        pay(participant, -1.0)
+    end
+    local reward = (1.0 * pool / num_predictions) / #rewarded
+    for i = 1, #rewarded do
+        pay(owners[i], reward)
+    end
+end
+
+-- Leakage can occur if owners gets out of sync with the samples
+local total = 0
+for _, recipient in ipairs(recipients) do
+    total = total + payments[recipient]
+end
+local leaked = 0
+if math.abs(total) > 0.1 then
+    leaked = 1
+    payments = {}
+    recipients = {}
+    for _, participant in ipairs(participants) do
+        pay(participant, 0.0)
+    end
+end
+
+-- Participation subsidy
+local subsidy = incentive / (0.5 + pool / num_predictions)
+for _, participant in ipairs(participants) do
+    pay(participant, subsidy)
+end
+
+local undeclared = {0}
+for _, recipient in ipairs(recipients) do
+    if expected[recipient] == nil then
+        undeclared[#undeclared + 1] = recipient
+    end
+end
+if #undeclared > 1 then
+    return undeclared
+end
+
+local num_rewarded = #rewarded
+local mass = num_rewarded / pool
+local density = mass / winning_window
+local reliable = 1
+if num_rewarded == 2 * half_winners then
+    reliable = 0
+end
+local breakeven = num_predictions * num_rewarded / pool
+local horizon = ARGV[10]
+for _, recipient in ipairs(recipients) do
+    local code = expected[recipient].code
+    local key = expected[recipient].key
+    local amount = budget * payments[recipient]
+    redis.call('HINCRBYFLOAT', KEYS[3], recipient, amount)
+    redis.call('HINCRBYFLOAT', KEYS[4], horizon, math.abs(amount))
+    for j = 0, num_leaderboards - 1 do
+        redis.call('ZINCRBY', KEYS[first_leaderboard + j], amount, code)
+    end
+    redis.call('HINCRBYFLOAT', KEYS[key], horizon, amount)
+    local logs = {KEYS[6]}
+    local extra = {}
+    if journal then
+        extra = {'recipient', recipient}
+    else
+        for l = 1, logs_per_recipient do
+            logs[#logs + 1] = KEYS[key + l]
+        end
+    end
+    for _, log_name in ipairs(logs) do
+        redis.call('XADD', log_name, 'MAXLEN', '~', ARGV[12], '*', 'settlement_time', ARGV[7], 'amount', amount,
+                   'budget', ARGV[2], 'stream', ARGV[9], 'delay', ARGV[8], 'value', ARGV[1],
+                   'window', winning_window, 'mass', mass, 'density', density, 'average', breakeven,
+                   'reliable', reliable, 'submissions_count', pool, 'submissions_close', num_rewarded,
+                   'stream_owner_code', ARGV[11], 'recipient_code', code, unpack(extra))
+        if not journal then
+            redis.call('EXPIRE', log_name, ARGV[13])
+        end
+    end
+end
+for j = 0, num_leaderboards - 1 do
+    redis.call('EXPIRE', KEYS[first_leaderboard + j], ARGV[14])
+end
+if marked then
+    redis.call('SET', KEYS[7], 1, 'EX', ARGV[15])
+end
+return {1, pool, num_rewarded, #recipients, leaked}
+"""
+
+
+# --------------------------------------------------------------------------
+#            Leaderboards
+# --------------------------------------------------------------------------
+
+# Several ZINCRBY on one leaderboard
+#   KEYS:  leaderboard
+#   ARGV:  member, amount, member, amount ...
+ZINCRBY_MANY_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    redis.call('ZINCRBY', KEYS[1], ARGV[i + 1], ARGV[i])
+end
+return 1
+"""
@@ -1,6 +1,8 @@
 import json
 import os
+import hashlib
 import numpy as np
+from collections import OrderedDict
 
 
 
@@ -37,4 +39,34 @@ def shorten(obj,num=5):
     elif isinstance(obj, dict):
         return dict([(k, shorten(v)) for k, v in obj.items()])
     else:
-        return obj
\ No newline at end of file
+        return obj
+
+
+def jump_consistent_hash(key, num_buckets):
+    """ Lamping and Veach jump consistent hash of a 64 bit integer key to one of range(num_buckets) """
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_of(name, num_shards):
+    """ Shard of a name that is stable across processes, and moves as few names as possible when num_shards grows """
+    key = int.from_bytes(hashlib.md5(name.encode()).digest()[:8], 'little')
+    return jump_consistent_hash(key, num_shards)
+
+
+class BoundedLRU(OrderedDict):
+    """ Dictionary that forgets the least recently written keys once maxsize is exceeded """
+
+    def __init__(self, maxsize=100000):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
@@ -22,7 +22,7 @@ setup(
     ],
     packages=["rediz"],
     test_suite='pytest',
-    tests_require=['pytest', 'microconventions', 'fakeredis'],
+    tests_require=['pytest', 'microconventions', 'fakeredis', 'lupa'],
     include_package_data=True,
     install_requires=["microconventions>=0.5.3", "fakeredis", "getjson", "redis", "sortedcontainers", "numpy",
                       "pymorton", "scipy"],
@@ -0,0 +1,252 @@
+from rediz.client import Rediz
+from rediz.pipelines import IntentPipeline
+import json, uuid
+from collections import Counter
+import numpy as np
+from rediz.rediz_test_config import REDIZ_TEST_CONFIG, REDIZ_FAKE_CONFIG
+BELLEHOOD_BAT = REDIZ_TEST_CONFIG['BELLEHOOD_BAT']
+
+# python -m pytest tests/test_async_settlement.py
+
+
+def test_async_settlement_queue_and_worker():
+    rdz = Rediz(async_settlement=True, **REDIZ_FAKE_CONFIG)
+    name = rdz.random_name()
+    title = rdz._mset_implementation(names=[name], values=[1.0], write_keys=[BELLEHOOD_BAT], budgets=[1],
+                                     with_percentiles=True)
+    assert "percentiles" not in title
+    assert rdz.client.llen(rdz._SETTLEMENT) == 1
+    assert rdz.client.zcard(rdz._predictions_name(name=name, delay=rdz.DELAYS[0])) == 0, "Baseline runs in worker"
+
+    report = rdz.admin_settlement(worker_id='test', with_report=True)
+    assert report['settled'] == 1 and report['backlog'] == 0
+    assert rdz.client.zcard(rdz._predictions_name(name=name, delay=rdz.DELAYS[0])) == rdz.num_predictions
+    assert rdz.client.llen(rdz._settlement_processing_name(worker_id='test')) == 0
+    rdz._delete_implementation(name)
+
+
+def test_async_settlement_retry_is_idempotent():
+    rdz = Rediz(async_settlement=True, **REDIZ_FAKE_CONFIG)
+    name = rdz.random_name()
+    rdz._mset_implementation(names=[name], values=[1.0], write_keys=[BELLEHOOD_BAT], budgets=[1])
+    job_json = rdz.client.lindex(rdz._SETTLEMENT, 0)
+    rdz.admin_settlement(worker_id='test')
+
+    # Simulate a worker that crashed after settling but before acknowledging
+    processing_name = rdz._settlement_processing_name(worker_id='test')
+    rdz.client.lpush(processing_name, job_json)
+    report = rdz.admin_settlement(worker_id='test', with_report=True)
+    assert report['retried'] == 1 and report['skipped'] == 1 and report['settled'] == 0
+    assert rdz.client.exists(rdz._settled_name(json.loads(job_json)["id"]))
+    rdz._delete_implementation(name)
+
+
+def test_settled_job_makes_no_writes():
+    rdz = Rediz(async_settlement=True, **REDIZ_FAKE_CONFIG)
+    name = rdz.random_name()
+    rdz._mset_implementation(names=[name], values=[1.0], write_keys=[BELLEHOOD_BAT], budgets=[1])
+    job_json = rdz.client.lindex(rdz._SETTLEMENT, 0)
+    rdz.client.set(rdz._settled_name(json.loads(job_json)["id"]), 1)
+    report = rdz.admin_settlement(worker_id='test', with_report=True)
+    assert report['skipped'] == 1 and report['settled'] == 0
+    assert rdz.client.zcard(rdz._predictions_name(name=name, delay=rdz.DELAYS[0])) == 0, "Baselines are part of the job"
+    rdz._delete_implementation(name)
+
+
+def test_derived_market_job_is_idempotent():
+    rdz = Rediz(async_settlement=True, **REDIZ_FAKE_CONFIG)
+    name = rdz.random_name()
+    rdz._enqueue_set(pipe=rdz.client, names=[name], values=[0.5], budgets=[1], write_keys=[BELLEHOOD_BAT])
+    job_json = rdz.client.lindex(rdz._SETTLEMENT, 0)
+    report = rdz.admin_settlement(worker_id='test', max_jobs=1, with_report=True)
+    assert report['settled'] == 1 and report['backlog'] == 1, "Settlement of the assignment is queued with it"
+
+    rdz.client.lpush(rdz._settlement_processing_name(worker_id='test'), job_json)
+    report = rdz.admin_settlement(worker_id='test', max_jobs=1, with_report=True)
+    assert report['skipped'] == 1 and report['backlog'] == 1
+    assert rdz.client.llen(rdz.lagged_values_name(name)) == 1
+    rdz._delete_implementation(name)
+
+
+def settle_fabricated_horizon(scripted_settlement, scripted_writes=False, settlement_journal=False,
+                              compact_tickets=False):
+    """ Three participants, one of whom is close to the truth """
+    rdz = Rediz(scripted_settlement=scripted_settlement, scripted_writes=scripted_writes,
+                settlement_journal=settlement_journal, compact_tickets=compact_tickets, **REDIZ_FAKE_CONFIG)
+    name, delay = rdz.random_name(), rdz.DELAYS[0]
+    owners = [str(uuid.uuid4()) for _ in range(3)]
+    samples = dict()
+    for owner_ndx, owner in enumerate(owners):
+        for k, ticket in enumerate(rdz._scenario_tickets(write_key=owner)):
+            samples[ticket] = 1.0 + owner_ndx + 1e-6 * k
+    rdz.client.zadd(rdz._samples_name(name=name, delay=delay), mapping=samples)
+    rdz.client.sadd(rdz._sample_owners_name(name=name, delay=delay), *owners)
+    rdz._participant_key_cache.clear()  # Settlement may run in a different process to submission
+    rdz._msettle(names=[name], values=[1.0], budgets=[1], with_percentiles=False, write_keys=[BELLEHOOD_BAT],
+                 with_copulas=False)
+    balances = [float(b) for b in rdz.client.hmget(rdz._BALANCES, owners)]
+    leaderboard = rdz.leaderboard_name(name=name, delay=delay)
+    scores = [rdz.client.zscore(leaderboard, rdz.shash(owner)) for owner in owners]
+    if settlement_journal:
+        assert rdz.client.xlen(rdz._JOURNAL) >= len(owners)
+        assert not rdz.client.exists(rdz.transactions_name(write_key=owners[0], name=name, delay=delay))
+        rdz.get_transactions(write_key=owners[0], name=name, delay=delay)
+        assert not rdz.client.exists(rdz.transactions_name(write_key=owners[0], name=name, delay=delay)), \
+            "Reads do not fan out"
+        rdz.admin_transactions()
+    transactions = [rdz.client.xlen(rdz.transactions_name(write_key=owner, name=name, delay=delay)) for owner in owners]
+    return balances, scores, transactions
+
+
+def test_scripted_settlement_matches_pipelined():
+    balances, scores, transactions = settle_fabricated_horizon(scripted_settlement=False)
+    scripted_balances, scripted_scores, scripted_transactions = settle_fabricated_horizon(scripted_settlement=True)
+    assert balances[0] > 0 > balances[1]
+    assert np.allclose(balances, scripted_balances)
+    assert np.allclose(scores, scripted_scores)
+    assert transactions == scripted_transactions == [1, 1, 1]
+
+
+def test_scripted_settlement_reads_inside_the_script():
+    rdz = Rediz(scripted_settlement=True, **REDIZ_FAKE_CONFIG)
+    name, delay = rdz.random_name(), rdz.DELAYS[0]
+    owners = [str(uuid.uuid4()) for _ in range(3)]
+
+    def submit(owner_ndx):
+        samples = dict((ticket, 1.0 + owner_ndx + 1e-6 * k) for k, ticket in
+                       enumerate(rdz._scenario_tickets(write_key=owners[owner_ndx])))
+        rdz.client.zadd(rdz._samples_name(name=name, delay=delay), mapping=samples)
+        rdz.client.sadd(rdz._sample_owners_name(name=name, delay=delay), owners[owner_ndx])
+
+    submit(1)
+    submit(2)
+    retrieved = rdz._msettle_retrieve(names=[name], values=[1.0])
+    submit(0)  # Joins after the horizon was read, so is declared to the script only when it is tried again
+    idempotency_key = rdz._settled_name('job')
+    for _ in range(2):
+        rdz._msettle(names=[name], values=[1.0], budgets=[1], with_percentiles=False, write_keys=[BELLEHOOD_BAT],
+                     with_copulas=False, retrieved=retrieved, idempotency_key=idempotency_key)
+    balances = [float(b) for b in rdz.client.hmget(rdz._BALANCES, owners)]
+    assert balances[0] > 0 > balances[1]
+    assert abs(sum(balances) - 3 * rdz._PARTICIPATION_INCENTIVE / 3.5) < 1e-6, "Paid once"
+    assert rdz.client.exists(idempotency_key + rdz.SEP + rdz.horizon_name(name=name, delay=delay))
+
+
+def test_leaderboard_increments_aggregated():
+    balances, scores, transactions = settle_fabricated_horizon(scripted_settlement=False)
+    scripted_balances, scripted_scores, _ = settle_fabricated_horizon(scripted_settlement=False, scripted_writes=True)
+    assert np.allclose(scores, scripted_scores)
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    leaderboard_names = rdz._settlement_leaderboard_names(name='x.json', delay=rdz.DELAYS[-1], sponsor='sponsor')
+    assert len(set(leaderboard_names)) == len(leaderboard_names) == 10
+
+    # Several members are summed into existing scores by one script call
+    leaderboard = rdz.leaderboard_name(name=rdz.random_name())
+    rdz.client.zadd(leaderboard, {'a': 1.0})
+    pipe = IntentPipeline(rdz.client)
+    rdz._leaderboard_increments_pipe(pipe=pipe, leaderboard_increments=Counter({(leaderboard, 'a'): 2.0,
+                                                                                (leaderboard, 'b'): -1.0}))
+    assert pipe.execute() == {('leaderboard', leaderboard): [1]}
+    assert rdz.client.zscore(leaderboard, 'a') == 3.0 and rdz.client.zscore(leaderboard, 'b') == -1.0
+    assert rdz.client.ttl(leaderboard) > 0
+
+
+def test_settlement_journal_fan_out():
+    balances, scores, transactions = settle_fabricated_horizon(scripted_settlement=False)
+    for scripted_settlement in [False, True]:
+        journal_balances, journal_scores, journal_transactions = settle_fabricated_horizon(
+            scripted_settlement=scripted_settlement, settlement_journal=True)
+        assert np.allclose(balances, journal_balances)
+        assert journal_transactions == transactions == [1, 1, 1]
+
+
+def test_settlement_journal_pending_entries_are_recovered():
+    rdz = Rediz(settlement_journal=True, **REDIZ_FAKE_CONFIG)
+    rdz.admin_transactions()
+    recipient = str(uuid.uuid4())
+    rdz.client.xadd(rdz._JOURNAL, fields={"recipient": recipient, "stream": "x.json", "delay": 70, "amount": 1.0})
+    # Delivered to another consumer but not acknowledged, as if that process crashed
+    rdz.client.xreadgroup(groupname=rdz._JOURNAL_GROUP, consumername='crashed', streams={rdz._JOURNAL: '>'})
+    assert rdz.admin_transactions() == 0, "Entries are only claimed once they have been idle for a while"
+    rdz._JOURNAL_CLAIM_IDLE = 0
+    report = rdz.admin_transactions(with_report=True)
+    assert report['fanned'] == 1 and report['removed'] == 1
+    assert rdz.client.xlen(rdz.transactions_name(write_key=recipient, name="x.json", delay=70)) == 1
+    assert rdz.admin_transactions() == 0
+
+
+def test_settlement_journal_ids_are_kept_and_backlog_is_reported():
+    rdz = Rediz(settlement_journal=True, **REDIZ_FAKE_CONFIG)
+    rdz.admin_transactions()
+    recipient = str(uuid.uuid4())
+    record = {"recipient": recipient, "stream": "x.json", "delay": 70, "amount": 1.0}
+    older = rdz.client.xadd(rdz._JOURNAL, fields=record)
+    rdz.client.xreadgroup(groupname=rdz._JOURNAL_GROUP, consumername='crashed', streams={rdz._JOURNAL: '>'})
+    newer = rdz.client.xadd(rdz._JOURNAL, fields=record)
+    assert rdz.admin_transactions() == 1
+    transactions_name = rdz.transactions_name(write_key=recipient, name="x.json", delay=70)
+    assert [entry_id for entry_id, _ in rdz.client.xrange(transactions_name)] == [newer], "Settlement time is kept"
+    rdz._JOURNAL_CLAIM_IDLE = 0
+    assert rdz.admin_transactions() == 1
+    entry_ids = [entry_id for entry_id, _ in rdz.client.xrange(transactions_name)]
+    assert len(entry_ids) == 2 and entry_ids[0] == newer and older not in entry_ids, "Late entries are appended"
+
+    rdz._JOURNAL_LIMIT = 2
+    for _ in range(2):
+        rdz.client.xadd(rdz._JOURNAL, fields=record)
+    report = rdz.admin_transactions(max_entries=0, with_report=True)
+    assert report['backlog'] == 2 and 'trim limit' in report['warnings']
+    assert json.loads(rdz.client.lindex(rdz._SETTLEMENT_ERRORS, 0))['operation'] == 'fan_out'
+    assert rdz.admin_transactions(with_report=True)['backlog'] == 0
+
+
+def test_compact_tickets_settle_like_legacy_tickets():
+    balances, scores, transactions = settle_fabricated_horizon(scripted_settlement=False)
+    for scripted_settlement in [False, True]:
+        compact_balances, compact_scores, compact_transactions = settle_fabricated_horizon(
+            scripted_settlement=scripted_settlement, compact_tickets=True)
+        assert np.allclose(balances, compact_balances)
+        assert np.allclose(scores, compact_scores)
+        assert compact_transactions == transactions
+
+
+def test_compact_tickets_are_decoded():
+    rdz = Rediz(compact_tickets=True, **REDIZ_FAKE_CONFIG)
+    name, delay = rdz.random_name(), rdz.DELAYS[0]
+    rdz._set_scenarios_implementation(name=name, values=list(np.linspace(0, 1, rdz.num_predictions)),
+                                      write_key=BELLEHOOD_BAT)
+    stored = rdz.client.zrange(rdz._predictions_name(name=name, delay=delay), 0, -1)
+    assert all(rdz.SEP not in ticket for ticket in stored)
+    participant_id = rdz._participant_id(write_key=BELLEHOOD_BAT)
+    rdz._participant_id_cache.clear()
+    assert rdz._participant_id(write_key=BELLEHOOD_BAT) == participant_id
+    assert rdz._participant_id(write_key=str(uuid.uuid4())) != participant_id
+    predictions = rdz._get_predictions_implementation(name=name, delay=delay)
+    assert sorted(predictions) == sorted(rdz._make_scenario_obscure(rdz._format_scenario(BELLEHOOD_BAT, k))
+                                         for k in range(rdz.num_predictions))
+    assert rdz._scenario_owners(stored[:1] + [rdz._format_scenario('legacy', 3)]) == [BELLEHOOD_BAT, 'legacy']
+    rdz._delete_scenarios_implementation(name=name, write_key=BELLEHOOD_BAT)
+    assert rdz.client.zcard(rdz._predictions_name(name=name, delay=delay)) == 0
+    rdz._delete_implementation(name)
+
+
+def test_unknown_participant_ids_are_not_paid_or_shown():
+    rdz = Rediz(compact_tickets=True, **REDIZ_FAKE_CONFIG)
+    name, delay = rdz.random_name(), rdz.DELAYS[0]
+    unknown = rdz._compact_scenario(participant_id=10 ** 12, k=3)
+    known = rdz._scenario_tickets(write_key=BELLEHOOD_BAT)[4]
+    assert rdz._game_payments(pool=2 * rdz.num_predictions, participant_set={BELLEHOOD_BAT, 'other'},
+                              rewarded_scenarios=[known, unknown], horizon=rdz.horizon_name(name, delay)) == {}
+    logged = json.loads(rdz.client.lindex(rdz._SETTLEMENT_ERRORS, 0))
+    assert logged['horizon'] == rdz.horizon_name(name, delay) and logged['tickets'] == [unknown]
+    assert rdz._game_payments(pool=2 * rdz.num_predictions, participant_set={BELLEHOOD_BAT, 'other'},
+                              rewarded_scenarios=[known])[BELLEHOOD_BAT] > 0
+    assert rdz._decoded_scenarios([unknown, known]) == [None, rdz._format_scenario(BELLEHOOD_BAT, 4)]
+
+    legacy = rdz._format_scenario(BELLEHOOD_BAT, 5)
+    rdz.client.zadd(rdz._predictions_name(name=name, delay=delay), mapping={unknown: 1.0, known: 2.0, legacy: 3.0})
+    predictions = rdz._get_predictions_implementation(name=name, delay=delay)
+    assert sorted(predictions.values()) == [2.0, 3.0]
+    scenarios = rdz._get_scenarios_implementation(name=name, write_key=BELLEHOOD_BAT, delay=delay)['scenarios']
+    assert scenarios == {rdz._format_scenario(BELLEHOOD_BAT, 4): 2.0, legacy: 3.0}, "Legacy tickets are found too"
+    rdz._delete_implementation(name)
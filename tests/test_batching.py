@@ -0,0 +1,45 @@
+from rediz import BatchingRediz
+import threading
+from rediz.rediz_test_config import REDIZ_TEST_CONFIG, REDIZ_FAKE_CONFIG
+BELLEHOOD_BAT = REDIZ_TEST_CONFIG['BELLEHOOD_BAT']
+
+# python -m pytest tests/test_batching.py
+
+
+def test_batching_coalesces_threads():
+    rdz = BatchingRediz(batch_window=0.2, batch_max_items=50, **REDIZ_FAKE_CONFIG)
+    batch_sizes = list()
+    mset = rdz.mset
+
+    def counted_mset(names, **kwargs):
+        batch_sizes.append(len(names))
+        return mset(names=names, **kwargs)
+    rdz.mset = counted_mset
+
+    names = [rdz.random_name() + '.json' for _ in range(4)]
+    names = names + names[:1]  # One repeated name must go in a second round
+    results = dict()
+
+    def setter(ndx):
+        results[ndx] = rdz.set(name=names[ndx], value=float(ndx), write_key=BELLEHOOD_BAT, budget=1)
+
+    threads = [threading.Thread(target=setter, args=(ndx,)) for ndx in range(len(names))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rdz.close()
+
+    assert sum(batch_sizes) == len(names)
+    assert len(batch_sizes) < len(names)
+    for ndx, name in enumerate(names):
+        assert results[ndx]["name"] == name
+        assert results[ndx]["value"] == float(ndx)
+    assert float(rdz.get(names[0])) in (0.0, 4.0)
+    rdz._delete_implementation(*set(names))
+
+
+def test_batching_rounds_preserve_order():
+    items = [{"name": n} for n in ['a', 'b', 'a', 'a', 'c']]
+    rounds = BatchingRediz._batch_rounds(items)
+    assert [[item["name"] for item in r] for r in rounds] == [['a', 'b', 'c'], ['a'], ['a']]
@@ -66,6 +66,21 @@ def test__streams_support():
     rdz = Rediz(decode_responses=True, **REDIZ_FAKE_CONFIG)  # Use fakeredis
     assert rdz._streams_support()==False, "Test failed because now fakeredis supports streams?!"
 
+def test_streams_support_cached():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    probes = list()
+    probe = rdz._streams_support
+    rdz._streams_support = lambda: probes.append(1) or probe()
+    supported = rdz.streams_support
+    for _ in range(5):
+        assert rdz.streams_support == supported
+    assert len(probes) == 1
+    rdz_never = Rediz(streams_support=False, **REDIZ_FAKE_CONFIG)
+    assert rdz_never.streams_support == False
+    rdz_reprobe = Rediz(streams_probe_interval=0, **REDIZ_FAKE_CONFIG)
+    rdz_reprobe._streams_probe_time = 0
+    assert rdz_reprobe.streams_support == supported
+
 def random_name():
     return random_key()+'.json'
 
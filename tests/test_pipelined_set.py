@@ -0,0 +1,225 @@
+from rediz.client import Rediz
+import json
+import numpy as np
+from rediz.pipelines import IntentPipeline
+from rediz.rediz_test_config import REDIZ_TEST_CONFIG, REDIZ_FAKE_CONFIG
+BELLEHOOD_BAT = REDIZ_TEST_CONFIG['BELLEHOOD_BAT']
+TASTEABLE_BEE = REDIZ_TEST_CONFIG['TASTEABLE_BEE']
+
+# python -m pytest tests/test_pipelined_set.py
+
+
+def count_round_trips(rdz):
+    """ Wrap the client so that every pipeline execution and hmget is counted """
+    counts = {'pipelines': 0, 'hmget': 0}
+    make_pipeline = rdz.client.pipeline
+    hmget = rdz.client.hmget
+
+    def pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*a, **k):
+            counts['pipelines'] += 1
+            return execute(*a, **k)
+        pipe.execute = counted_execute
+        return pipe
+
+    def counted_hmget(*args, **kwargs):
+        counts['hmget'] += 1
+        return hmget(*args, **kwargs)
+
+    rdz.client.pipeline = pipeline
+    rdz.client.hmget = counted_hmget
+    return counts
+
+
+def test_mixed_ownership_single_write_pipeline():
+    rdz = Rediz(max_ttl=10 ** 9, **REDIZ_FAKE_CONFIG)
+    existing, stolen, new = rdz.random_name(), rdz.random_name(), rdz.random_name()
+    rdz._pipelined_set(names=[existing, stolen], values=[1.0, 2.0], write_keys=[BELLEHOOD_BAT, TASTEABLE_BEE],
+                       budgets=[1, 1])
+
+    counts = count_round_trips(rdz)
+    names = [existing, stolen, new, None, 'bad name']
+    values = [3.0, 4.0, 5.0, 6.0, 7.0]
+    budgets = [1, 1, 100, 1, 1]
+    log = rdz._pipelined_set(names=names, values=values, write_keys=[BELLEHOOD_BAT] * 5, budgets=budgets)
+    assert counts['hmget'] == 1
+    assert counts['pipelines'] == 2, "Expected one write pipeline and one subscriber lookup"
+
+    executed = dict((ex['ndx'], ex) for ex in log['executed'])
+    rejected = dict((rj['ndx'], rj) for rj in log['rejected'])
+    assert sorted(executed) == [0, 2, 3]
+    assert sorted(rejected) == [1, 4]
+    assert executed[2]['new'] and executed[3]['obscure'] and not executed[0]['new']
+    for ndx, ex in executed.items():
+        assert ex['ttl'] == rdz._cost_based_ttl(value=values[ndx], budget=budgets[ndx]), "Budgets misaligned"
+    assert all(len(ex['result']) for ex in executed.values())
+    assert rdz.get(existing) == '3.0' and rdz.get(stolen) == '2.0' and rdz.get(new) == '5.0'
+    assert rdz.get_errors(write_key=BELLEHOOD_BAT)
+
+
+def test_intent_pipeline_uneven_intents():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    name = rdz.random_name()
+    pipe = IntentPipeline(rdz.client)
+    with pipe.intent('one') as p:
+        p.set(name, 7)
+    pipe.expire(name, 10)  # Not attributed
+    with pipe.intent('three') as p:
+        p.get(name)
+        p.exists(name)
+        p.delete(name)
+    results = pipe.execute()
+    assert results['one'] == [True]
+    assert results['three'] == ['7', 1, 1]
+
+
+def test_modify_page_no_padding():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    name = rdz.random_name()
+    log = rdz._pipelined_set(names=[name, name], values=[1.0, '{"a": 1, "b": 2}'], write_keys=[BELLEHOOD_BAT] * 2,
+                             budgets=[1, 1])
+    scalar, record = sorted(log['executed'], key=lambda ex: ex['ndx'])
+    assert len(scalar['result']) != len(record['result'])
+    rdz._delete_implementation(name)
+
+
+def test_scalar_set_shares_settlement_pipeline():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+
+    def no_pools(*args, **kwargs):
+        raise AssertionError("Prediction pools should come from the settlement pipeline")
+    rdz._pools = no_pools
+    name = rdz.random_name()
+    title = rdz._mset_implementation(names=[name], values=[1.5], write_keys=[BELLEHOOD_BAT], budgets=[1])
+    assert title["name"] == name
+    assert len(rdz.client.zrange(rdz._predictions_name(name=name, delay=rdz.DELAYS[0]), 0, -1)) > 0
+    rdz._delete_implementation(name)
+
+
+def test_batched_baseline_predictions():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    names = [rdz.random_name() for _ in range(3)]
+    rdz._mset_implementation(names=names, values=[1.0, 2.0, 3.0], write_keys=[BELLEHOOD_BAT] * 3, budgets=[1] * 3)
+    for name in names:
+        for delay in rdz.DELAYS:
+            assert rdz.client.zcard(rdz._predictions_name(name=name, delay=delay)) == rdz.num_predictions
+    confirms = [json.loads(c) for c in rdz.get_confirms(write_key=BELLEHOOD_BAT)]
+    confirms = [c for c in confirms if c.get('operation') == 'submit']
+    assert confirms[0]['count'] == len(names)
+    baseline_counts = count_round_trips(rdz)
+    assert rdz._baseline_predictions([(name, BELLEHOOD_BAT, rdz.DELAYS) for name in names]) == [True] * 3
+    assert baseline_counts['pipelines'] == 3  # Lags, submission and one confirmation
+    rdz._delete_implementation(*names)
+
+
+def test_nested_neighbours_match_per_window_queries():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    samples_name = rdz._samples_name(name=rdz.random_name(), delay=rdz.DELAYS[0])
+    value = 1.0
+    offsets = np.concatenate([np.random.randn(300) * 1e-3, np.random.randn(30) * 1e-5, [0.0, 5e-5, -5e-4]])
+    rdz.client.zadd(samples_name, mapping=dict(('ticket' + str(k), value + o) for k, o in enumerate(offsets)))
+    half_winners = int(np.ceil(rdz.NUM_WINNERS / 2))
+    widest = max(rdz._WINDOWS)
+    scenarios_up = rdz.client.zrangebyscore(samples_name, min=value, max=value + 0.5 * widest, withscores=True,
+                                            start=0, num=half_winners)
+    scenarios_dn = rdz.client.zrevrangebyscore(samples_name, max=value, min=value - 0.5 * widest, withscores=True,
+                                               start=0, num=half_winners)
+    neighbours = rdz._nested_neighbours(value, scenarios_up, scenarios_dn)
+    for window, (up, dn) in zip(rdz._WINDOWS, neighbours):
+        assert up == rdz.client.zrangebyscore(samples_name, min=value, max=value + 0.5 * window, start=0,
+                                              num=half_winners)
+        assert dn == rdz.client.zrevrangebyscore(samples_name, max=value, min=value - 0.5 * window, start=0,
+                                                 num=half_winners)
+    rdz.client.delete(samples_name)
+
+
+def test_jiggered_scenarios_sorted_and_unique():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    assert rdz._ticket_prefixes()[7] + BELLEHOOD_BAT == rdz._format_scenario(BELLEHOOD_BAT, 7)
+    rounded = list(np.round(np.random.randn(rdz.num_predictions), 1))  # Plenty of ties
+    for values in [rounded, sorted(rounded), [5000.0] * rdz.num_predictions]:
+        predictions = rdz._jiggered_scenarios(values=values, write_key=BELLEHOOD_BAT)
+        tickets = list(predictions)
+        assert tickets == [rdz._format_scenario(BELLEHOOD_BAT, k) for k in range(rdz.num_predictions)]
+        jiggered = np.array(list(predictions.values()))
+        assert np.all(np.diff(jiggered) > 0)
+        assert np.allclose(jiggered, sorted(values), atol=1e-3)
+    try:
+        rdz._jiggered_scenarios(values=[np.nan] * rdz.num_predictions, write_key=BELLEHOOD_BAT)
+        rejected = False
+    except Exception as e:
+        rejected = 'Cannot accept submission' in str(e)
+    assert rejected, "Values that cannot be made unique are rejected"
+    assert 'Cannot accept submission' in json.loads(rdz.get_errors(write_key=BELLEHOOD_BAT)[0])['error']
+
+
+def test_mset_scenarios_single_pipeline():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    names = [rdz.random_name() for _ in range(3)]
+    submissions = dict(((name, delay), list(np.random.randn(rdz.num_predictions)))
+                       for name in names for delay in rdz.DELAYS)
+    counts = count_round_trips(rdz)
+    successes = rdz.mset_scenarios(write_key=BELLEHOOD_BAT, submissions=submissions)
+    assert counts['pipelines'] == 2, "Expected one submission pipeline and one confirmation"
+    assert list(successes) == list(submissions) and all(successes.values())
+    for name, delay in submissions:
+        assert rdz.client.zcard(rdz._predictions_name(name=name, delay=delay)) == rdz.num_predictions
+    confirms = [json.loads(c) for c in rdz.get_confirms(write_key=BELLEHOOD_BAT)]
+    assert confirms[0]['operation'] == 'submit' and confirms[0]['count'] == len(submissions)
+    for name in names:
+        rdz._delete_scenarios_implementation(name=name, write_key=BELLEHOOD_BAT)
+
+
+def test_mset_scenarios_rejects_horizons_one_at_a_time():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    good, bad = rdz.random_name(), rdz.random_name()
+    delay = rdz.DELAYS[0]
+    submissions = {(bad, delay): [np.nan] * rdz.num_predictions,
+                   (good, delay): list(np.random.randn(rdz.num_predictions))}
+    successes = rdz.mset_scenarios(write_key=BELLEHOOD_BAT, submissions=submissions)
+    assert list(successes) == list(submissions)
+    assert successes[(good, delay)] and not successes[(bad, delay)]
+    assert rdz.client.zcard(rdz._predictions_name(name=good, delay=delay)) == rdz.num_predictions
+    assert not rdz.client.exists(rdz._predictions_name(name=bad, delay=delay))
+    problems = json.loads(rdz.get_errors(write_key=BELLEHOOD_BAT)[0])['problems']
+    assert [problem['name'] for problem in problems] == [bad]
+    rdz._delete_scenarios_implementation(name=good, write_key=BELLEHOOD_BAT)
+
+
+def test_bankrupt_submissions_use_cached_balance_and_zscore():
+    rdz = Rediz(balance_cache_ttl=60, **REDIZ_FAKE_CONFIG)
+    write_key = TASTEABLE_BEE
+    original_balance = rdz.client.hget(rdz._BALANCES, write_key)
+    names = [rdz.random_name() for _ in range(2)]
+    rdz.client.hset(rdz._BALANCES, write_key, -10 ** 12)
+    rdz.client.zadd(rdz.leaderboard_name(name=names[0], delay=rdz.DELAYS[0]), {rdz.shash(write_key): 5.0})
+
+    def no_leaderboard(*args, **kwargs):
+        raise AssertionError("Leaderboards should not be retrieved to check one code")
+    rdz._get_leaderboard_implementation = no_leaderboard
+    submissions = dict(((name, rdz.DELAYS[0]), list(np.random.randn(rdz.num_predictions))) for name in names)
+    successes = rdz.mset_scenarios(write_key=write_key, submissions=submissions)
+    assert successes[(names[0], rdz.DELAYS[0])] and not successes[(names[1], rdz.DELAYS[0])]
+
+    counts = count_round_trips(rdz)
+    rdz.client.hset(rdz._BALANCES, write_key, 10 ** 12)  # Not seen until the cached balance expires
+    assert rdz._bankrupt_write_keys([write_key]) == {write_key}
+    assert counts['hmget'] == 0
+    assert not rdz.set_scenarios(name=names[1], values=list(np.random.randn(rdz.num_predictions)),
+                                 delay=rdz.DELAYS[0], write_key=write_key)
+    assert not rdz._bankrupt_write_keys([write_key], cached=False), "Admin reads bypass the cache"
+    rdz._balance_cache.clear()
+    assert not rdz._bankrupt_write_keys([write_key])
+    rdz.client.hset(rdz._BALANCES, write_key, original_balance or 0)
+    rdz._delete_scenarios_implementation(name=names[0], write_key=write_key)
+
+
+def test_set_scenarios_success_and_warn():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    n = rdz.num_predictions
+    assert rdz._set_scenarios_success(execut=[n, True, '1-0'], anticipated_execut=[n, True, None]) == (True, False)
+    assert rdz._set_scenarios_success(execut=[n - 1, True], anticipated_execut=[n, True]) == (True, True)
+    assert rdz._set_scenarios_success(execut=[n, False], anticipated_execut=[n, True]) == (False, True)
@@ -0,0 +1,158 @@
+from rediz.client import Rediz
+import time
+import numpy as np
+from rediz.utilities import jump_consistent_hash, shard_of
+from rediz.rediz_test_config import REDIZ_TEST_CONFIG, REDIZ_FAKE_CONFIG
+BELLEHOOD_BAT = REDIZ_TEST_CONFIG['BELLEHOOD_BAT']
+
+# python -m pytest tests/test_promises.py
+
+
+def make_due(rdz, schedule):
+    """ Pretend every scheduled promise fell due a moment ago """
+    due = dict((promise, int(time.time()) - 1) for promise in rdz.client.zrange(schedule, 0, -1))
+    if due:
+        rdz.client.zadd(schedule, mapping=due, xx=True)
+    return len(due)
+
+
+def test_sorted_promises_delivery():
+    for scripted_writes in [False, True]:
+        rdz = Rediz(sorted_promises=True, scripted_writes=scripted_writes, **REDIZ_FAKE_CONFIG)
+        rdz.client.delete(rdz._PROMISE_SCHEDULE)
+        original_balance = rdz.client.hget(rdz._BALANCES, BELLEHOOD_BAT)
+        rdz.client.hset(rdz._BALANCES, BELLEHOOD_BAT, 10 ** 12)  # Creating the stream must not leave it bankrupt
+        name = rdz.random_name()
+        rdz.set(name=name, value=17.0, write_key=BELLEHOOD_BAT, budget=1)
+        delay = rdz.DELAYS[0]
+        assert rdz.set_scenarios(name=name, values=list(np.random.randn(rdz.num_predictions)), delay=delay,
+                                 write_key=BELLEHOOD_BAT)
+        assert not rdz.client.keys(rdz._PROMISES + '*'), "Per-second queues are not used"
+        assert make_due(rdz, rdz._PROMISE_SCHEDULE) == 2 * len(rdz.DELAYS) + 1  # Copies, baselines and scenarios
+
+        report = rdz.admin_promises(with_report=True)
+        operations = [record['operation'] for record in report]
+        if scripted_writes:
+            assert sorted(operations) == ['deliver'] * len(rdz.DELAYS) + ['set'] * len(rdz.DELAYS)
+        else:
+            assert sorted(operations) == ['sadd'] * len(rdz.DELAYS) + ['set'] * len(rdz.DELAYS) + \
+                   ['zadd'] * len(rdz.DELAYS)
+        assert rdz.admin_promises(with_report=True) == [], "Claimed promises are not delivered twice"
+        assert float(rdz.client.get(rdz.delayed_name(name=name, delay=delay))) == 17.0
+        assert rdz.client.zcard(rdz._samples_name(name=name, delay=delay)) == rdz.num_predictions
+        assert rdz.client.sismember(rdz._sample_owners_name(name=name, delay=delay), BELLEHOOD_BAT)
+        rdz._delete_implementation(name)
+        rdz.client.hset(rdz._BALANCES, BELLEHOOD_BAT, original_balance or 0)
+
+
+def test_sorted_promises_discard_expired_and_keep_future():
+    rdz = Rediz(sorted_promises=True, **REDIZ_FAKE_CONFIG)
+    now = int(time.time())
+    rdz.client.zadd(rdz._PROMISE_SCHEDULE, mapping={'expired': now - rdz._DELAY_GRACE - 5, 'due': now,
+                                                   'future': now + 60})
+    assert rdz._claim_promises() == ['due']
+    assert rdz.client.zrange(rdz._PROMISE_SCHEDULE, 0, -1) == ['future']
+    rdz.client.delete(rdz._PROMISE_SCHEDULE)
+
+
+def test_scripted_prediction_delivery_decodes_owners():
+    rdz = Rediz(scripted_writes=True, compact_tickets=True, **REDIZ_FAKE_CONFIG)
+    name, delay = rdz.random_name(), rdz.DELAYS[0]
+    source = rdz._random_promised_name(name)
+    tickets = rdz._scenario_tickets(write_key=BELLEHOOD_BAT) + [rdz._format_scenario('legacy', k) for k in range(400)]
+    rdz.client.zadd(source, mapping=dict((ticket, float(k)) for k, ticket in enumerate(tickets)))
+    rdz.client.sadd(rdz._promise_queue_name(int(time.time())),
+                    rdz._prediction_promise(target=name, delay=delay, predictions_name=source))
+    report = rdz.admin_promises(with_report=True)
+    assert report[0]['execution_result'] == len(tickets) + 2
+    samples = rdz.client.zrange(rdz._samples_name(name=name, delay=delay), 0, -1, withscores=True)
+    assert samples == rdz.client.zrange(source, 0, -1, withscores=True)
+    assert rdz.client.smembers(rdz._sample_owners_name(name=name, delay=delay)) == {BELLEHOOD_BAT, 'legacy'}
+    rdz.client.delete(source, rdz._samples_name(name=name, delay=delay), rdz._sample_owners_name(name=name, delay=delay))
+
+
+def test_jump_consistent_hash_moves_few_names():
+    names = ['name_' + str(k) for k in range(2000)]
+    before = [shard_of(name, 8) for name in names]
+    after = [shard_of(name, 9) for name in names]
+    assert set(before) == set(range(8))
+    moved = [b != a for b, a in zip(before, after)]
+    assert all(a == 8 for a, m in zip(after, moved) if m), "Names only move to the new shard"
+    assert sum(moved) < len(names) / 4
+    assert jump_consistent_hash(0, 1) == 0 and before == [shard_of(name, 8) for name in names]
+
+
+def test_sharded_promises_delivered_in_parallel():
+    for sorted_promises in [False, True]:
+        rdz = Rediz(promise_shards=4, sorted_promises=sorted_promises, **REDIZ_FAKE_CONFIG)
+        names = [rdz.random_name() for _ in range(8)]
+        now = int(time.time())
+        for name in names:
+            promise = rdz._copy_promise(source=name, destination=rdz.delayed_name(name=name, delay=rdz.DELAYS[0]))
+            shard = rdz._promise_shard(name)
+            if sorted_promises:
+                rdz.client.zadd(rdz._promise_schedule_name(shard), mapping={promise: now})
+            else:
+                rdz.client.sadd(rdz._promise_queue_name(epoch_seconds=now, shard=shard), promise)
+            rdz.client.set(name, 3.0)
+        backlog = rdz.get_promise_backlog()
+        assert sorted(backlog) == list(range(4)) and sum(backlog.values()) == len(names)
+        report = rdz.admin_sharded_promises(with_report=True)
+        assert sum(len(shard_report) for shard_report in report['shards'].values()) == len(names)
+        assert sum(report['backlog'].values()) == 0
+        for name in names:
+            assert float(rdz.client.get(rdz.delayed_name(name=name, delay=rdz.DELAYS[0]))) == 3.0
+        rdz._delete_implementation(*names)
+
+
+def test_promise_shard_counts_must_agree():
+    rdz = Rediz(**REDIZ_FAKE_CONFIG)
+    pipe = rdz.client.pipeline()
+    rdz._promise_pipe(pipe=pipe, promise='promise', due=int(time.time()) + 60, ttl=60, name=rdz.random_name())
+    pipe.execute()
+    assert int(rdz.client.get(rdz._PROMISE_SHARD_COUNT)) == 1
+    worker = Rediz(promise_shards=4, **REDIZ_FAKE_CONFIG)
+    worker.client = rdz.client  # Same redis
+    try:
+        worker.admin_sharded_promises()
+        rejected = False
+    except Exception as e:
+        rejected = 'promise_shards' in str(e)
+    assert rejected, "Workers delivering a different number of shards than producers queue fail fast"
+    rdz.client.delete(rdz._PROMISE_SHARD_COUNT)
+
+
+def test_promise_stats_record_lateness_and_drops():
+    for sorted_promises in [False, True]:
+        rdz = Rediz(sorted_promises=sorted_promises, **REDIZ_FAKE_CONFIG)
+        rdz.client.delete(rdz._PROMISE_STATS, rdz._PROMISE_LATENESS, rdz._PROMISE_SCHEDULE)
+        name, missing = rdz.random_name(), rdz.random_name()
+        now = int(time.time())
+        rdz.client.set(name, 2.0)
+        pipe = rdz.client.pipeline()
+        for source, due in [(name, now - 3), (missing, now)]:
+            promise = rdz._copy_promise(source=source, destination=rdz.delayed_name(name=source, delay=rdz.DELAYS[0]))
+            rdz._promise_pipe(pipe=pipe, promise=promise, due=due, ttl=60, name=source)
+        pipe.execute()
+        if sorted_promises:
+            rdz.client.zadd(rdz._PROMISE_SCHEDULE, mapping={'stale': now - rdz._DELAY_GRACE - 5})
+        else:
+            # Queued with a one second delay, and left with the TTL it would have by now
+            stale_due = now - rdz._DELAY_GRACE - 2
+            stale_queue = rdz._promise_queue_name(epoch_seconds=stale_due)
+            rdz.client.sadd(stale_queue, 'stale')
+            remaining_ttl = rdz._promise_queue_ttl(1 + rdz._DELAY_GRACE) - (now - stale_due + 1)
+            assert remaining_ttl > 0, "Undelivered queues outlive the window in which they are counted"
+            rdz.client.expire(stale_queue, remaining_ttl)
+        backlog = rdz.get_promise_stats()['backlog']
+        assert backlog[now - 3] == 1 and backlog[now] == 1 and sum(backlog.values()) == 2
+
+        report = rdz.admin_promises(with_report=True)
+        assert [record['operation'] for record in report] == ['set']
+        stats = rdz.get_promise_stats()
+        assert stats['counters']['claimed'] == 2 and stats['counters']['copies'] == 1
+        assert stats['counters']['none_values'] == 1
+        assert stats['counters']['expired'] == 1
+        assert sum(stats['lateness'].values()) == 2 and stats['lateness']['5'] == 1
+        assert sum(stats['backlog'].values()) == 0
+        rdz._delete_implementation(name)
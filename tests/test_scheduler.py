@@ -0,0 +1,53 @@
+from rediz.scheduler import PromiseScheduler, TimerWheel, PROMISES_TASK, CANCELLATIONS_TASK
+import time
+import random
+from rediz.rediz_test_config import REDIZ_FAKE_CONFIG
+
+# python -m pytest tests/test_scheduler.py
+
+
+def test_timer_wheel_cascades_in_order():
+    start = 1000
+    wheel = TimerWheel(now=start, slots=4, levels=2)  # Level 0 spans 4 seconds, level 1 spans 16, beyond is overflow
+    dues = [start + random.randint(0, 60) for _ in range(200)]
+    for due in dues:
+        wheel.add(due, 'task')
+    assert len(wheel) == len(set(dues))
+    fired = list()
+    for now in range(start, start + 61):
+        assert wheel.next_due() == min(due for due in dues if due >= now) if any(due >= now for due in dues) else True
+        fired += [due for due, _ in wheel.advance(now)]
+        assert all(due <= now for due in fired)
+    assert fired == sorted(set(dues)) and len(wheel) == 0 and wheel.next_due() is None
+    wheel.add(start, 'late')
+    assert wheel.next_due() == start and wheel.advance(start + 61) == [(start, 'late')]
+
+
+def test_scheduler_wakes_when_promise_due():
+    scheduler = PromiseScheduler(max_sleep=30, promise_notify=True, **REDIZ_FAKE_CONFIG)
+    first = scheduler.step()
+    assert PROMISES_TASK in first and CANCELLATIONS_TASK in first  # Backlog and cancellations on startup
+    pipe = scheduler.client.pipeline()
+    scheduler._notify_pipe(pipe=pipe, dues=[int(time.time()) - 60])  # Announced, but with nothing to deliver
+    pipe.execute()
+    scheduler.step()
+    assert scheduler.get_lateness_stats()['count'] == 0, "Lateness is only recorded for deliveries"
+
+    name = scheduler.random_name()
+    destination = scheduler.delayed_name(name=name, delay=scheduler.DELAYS[0])
+    scheduler.client.set(name, 5.0)
+    due = int(time.time()) + 1
+    pipe = scheduler.client.pipeline()
+    scheduler._promise_pipe(pipe=pipe, promise=scheduler._copy_promise(source=name, destination=destination), due=due, ttl=60,
+                      name=name)
+    assert scheduler._notify_pipe(pipe=pipe, dues=[due]) == [None]
+    pipe.execute()
+
+    before = time.time()
+    while not scheduler.client.exists(destination) and time.time() < before + 5:
+        scheduler.step()
+    assert float(scheduler.client.get(destination)) == 5.0
+    assert time.time() - before < 2.5, "Expected delivery when due, not after max_sleep"
+    stats = scheduler.get_lateness_stats()
+    assert stats['count'] >= 1 and stats['p50'] < 1.0
+    scheduler._delete_implementation(name, destination)
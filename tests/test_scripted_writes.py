@@ -0,0 +1,75 @@
+from rediz.client import Rediz
+import json
+from rediz.pipelines import IntentPipeline
+from rediz.rediz_test_config import REDIZ_TEST_CONFIG, REDIZ_FAKE_CONFIG
+BELLEHOOD_BAT = REDIZ_TEST_CONFIG['BELLEHOOD_BAT']
+
+# python -m pytest tests/test_scripted_writes.py   ( fakeredis needs lupa for Lua scripting )
+
+
+def test_scripted_scalar_matches_pipelined():
+    rdz_plain = Rediz(**REDIZ_FAKE_CONFIG)
+    rdz_script = Rediz(scripted_writes=True, **REDIZ_FAKE_CONFIG)
+    for rdz in [rdz_plain, rdz_script]:
+        name = rdz.random_name()
+        for value in [3.0, 4.5]:
+            res = rdz._pipelined_set(names=[name], values=[value], write_keys=[BELLEHOOD_BAT], budgets=[1])
+            assert len(res["executed"]) == 1
+        assert float(rdz.get(name)) == 4.5
+        assert rdz.get_lagged_values(name) == [4.5, 3.0]
+        assert len(rdz.get_lagged_times(name)) == 2
+        assert 0 < rdz.client.ttl(name) <= res["executed"][0]["ttl"]
+        copy = res["executed"][0]["copy"]
+        assert float(rdz.client.get(copy)) == 4.5
+        promises = [p for q in rdz.client.keys(rdz._PROMISES + '*') for p in rdz.client.smembers(q)]
+        assert sum(copy in p for p in promises) == len(rdz.DELAYS)
+        rdz._delete_implementation(name)
+
+
+def test_scripted_history():
+    rdz = Rediz(scripted_writes=True, **REDIZ_FAKE_CONFIG)
+    name = rdz.random_name()
+    value = json.dumps({"temperature": 17, "pressure": 1001})
+    rdz._pipelined_set(names=[name], values=[value], write_keys=[BELLEHOOD_BAT], budgets=[1])
+    assert rdz.get(name) == value
+    if rdz.streams_support:
+        history = rdz.client.xrange(rdz.history_name(name))
+        assert history[0][1] == dict((k, str(v)) for k, v in rdz.to_record(value).items())
+    rdz._delete_implementation(name)
+
+
+def test_lazy_distribution_ttl_refresh():
+    for scripted_writes in [False, True]:
+        rdz = Rediz(distribution_ttl_refresh=3600, scripted_writes=scripted_writes, **REDIZ_FAKE_CONFIG)
+        name = rdz.random_name()
+        predictions_name = rdz._predictions_name(name=name, delay=rdz.DELAYS[0])
+        rdz._pipelined_set(names=[name], values=[1.0], write_keys=[BELLEHOOD_BAT], budgets=[1])
+        assert name in rdz._distribution_refreshes
+        rdz._set_scenarios_pipe(pipe=rdz.client, name=name, predictions={'a': 1.0}, delays=rdz.DELAYS[:1],
+                                write_key=BELLEHOOD_BAT)
+        assert rdz.client.ttl(predictions_name) > 0, "Keys created within the interval still expire"
+        rdz.client.expire(predictions_name, 100)
+        rdz._pipelined_set(names=[name], values=[2.0], write_keys=[BELLEHOOD_BAT], budgets=[1])
+        assert rdz.client.ttl(predictions_name) <= 100, "TTL should not be refreshed within the interval"
+        rdz._distribution_refreshes[name] = 0
+        rdz._pipelined_set(names=[name], values=[3.0], write_keys=[BELLEHOOD_BAT], budgets=[1])
+        assert rdz.client.ttl(predictions_name) > 100
+        rdz._delete_implementation(name)
+        assert name not in rdz._distribution_refreshes
+
+
+def test_failed_write_is_not_remembered_as_refreshed():
+    rdz = Rediz(distribution_ttl_refresh=3600, **REDIZ_FAKE_CONFIG)
+    name = rdz.random_name()
+    execute = IntentPipeline.execute
+
+    def failing_execute(self, *args, **kwargs):
+        raise ConnectionError("Write failed")
+    IntentPipeline.execute = failing_execute
+    try:
+        rdz._pipelined_set(names=[name], values=[1.0], write_keys=[BELLEHOOD_BAT], budgets=[1])
+    except ConnectionError:
+        pass
+    finally:
+        IntentPipeline.execute = execute
+    assert name not in rdz._distribution_refreshes
@@ -1,6 +1,7 @@
 from rediz import Rediz
 from rediz.rediz_test_config import REDIZ_TEST_CONFIG
 import numpy as np
+import sys, math, time
 
 def test_conv():
     rdz = Rediz(**REDIZ_TEST_CONFIG)
@@ -42,4 +43,54 @@ def test_mean_percentile_again():
     avg_p = rdz.zmean_percentile(p)
     implied_avg = norminv(avg_p)
     actual_avg  = np.mean(zscores)
-    assert abs(implied_avg-actual_avg)<1e-4
\ No newline at end of file
+    assert abs(implied_avg-actual_avg)<1e-4
+
+def test_vectorized_costs():
+    rdz = Rediz(**REDIZ_TEST_CONFIG)
+    values = [1.0, 17, "x" * 500, '[1.0, 2.0, 3.0]']
+    budgets = [1, 0.5, 10, 1000]
+    ttls = rdz._cost_based_ttls(values=values, budgets=budgets)
+    lag_lens = rdz._cost_based_lagged_lens(values=values)
+
+    def closed_form_ttl(value, budget):
+        # The scalar cost model as it was before vectorization
+        credits_per_month = (1 + 2 * len(rdz.DELAYS)) * 3 * (sys.getsizeof(value) + 10) * (10000. / (10 * 1000 * 1000))
+        ttl_seconds = budget * int(math.ceil(60. * 60. * 24. * 30. / credits_per_month))
+        return int(min(ttl_seconds, rdz._MAX_TTL))
+
+    def closed_form_lagged_len(value):
+        t = time.time()
+        sz = (sys.getsizeof(value) + sys.getsizeof(t)) + 10
+        min_sz = sys.getsizeof(51234134.12434) + sys.getsizeof(t) + 10
+        return int(math.ceil(rdz.LAGGED_LEN * (min_sz / sz)))
+
+    for value, budget, ttl, lag_len in zip(values, budgets, ttls, lag_lens):
+        assert ttl == closed_form_ttl(value=value, budget=budget)
+        assert lag_len == closed_form_lagged_len(value)
+    assert lag_lens[0] == rdz.LAGGED_LEN
+    assert lag_lens[2] < rdz.LAGGED_LEN
+
+def test_vectorized_zmean_scenarios_percentiles():
+    rdz = Rediz(**REDIZ_TEST_CONFIG)
+    owners = ['owner' + str(o) for o in range(5)]
+    scenario_lists = [[rdz._format_scenario(owners[o], k) for o, k in
+                       zip(np.random.choice(5, size=n), np.random.choice(rdz.num_predictions + 5, size=n))]
+                      for n in [0, 1, 7, 30]]
+    included = [rdz.shash(owner) for owner in owners[:3]]
+
+    def reference(scenarios, included_codes):
+        owners_prctls = dict((rdz._scenario_owner(s), rdz._scenario_percentile(s)) for s in scenarios if
+                             rdz._scenario_percentile(s) < 1 and
+                             (not included_codes or rdz.shash(rdz._scenario_owner(s)) in included_codes))
+        prctls = list(owners_prctls.values())
+        mean_prctl = Rediz.zmean_percentile(prctls)
+        if prctls and included_codes is not None and len(prctls) < len(included_codes) and abs(mean_prctl - 0.5) > 1e-6:
+            E = np.exp(8.0 * (mean_prctl - 0.5))
+            prctls = prctls + [E / (E + 1)] * (len(included_codes) - len(prctls))
+            return Rediz.zmean_percentile(prctls)
+        return mean_prctl
+
+    for included_codes in [None, included]:
+        zmeans = rdz._zmean_scenarios_percentiles(scenario_lists=scenario_lists, included_codes=included_codes)
+        for scenarios, zmean in zip(scenario_lists, zmeans):
+            assert abs(zmean - reference(scenarios, included_codes)) < 1e-8
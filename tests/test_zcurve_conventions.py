@@ -1,6 +1,7 @@
 
 from rediz import Rediz
 import numpy as np
+from microconventions import MicroConventions
 from rediz.rediz_test_config import REDIZ_TEST_CONFIG
 
 def test_morton():
@@ -11,3 +12,22 @@ def test_morton():
             z = zc.to_zcurve(prctls=prtcls)
             prtcls_back = zc.from_zcurve(z, dim=len(prtcls) )
             assert all( abs(p1-p2)<10./zc.morton_scale(dim=3) for p1,p2 in zip(prtcls,prtcls_back)), "Morton embedding failed "
+
+def test_vectorized_morton():
+    import pymorton
+    zc = Rediz(**REDIZ_TEST_CONFIG)
+    for dim in [2, 3]:
+        ints = np.random.randint(0, zc.morton_scale(dim), size=(200, dim))
+        interleaved = zc._morton_interleave(ints)
+        assert all(int(m) == pymorton.interleave(*[int(i) for i in row]) for m, row in zip(interleaved, ints))
+    for dim in [1, 2, 3]:
+        prctls = np.random.rand(100, dim) * 0.98 + 0.01
+        zvalues = zc._to_zcurves(prctls)
+        assert all(abs(z - zc.to_zcurve(list(row))) < 1e-8 for z, row in zip(zvalues, prctls))
+
+def test_cached_zcurve_name():
+    zc = Rediz(**REDIZ_TEST_CONFIG)
+    names = ['b.json', 'a.json', 'c.json']
+    zname = zc.zcurve_name(names, 70)
+    assert zname == MicroConventions.zcurve_name(zc, names, 70)
+    assert zc.zcurve_name(list(reversed(names)), 70) == zname